@@ -1,5 +1,37 @@
-from .cunning_tokenizer import *
-from .entities_processor import *
-from .lemmatizer import *
-from .normalizer import *
-from .stemmer import *
+import importlib
+
+# The submodules are imported on first access, so the light ones
+# (sentence_splitter, offset_map) don't pull in spacy, pymystem3 and nltk
+_EXPORTS = {
+    "cunning_tokenizer": ["CunningTokenizer", "get_cunning_tokenizer"],
+    "entities_processor": ["EntitiesProcessor"],
+    "gazetteer": ["Gazetteer", "Gazetteers", "compile_gazetteer", "get_gazetteers"],
+    "keyword_automaton": ["KeywordAutomaton"],
+    "lemmatizer": ["TextLemmatizer"],
+    "morphology_cache": ["MorphologyCache", "get_morphology_cache"],
+    "normalizer": ["TextNormalizer"],
+    "offset_map": ["OffsetMap", "TextEditBuffer"],
+    "sentence_prefilter": [
+        "PrefilterStats",
+        "SentencePrefilter",
+        "get_prefilter_stats",
+    ],
+    "sentence_splitter": ["SentenceSplitter"],
+    "stemmer": ["TextSnowballStemmer"],
+    "tokenization_store": ["TokenizationStore"],
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_MODULES[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,11 +1,32 @@
+import hashlib
 import re
 import string
-from typing import List, Tuple, Union
+import threading
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import spacy
 
-__all__ = ["CunningTokenizer"]
+from .offset_map import OffsetMap
+from . import sentence_splitter
+from .sentence_splitter import SentenceSplitter
+
+__all__ = ["CunningTokenizer", "get_cunning_tokenizer"]
+
+_DEFAULT_SPACY_MODEL = "ru_core_news_sm"
+
+# Only spaCy's tokenizer is used (token.text and token.idx), so
+# everything else in the pipeline is not even loaded
+_NON_TOKENIZER_PIPES = [
+    "tok2vec",
+    "morphologizer",
+    "tagger",
+    "parser",
+    "senter",
+    "attribute_ruler",
+    "lemmatizer",
+    "ner",
+]
 
 SentenceForTokenization = Union[
     str,
@@ -15,9 +36,35 @@ SentenceForTokenization = Union[
 ]
 
 
+_TOKENIZE_BATCH_SIZE = 256
+
+_NEWLINE_TOKEN_RE = re.compile("^\\s*\\n+\\s*$")
+
+
 class CunningTokenizer:
-    def __init__(self) -> None:
-        self._nlp = spacy.load("ru_core_news_sm")
+    def __init__(self, model: str = _DEFAULT_SPACY_MODEL) -> None:
+        self._nlp = spacy.load(model, exclude=_NON_TOKENIZER_PIPES)
+        self._splitter = SentenceSplitter()
+        self._version = None
+
+    @property
+    def version(self) -> str:
+        """Version of the tokenization output.
+
+        Made of the spaCy model version and a hash of the tokenizer and
+        splitter sources, so it changes whenever the output might.
+        """
+        if self._version is None:
+            h = hashlib.blake2b(digest_size=8)
+            for module_path in (__file__, sentence_splitter.__file__):
+                with open(module_path, "rb") as f:
+                    h.update(f.read())
+            meta = self._nlp.meta
+            self._version = (
+                f'{meta.get("lang")}_{meta.get("name")}-{meta.get("version")}'
+                f"/spacy-{spacy.__version__}/{h.hexdigest()}"
+            )
+        return self._version
 
     def is_english_token(self, token):
         return re.search("[а-яА-Я]", token) is None
@@ -74,148 +121,118 @@ class CunningTokenizer:
             (self._maybe_split_by_slash, ["/", "\\", *string.whitespace]),
         ]
 
-    def _extract_enums_by_punct(self, offset, s, sent_data, entities, i):
-        res_s = ""
-        lines = re.split("(\n)", s)
-
-        new_sent_data = []
-
-        while len(lines) > 0 and (lines[-1].isspace() or len(lines[-1]) == 0):
-            lines = lines[:-1]
-
-        line_offset = 0
-        for j, line in enumerate(lines):
-            is_last_line_with_entities = False
-            is_line_with_colon = False
-            if j == len(lines) - 1 and i == len(sent_data) - 1 and len(entities) > 0:
-                last_entity_start, _, _ = entities[-1]
-                if last_entity_start > line_offset + len(res_s):
-                    is_last_line_with_entities = True
-
-            is_line_with_colon = re.match("^[А-Я].*:\\s*$", line)
-
-            if is_last_line_with_entities or is_line_with_colon:
-                if not res_s.isspace():
-                    new_sent_data.append((offset + line_offset, res_s))
-                line_offset += len(res_s)
-                res_s = ""
-
-            res_s += line
-        if not res_s.isspace():
-            new_sent_data.append((offset + line_offset, res_s))
-        return new_sent_data
-
-    def _extract_enums_by_line_length(self, sent_data, line_threshold=55):
-        new_sent_data = []
-        for offset, s in sent_data:
-            lines = re.split("(\n)", s)
-
-            line_lengths = []
-
-            for line in lines:
-                if len(line) > 0 and not line.isspace():
-                    line_lengths.append(len(line))
-
-            if len(line_lengths) and np.mean(line_lengths) > line_threshold:
-                line_offset = 0
-                for line in lines:
-                    if len(line) > 0 and not line.isspace():
-                        new_sent_data.append((offset + line_offset, line))
-                    line_offset += len(line)
-            else:
-                new_sent_data.append((offset, s))
-        return new_sent_data
-
     def extract_sentences(self, text, entities=None) -> List[Tuple[int, str]]:
-        if entities is None:
-            entities = []
-        sentences_by_dot = re.split("(\\.[ \n]|\n{3,}|\\!\\?)", text)
-        offset = 0
-        sent_data = []
-        for s in sentences_by_dot:
-            if not re.match("^[\\s\\.]*$", s):
-                sent_data.append((offset, s))
-            offset += len(s)
-
-        new_sent_data = []
-        for i, (offset, s) in enumerate(sent_data):
-            local_sent_data = self._extract_enums_by_punct(
-                offset, s, sent_data, entities, i
-            )
-            local_sent_data = self._extract_enums_by_line_length(local_sent_data)
-            new_sent_data.extend(local_sent_data)
-
-        new_sent_data = [s for s in new_sent_data if len(s[1]) > 0]
-
-        return new_sent_data
+        return self._splitter.split(text, entities)
 
     def add_entities_to_sentences(self, sentences, entities, add_empty=False):
-        for i in range(len(sentences)):
-            s = sentences[i]
-            if len(s) == 3:
-                sentences[i] = (s[0], s[1])
-
+        """Assign entities to sentences.
+
+        An entity goes to the first sentence ending after the entity
+        start. Entities don't have to be sorted; entities starting after
+        the last sentence are dropped.
+
+        Parameters
+        ----------
+        sentences : List[Tuple[int, str]]
+            Sentences as returned by extract_sentences
+        entities : NEREntities
+        add_empty : bool
+            If True, also return sentences without entities
+
+        Returns
+        -------
+        List[Tuple[int, str, NEREntities]]
+            Sentences with their entities sorted by start, ready to be
+            passed to tokenize or tokenize_many
+        """
+        sentences = [(s[0], s[1]) for s in sentences]
         if len(sentences) == 0 or len(entities) == 0:
             if add_empty:
                 return [(o, s, []) for o, s in sentences]
             return []
 
-        res, current_tokens = [], []
-        sent_i = -1
-        current_sent, current_offset = None, None
-        current_sent_end = -1
-        for start, end, class_ in entities:
-            while start >= current_sent_end:
-                if len(current_tokens) > 0 or add_empty and current_sent is not None:
-                    res.append((current_offset, current_sent, current_tokens))
-                    current_tokens = []
-                sent_i += 1
-                current_offset, current_sent = sentences[sent_i]
-                current_sent_end = current_offset + len(current_sent)
-            current_tokens.append((start, end, class_))
-
-        while len(current_tokens) > 0 or add_empty and sent_i <= len(sentences):
-            res.append((current_offset, current_sent, current_tokens))
-            current_tokens = []
-            sent_i += 1
-            if sent_i < len(sentences):
-                current_offset, current_sent = sentences[sent_i]
-            else:
+        sentence_ends = np.fromiter(
+            (o + len(s) for o, s in sentences), dtype=np.int64, count=len(sentences)
+        )
+        entity_starts = np.fromiter(
+            (e[0] for e in entities), dtype=np.int64, count=len(entities)
+        )
+        sentence_indices = np.searchsorted(sentence_ends, entity_starts, side="right")
+        order = np.lexsort((entity_starts, sentence_indices))
+
+        entities_by_sentence = [[] for _ in sentences]
+        for sent_i, ent_i in zip(sentence_indices[order].tolist(), order.tolist()):
+            if sent_i >= len(sentences):
                 break
+            start, end, class_ = entities[ent_i]
+            entities_by_sentence[sent_i].append((start, end, class_))
 
-        return res
+        return [
+            (offset, sentence, sent_entities)
+            for (offset, sentence), sent_entities in zip(
+                sentences, entities_by_sentence
+            )
+            if add_empty or len(sent_entities) > 0
+        ]
 
     def fix_sentences(self, text):
         sent_data = self.extract_sentences(text, [])
         return ". ".join([s[1] for s in sent_data])
 
+    def _split_word(self, word, is_added, split_funcs):
+        if len(split_funcs) == 0 or word.isspace():
+            yield word, is_added
+            return
+        (f, tokens), split_funcs = split_funcs[0], split_funcs[1:]
+
+        split = f(word)
+        if split is not None:
+            split = [s for s in split if len(s) > 0]
+        if split is None or len(split) == 1:
+            yield from self._split_word(word, is_added, split_funcs)
+            return
+        for i, s in enumerate(split):
+            if s in ["/", "\\"]:
+                yield " ", True
+            yield from self._split_word(s, is_added, split_funcs)
+            if s in tokens and i != len(split) - 1:
+                yield " ", True
+
+    def _iter_fixed_punctuation(self, text):
+        # Every split function is applied to the output of the previous
+        # one word by word, so all of them are applied in a single pass
+        split_funcs = self.split_funcs
+        for w in re.split("(\\s+)", text):
+            yield from self._split_word(w, False, split_funcs)
+
     def fix_punctuation_with_data(self, text):
-        words = [(w, False) for w in re.split("(\\s+)", text)]
-        res = []
-        for f, tokens in self.split_funcs:
-            for w, is_added in words:
-                if w.isspace():
-                    res.append((w, is_added))
-                    continue
-
-                split = f(w)
-                if split is not None:
-                    split = [s for s in split if len(s) > 0]
-                if split is None or len(split) == 1:
-                    res.append((w, is_added))
-                else:
-                    for i, s in enumerate(split):
-                        if s in ["/", "\\"]:
-                            res.append((" ", True))
-                        res.append((s, is_added))
-                        if s in tokens and i != len(split) - 1:
-                            res.append((" ", True))
-            words = res
-            res = []
-        return words
+        return list(self._iter_fixed_punctuation(text))
+
+    def fix_punctuation_with_offsets(self, text) -> Tuple[str, OffsetMap]:
+        """Fix punctuation and map the positions of the old text.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        Tuple[str, OffsetMap]
+            The fixed text and the map from the old positions to the new
+            ones
+        """
+        words, insertions = [], []
+        old_pos = 0
+        for word, is_added in self._iter_fixed_punctuation(text):
+            words.append(word)
+            if is_added:
+                insertions.append((old_pos, len(word)))
+            else:
+                old_pos += len(word)
+        return "".join(words), OffsetMap.from_insertions(len(text), insertions)
 
     def fix_punctuation(self, text):
-        return "".join([w[0] for w in self.fix_punctuation_with_data(text)])
+        return "".join([w[0] for w in self._iter_fixed_punctuation(text)])
 
     def _tokenize_parameters(self, sentence: SentenceForTokenization):
         if isinstance(sentence, str):
@@ -228,10 +245,7 @@ class CunningTokenizer:
             offset, text, entities = sentence
         return offset, text, entities
 
-    def tokenize(self, sentence: SentenceForTokenization, with_bio=False):
-        offset, text, entities = self._tokenize_parameters(sentence)
-        doc = self._nlp(text)
-
+    def _tokenize_doc(self, doc, offset, entities, with_bio):
         ent_start, ent_end, ent_class = -1, -1, None
         ent_idx = -1
 
@@ -244,8 +258,8 @@ class CunningTokenizer:
                     if ent_idx >= len(entities):
                         break
                     ent_start, ent_end, ent_class = entities[ent_idx]
-                if ent_end > token_offset >= ent_start and not re.match(
-                    "^\\s*\\n+\\s*$", token.text
+                if ent_end > token_offset >= ent_start and not _NEWLINE_TOKEN_RE.match(
+                    token.text
                 ):
                     if with_bio:
                         if token_offset == ent_start:
@@ -263,10 +277,78 @@ class CunningTokenizer:
 
         return tokens, tags, offsets
 
+    def tokenize(self, sentence: SentenceForTokenization, with_bio=False):
+        offset, text, entities = self._tokenize_parameters(sentence)
+        doc = self._nlp(text)
+        return self._tokenize_doc(doc, offset, entities, with_bio)
+
+    def tokenize_many(
+        self,
+        sentences: List[SentenceForTokenization],
+        with_bio=False,
+        batch_size=_TOKENIZE_BATCH_SIZE,
+    ) -> List[Tuple[List[str], List[str], List[int]]]:
+        """Tokenize a list of sentences at once.
+
+        Same as calling tokenize for each sentence, but the texts are
+        streamed through spaCy with nlp.pipe.
+
+        Parameters
+        ----------
+        sentences : List[SentenceForTokenization]
+            Sentences in any format accepted by tokenize
+        with_bio : bool
+            If True, make tags in the BIO notation
+        batch_size : int
+            Batch size for nlp.pipe
+
+        Returns
+        -------
+        List[Tuple[List[str], List[str], List[int]]]
+            Tokens, tags and offsets for each sentence
+        """
+        parameters = [self._tokenize_parameters(s) for s in sentences]
+        docs = self._nlp.pipe(
+            [text for _, text, _ in parameters], batch_size=batch_size
+        )
+        return [
+            self._tokenize_doc(doc, offset, entities, with_bio)
+            for doc, (offset, _, entities) in zip(docs, parameters)
+        ]
+
     def jsonl_datum_to_labels(self, text, entities):
         sent_data = self.extract_sentences(text)
         sent_data = self.add_entities_to_sentences(sent_data, entities, True)
-        tokenized_sent_data = [self.tokenize(s) for s in sent_data]
+        tokenized_sent_data = self.tokenize_many(sent_data)
         kw_labels = [t[1] for t in tokenized_sent_data]
         kw_tokens = [t[0] for t in tokenized_sent_data]
         return kw_labels, kw_tokens
+
+
+_tokenizers: Dict[str, CunningTokenizer] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_cunning_tokenizer(model: str = _DEFAULT_SPACY_MODEL) -> CunningTokenizer:
+    """Get a process-wide CunningTokenizer.
+
+    The tokenizer is created on the first call and reused afterwards,
+    so the spaCy model is loaded once per process.
+
+    Parameters
+    ----------
+    model : str
+        Name of the spaCy model to take the tokenizer from
+
+    Returns
+    -------
+    CunningTokenizer
+    """
+    try:
+        return _tokenizers[model]
+    except KeyError:
+        pass
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            _tokenizers[model] = CunningTokenizer(model)
+        return _tokenizers[model]
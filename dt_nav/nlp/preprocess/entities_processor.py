@@ -1,8 +1,20 @@
+import concurrent.futures
+import logging
+import re
 import string
+import time
+from typing import Iterable, List, Optional
 
-from pymystem3 import Mystem
+from dt_nav.utils import JsonlDatum
 
-from .cunning_tokenizer import CunningTokenizer
+from .cunning_tokenizer import get_cunning_tokenizer
+from .gazetteer import Gazetteers, get_gazetteers
+from .morphology_cache import MorphologyCache, get_morphology_cache
+from .offset_map import TextEditBuffer
+
+_CPP_FIXES = {"С ++": "C++ ", "C ++": "c++ ", "С\n++": "С++ ", "C\n++": "С++ "}
+
+_CPP_FIXES_RE = re.compile("|".join([re.escape(k) for k in _CPP_FIXES]))
 
 _CAST_TOKENS = {"с++": "c++", "с": "c", "C++": "c++", "C": "c"}
 
@@ -35,13 +47,45 @@ _STUPID_WORDS = set(
     ]
 )
 
+# Goes between tokens analyzed in one call to mystem. Newlines keep
+# mystem from disambiguating a token by its neighbours
+_MYSTEM_SEPARATOR = "\n|||\n"
+
+_MYSTEM_BATCH_SIZE = 1000
+
+# Stages of EntitiesProcessor.process before and after the corpus-wide
+# process_tokens_freq
+_MAP_STAGES = [
+    "preprocess_cpp",
+    "preprocess_split_tokens",
+    "preprocess_prefix_tokens",
+    "preprocess_cast_tokens",
+    "process_tokens_override_classes",
+]
+_FINAL_STAGES = [
+    "preprocess_filter_empty",
+    "preprocess_punctuation_and_sentences",
+]
+
+_CHUNK_SIZE = 100
+
 __all__ = ["EntitiesProcessor"]
 
 
 class EntitiesProcessor:
-    def __init__(self):
-        self._tokenizer = CunningTokenizer()
-        self._mystem = Mystem()
+    def __init__(
+        self,
+        morphology_cache: Optional[MorphologyCache] = None,
+        gazetteers: Optional[Gazetteers] = None,
+    ):
+        self._tokenizer = get_cunning_tokenizer()
+        self._gazetteers = gazetteers or get_gazetteers()
+        self._morphology = morphology_cache or get_morphology_cache()
+        self._mystem = self._morphology.mystem
+        self.stage_timings = {}
+        # Analyses missing in the cache are collected here if it isn't
+        # None, so process_parallel can merge them from the workers
+        self.new_analysis = None
 
     def _preprocess_token_for_cnt(self, token):
         token = token.lower().strip()
@@ -53,17 +97,15 @@ class EntitiesProcessor:
 
     def preprocess_cpp(self, data):
         for datum in data:
-            datum["text"] = (
-                datum["text"]
-                .replace("С ++", "C++ ")
-                .replace("C ++", "c++ ")
-                .replace("С\n++", "С++ ")
-                .replace("C\n++", "С++ ")
-            )
+            buffer = TextEditBuffer(datum["text"])
+            for match in _CPP_FIXES_RE.finditer(datum["text"]):
+                buffer.replace(match.start(), match.end(), _CPP_FIXES[match.group()])
+            datum["text"], _ = buffer.apply()
 
     def preprocess_cast_tokens(self, data):
         for datum in data:
             text = datum["text"]
+            buffer = TextEditBuffer(text)
             for token_datum in datum["entities"]:
                 start, end, _ = token_datum
                 token = text[start:end]
@@ -72,11 +114,10 @@ class EntitiesProcessor:
                     casted = _CAST_TOKENS[proc_token]
                     if len(casted) < len(token):
                         casted = casted.ljust(len(token))
-                    datum["text"] = text[:start] + casted + text[end:]
-                    text = datum["text"]
-
+                    buffer.replace(start, end, casted)
                 except KeyError:
                     pass
+            datum["text"], _ = buffer.apply()
 
     def _convert_split(self, start, split, class_, tokens):
         res = []
@@ -120,8 +161,7 @@ class EntitiesProcessor:
 
     # XXX Потому что иногда он дописывает в конце бесполезный \n
     # И иногда прожевывает знаки препинания, например тут: Wi­Fi
-    def _mystem_safe_analysis(self, token):
-        analysis = self._mystem.analyze(token)
+    def _mystem_fix_analysis(self, analysis, token):
         len_ = 0
         res = []
         while len_ < len(token) and len(analysis) > 0:
@@ -134,13 +174,121 @@ class EntitiesProcessor:
             res[-1]["text"] = res[-1]["text"][:-1]
         return res
 
+    def _mystem_safe_analysis(self, token):
+        return self._mystem_fix_analysis(self._mystem.analyze(token), token)
+
+    def _mystem_split_analysis(self, analysis, count):
+        """Split analysis of tokens joined by _MYSTEM_SEPARATOR.
+
+        The separator is looked for in the text of the analysis, so it
+        doesn't matter if mystem glues it to the neighbouring
+        punctuation. The analysis of every token ends with "\n", as if
+        it was analyzed separately. Returns None if the separators are
+        lost.
+        """
+        out_text = "".join([a["text"] for a in analysis])
+        bounds, pos = [0], 0
+        while True:
+            pos = out_text.find(_MYSTEM_SEPARATOR, pos)
+            if pos == -1:
+                break
+            bounds.extend([pos, pos + len(_MYSTEM_SEPARATOR)])
+            pos += len(_MYSTEM_SEPARATOR)
+        bounds.append(len(out_text))
+        if len(bounds) != count * 2:
+            return None
+
+        res = [[] for _ in range(count)]
+        item_start, i = 0, 0
+        for a in analysis:
+            item_end = item_start + len(a["text"])
+            while i < count and bounds[2 * i + 1] <= item_start:
+                i += 1
+            j = i
+            while j < count and bounds[2 * j] < item_end:
+                seg_start, seg_end = bounds[2 * j], bounds[2 * j + 1]
+                if seg_start <= item_start and item_end <= seg_end:
+                    res[j].append(a)
+                elif max(seg_start, item_start) < min(seg_end, item_end):
+                    part = {**a}
+                    part["text"] = a["text"][
+                        max(seg_start, item_start)
+                        - item_start : min(seg_end, item_end)
+                        - item_start
+                    ]
+                    res[j].append(part)
+                j += 1
+            item_start = item_end
+
+        # mystem adds this one at the end of every call, gluing it to the
+        # trailing punctuation if there is any
+        for token_analysis in res[:-1]:
+            if len(token_analysis) > 0 and "analysis" not in token_analysis[-1]:
+                last = {**token_analysis[-1]}
+                last["text"] += "\n"
+                token_analysis[-1] = last
+            else:
+                token_analysis.append({"text": "\n"})
+        return res
+
+    def _mystem_safe_analysis_many(self, tokens):
+        """Analyze many tokens with a few calls to mystem.
+
+        The tokens are joined by _MYSTEM_SEPARATOR and sent to mystem in
+        batches of _MYSTEM_BATCH_SIZE, then the analysis is split back
+        per token and fixed as in _mystem_safe_analysis.
+        """
+        res = [None] * len(tokens)
+        batch = []
+        for i, token in enumerate(tokens):
+            if _MYSTEM_SEPARATOR in token:
+                res[i] = self._mystem_safe_analysis(token)
+            else:
+                batch.append(i)
+
+        for batch_start in range(0, len(batch), _MYSTEM_BATCH_SIZE):
+            indices = batch[batch_start : batch_start + _MYSTEM_BATCH_SIZE]
+            batch_tokens = [tokens[i] for i in indices]
+            analysis = self._mystem.analyze(_MYSTEM_SEPARATOR.join(batch_tokens))
+            split = self._mystem_split_analysis(analysis, len(batch_tokens))
+            for i, token, token_analysis in zip(
+                indices, batch_tokens, split or [None] * len(indices)
+            ):
+                if token_analysis is None:
+                    res[i] = self._mystem_safe_analysis(token)
+                else:
+                    res[i] = self._mystem_fix_analysis(token_analysis, token)
+        return res
+
+    def _mystem_cached_analysis_many(self, tokens):
+        res = [self._morphology.get_analysis(token) for token in tokens]
+        missing = list(dict.fromkeys([t for t, a in zip(tokens, res) if a is None]))
+        analysis_by_token = dict(zip(missing, self._mystem_safe_analysis_many(missing)))
+        for token, analysis in analysis_by_token.items():
+            self._morphology.put_analysis(token, analysis)
+        if self.new_analysis is not None:
+            self.new_analysis.update(analysis_by_token)
+        return [
+            analysis_by_token[token] if analysis is None else analysis
+            for token, analysis in zip(tokens, res)
+        ]
+
     def preprocess_prefix_tokens(self, data):
+        analyses = iter(
+            self._mystem_cached_analysis_many(
+                [
+                    datum["text"][start:end]
+                    for datum in data
+                    for start, end, _ in datum["entities"]
+                ]
+            )
+        )
         for datum in data:
             text = datum["text"]
             for token_datum in datum["entities"]:
                 start, end, _ = token_datum
                 token = text[start:end]
-                analysis = self._mystem_safe_analysis(token)
+                analysis = next(analyses)
 
                 actual_start = start
                 if (
@@ -183,19 +331,17 @@ class EntitiesProcessor:
                 token_datum[1] = actual_end
 
     def process_tokens_override_classes(self, data):
-        with open("./data/programming_languages.txt") as f:
-            prog_lang_names = set([l.strip() for l in f.readlines()])
-
         for datum in data:
             text = datum["text"]
             for token_datum in datum["entities"]:
                 start, end, _ = token_datum
                 token = text[start:end]
                 token = self._preprocess_token_for_cnt(token)
-                if token in prog_lang_names:
-                    token_datum[2] = "ProgLanguage"
+                class_ = self._gazetteers.classify(token)
+                if class_ is not None:
+                    token_datum[2] = class_
 
-    def process_tokens_freq(self, data):
+    def _count_token_classes(self, data):
         all_tokens = {}
 
         for datum in data:
@@ -213,12 +359,16 @@ class EntitiesProcessor:
                     token_data[class_] += 1
                 except KeyError:
                     token_data[class_] = 1
+        return all_tokens
 
+    def _top_token_classes(self, all_tokens):
         token_top_class = {}
         for token, token_data in all_tokens.items():
             top_class = max(token_data, key=token_data.get)
             token_top_class[token] = top_class
+        return token_top_class
 
+    def _apply_token_classes(self, data, token_top_class):
         for datum in data:
             text = datum["text"]
             for token_datum in datum["entities"]:
@@ -227,60 +377,248 @@ class EntitiesProcessor:
                 token = self._preprocess_token_for_cnt(token)
                 token_datum[2] = token_top_class[token]
 
+    def process_tokens_freq(self, data):
+        all_tokens = self._count_token_classes(data)
+        self._apply_token_classes(data, self._top_token_classes(all_tokens))
+
     def preprocess_punctuation(self, data):
         for datum in data:
-            words = self._tokenizer.fix_punctuation_with_data(datum["text"])
-            dumb_mapping = {}
-            old_pos, new_pos = 0, 0
-            for word, is_added in words:
-                for _ in range(0, len(word)):
-                    if not is_added:
-                        dumb_mapping[old_pos] = new_pos
-                    new_pos += 1
-                    if not is_added:
-                        old_pos += 1
-
-            new_entities = []
-            for start, end, t in datum["entities"]:
-                new_entities.append((dumb_mapping[start], dumb_mapping[end], t))
-            datum["text"] = "".join([w[0] for w in words])
-            datum["entities"] = new_entities
+            text, offset_map = self._tokenizer.fix_punctuation_with_offsets(
+                datum["text"]
+            )
+            datum["entities"] = offset_map.remap_spans(datum["entities"])
+            datum["text"] = text
+
+    def _sentences_edit(self, text, entities, add_empty):
+        """Put every sentence on its own with a dot and a space.
+
+        Returns the new text, the offset map and the indices of entities
+        in the order of the new text.
+        """
+        sentences = self._tokenizer.extract_sentences(text, entities)
+        sentences_with_entities = self._tokenizer.add_entities_to_sentences(
+            sentences,
+            [(start, end, i) for i, (start, end, _) in enumerate(entities)],
+            add_empty=add_empty,
+        )
+        buffer = TextEditBuffer(text)
+        order = []
+        first_offset = len(text)
+        if len(sentences_with_entities) > 0:
+            first_offset = sentences_with_entities[0][0]
+        if first_offset > 0:
+            buffer.delete(0, first_offset, anchor="end")
+        next_offsets = [offset for offset, _, _ in sentences_with_entities[1:]]
+        next_offsets.append(len(text))
+        for (offset, sentence, sent_entities), next_offset in zip(
+            sentences_with_entities, next_offsets
+        ):
+            stripped_len = len(sentence.rstrip())
+            suffix = ""
+            if stripped_len > 0:
+                if not sentence[stripped_len - 1] in string.punctuation:
+                    suffix += "."
+                suffix += " "
+            # Trailing spaces and the text up to the next sentence go away,
+            # the positions there move together with the sentence
+            buffer.replace(offset + stripped_len, next_offset, suffix)
+            order.extend([i for _, _, i in sent_entities])
+        new_text, offset_map = buffer.apply()
+        return new_text, offset_map, order
 
     def preprocess_sentences(self, data, add_empty=True):
         for datum in data:
-            sentences = self._tokenizer.extract_sentences(
-                datum["text"], datum["entities"]
+            entities = datum["entities"]
+            text, offset_map, order = self._sentences_edit(
+                datum["text"], entities, add_empty
             )
-            sentences_with_entities = self._tokenizer.add_entities_to_sentences(
-                sentences, datum["entities"], add_empty=add_empty
+            datum["text"] = text
+            datum["entities"] = offset_map.remap_spans([entities[i] for i in order])
+
+    def preprocess_punctuation_and_sentences(self, data, add_empty=True):
+        """preprocess_punctuation and preprocess_sentences in one go.
+
+        The offset maps of both are composed, so the entities are moved
+        to the final text once.
+        """
+        for datum in data:
+            entities = datum["entities"]
+            text, punctuation_map = self._tokenizer.fix_punctuation_with_offsets(
+                datum["text"]
+            )
+            text, sentences_map, order = self._sentences_edit(
+                text, punctuation_map.remap_spans(entities), add_empty
             )
-            new_text, new_entities = "", []
-            for offset, sentence, sent_entities in sentences_with_entities:
-                stripped_sentence = sentence.rstrip()
-                if len(stripped_sentence) > 0:
-                    if not stripped_sentence[-1] in string.punctuation:
-                        stripped_sentence += "."
-                    stripped_sentence += " "
+            offset_map = punctuation_map.then(sentences_map)
+            datum["text"] = text
+            datum["entities"] = offset_map.remap_spans([entities[i] for i in order])
+
+    def _run_stages(self, data, stages, timings):
+        for stage in stages:
+            start = time.perf_counter()
+            getattr(self, stage)(data)
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+    def _map_pass(self, data, timings):
+        """Run the stages preceding process_tokens_freq.
+
+        Returns the counts of entity classes by token for the reduction.
+        """
+        self._run_stages(data, _MAP_STAGES, timings)
+        start = time.perf_counter()
+        all_tokens = self._count_token_classes(data)
+        timings["process_tokens_freq"] = (
+            timings.get("process_tokens_freq", 0) + time.perf_counter() - start
+        )
+        return all_tokens
+
+    def _final_pass(self, data, token_top_class, timings):
+        """Run process_tokens_freq with the reduced classes and the rest."""
+        start = time.perf_counter()
+        self._apply_token_classes(data, token_top_class)
+        timings["process_tokens_freq"] = (
+            timings.get("process_tokens_freq", 0) + time.perf_counter() - start
+        )
+        self._run_stages(data, _FINAL_STAGES, timings)
+
+    def _log_timings(self, timings):
+        logging.info(
+            "EntitiesProcessor stage timings: "
+            + ", ".join([f"{stage}={t:.2f}s" for stage, t in timings.items()])
+        )
+        logging.info(f"Morphology cache: {self._morphology.stats()}")
+        if self._morphology.path is not None:
+            self._morphology.save()
 
-                delta = offset - len(new_text)
+    def process(self, data):
+        self.stage_timings = {}
+        all_tokens = self._map_pass(data, self.stage_timings)
+        token_top_class = self._top_token_classes(all_tokens)
+        self._final_pass(data, token_top_class, self.stage_timings)
+        self._log_timings(self.stage_timings)
+        return data
 
-                for entity in sent_entities:
-                    start, end, ent_text = entity
-                    new_entities.append((start - delta, end - delta, ent_text))
+    def process_parallel(
+        self,
+        data: Iterable[JsonlDatum],
+        max_workers: Optional[int] = None,
+        chunk_size=_CHUNK_SIZE,
+    ) -> List[JsonlDatum]:
+        """Process datums in parallel, the same as process does.
+
+        Every chunk of datums goes through all stages in a worker
+        process with its own tokenizer and mystem. process_tokens_freq
+        needs the counts over the whole corpus, so all chunks pass the
+        preceding stages before any of them goes on.
+
+        All the datums are kept in memory of the current process, so
+        data must fit there. Every chunk is sent to the workers twice,
+        before and after the barrier.
+
+        Workers use the morphology cache file of this processor. The
+        analyses they add are merged into its cache, which is saved
+        once at the end.
+
+        Parameters
+        ----------
+        data : Iterable[JsonlDatum]
+        max_workers : Optional[int]
+            Number of worker processes. If 1, everything is done in the
+            current process
+        chunk_size : int
+            Number of datums sent to a worker at once
+
+        Returns
+        -------
+        List[JsonlDatum]
+            Processed datums in the original order
+        """
+        self.stage_timings = {}
+        chunks = _chunked(data, chunk_size)
+        res = []
 
-                new_text += stripped_sentence
+        if max_workers == 1:
+            processed, all_tokens = [], {}
+            for chunk in chunks:
+                chunk_tokens = self._map_pass(chunk, self.stage_timings)
+                _merge_token_classes(all_tokens, chunk_tokens)
+                processed.append(chunk)
+            token_top_class = self._top_token_classes(all_tokens)
+            for chunk in processed:
+                self._final_pass(chunk, token_top_class, self.stage_timings)
+                res.extend(chunk)
+            self._log_timings(self.stage_timings)
+            return res
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(self._morphology.path,),
+        ) as executor:
+            processed, chunk_token_lists, all_tokens = [], [], {}
+            for chunk, chunk_tokens, new_analysis, timings in executor.map(
+                _map_chunk, chunks
+            ):
+                for token, analysis in new_analysis.items():
+                    self._morphology.put_analysis(token, analysis)
+                _merge_token_classes(all_tokens, chunk_tokens)
+                _merge_timings(self.stage_timings, timings)
+                processed.append(chunk)
+                chunk_token_lists.append(list(chunk_tokens.keys()))
+
+            # The barrier: every chunk is counted, now the classes are known
+            token_top_class = self._top_token_classes(all_tokens)
+            tasks = (
+                (chunk, {t: token_top_class[t] for t in chunk_tokens})
+                for chunk, chunk_tokens in zip(processed, chunk_token_lists)
+            )
+            for chunk, timings in executor.map(_final_chunk, tasks):
+                _merge_timings(self.stage_timings, timings)
+                res.extend(chunk)
+        self._log_timings(self.stage_timings)
+        return res
 
-            datum["text"] = new_text
-            datum["entities"] = new_entities
 
-    def process(self, data):
-        self.preprocess_cpp(data)
-        self.preprocess_split_tokens(data)
-        self.preprocess_prefix_tokens(data)
-        self.preprocess_cast_tokens(data)
-        self.process_tokens_override_classes(data)
-        self.process_tokens_freq(data)
-        self.preprocess_filter_empty(data)
-        self.preprocess_punctuation(data)
-        self.preprocess_sentences(data)
-        return data
+def _chunked(data, chunk_size):
+    chunk = []
+    for datum in data:
+        chunk.append(datum)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _merge_token_classes(all_tokens, chunk_tokens):
+    for token, token_data in chunk_tokens.items():
+        target = all_tokens.setdefault(token, {})
+        for class_, count in token_data.items():
+            target[class_] = target.get(class_, 0) + count
+
+
+def _merge_timings(timings, chunk_timings):
+    for stage, t in chunk_timings.items():
+        timings[stage] = timings.get(stage, 0) + t
+
+
+_processor = None
+
+
+def _init_worker(morphology_path: Optional[str]):
+    global _processor
+    _processor = EntitiesProcessor(get_morphology_cache(morphology_path))
+
+
+def _map_chunk(chunk):
+    timings = {}
+    _processor.new_analysis = {}
+    chunk_tokens = _processor._map_pass(chunk, timings)
+    return chunk, chunk_tokens, _processor.new_analysis, timings
+
+
+def _final_chunk(task):
+    chunk, token_top_class = task
+    timings = {}
+    _processor._final_pass(chunk, token_top_class, timings)
+    return chunk, timings
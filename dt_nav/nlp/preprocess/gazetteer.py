@@ -0,0 +1,233 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Mapping, Optional, Union
+
+__all__ = ["Gazetteer", "Gazetteers", "compile_gazetteer", "get_gazetteers"]
+
+_DATA_DIR = Path(__file__).resolve().parents[3] / "data"
+
+DEFAULT_GAZETTEERS = {"ProgLanguage": _DATA_DIR / "programming_languages.txt"}
+
+_MAGIC = b"DTGAZ001"
+_HEADER = struct.Struct("<8sI")
+_OFFSET = struct.Struct("<I")
+
+_RELOAD_CHECK_INTERVAL = 5.0
+
+PathLike = Union[str, os.PathLike]
+
+
+def compile_gazetteer(entries: Iterable[str], path: PathLike):
+    """Write a compiled gazetteer.
+
+    The file is a header with the number of entries, the offsets of
+    the entries and then the sorted UTF-8 encoded entries themselves,
+    so it can be searched right in the mapped memory.
+
+    Parameters
+    ----------
+    entries : Iterable[str]
+    path : PathLike
+        Path to the compiled file. It is replaced atomically
+    """
+    encoded = sorted(set([e.encode("utf-8") for e in entries]))
+    offsets = [0]
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(encoded)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+
+
+class _MappedEntries:
+    """Sorted entries of a compiled gazetteer as a sequence of bytes."""
+
+    def __init__(self, path: PathLike):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"Empty compiled gazetteer: {path}")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self._mm.close()
+            raise ValueError(f"Not a compiled gazetteer: {path}")
+        self._offsets_start = _HEADER.size
+        self._data_start = self._offsets_start + (self._count + 1) * _OFFSET.size
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._mm, self._offsets_start + i * _OFFSET.size)[0]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i) -> bytes:
+        start = self._data_start + self._offset(i)
+        end = self._data_start + self._offset(i + 1)
+        return self._mm[start:end]
+
+    def __contains__(self, entry: bytes):
+        i = bisect.bisect_left(self, entry)
+        return i < self._count and self[i] == entry
+
+    def close(self):
+        self._mm.close()
+
+
+class Gazetteer:
+    """A dictionary of names loaded from a text file with one name per line.
+
+    The file is compiled to a sorted memory-mapped form, so every
+    worker process can load it cheaply. The compiled file is rebuilt
+    when the source file changes, and the gazetteer reloads itself on
+    the next lookup after that.
+
+    Parameters
+    ----------
+    path : PathLike
+        Source text file
+    compiled_path : Optional[PathLike]
+        Path to the compiled file, path with ".gaz" appended by default
+    check_interval : float
+        How often to check the source file for changes, in seconds
+    """
+
+    def __init__(
+        self,
+        path: PathLike,
+        compiled_path: Optional[PathLike] = None,
+        check_interval=_RELOAD_CHECK_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.compiled_path = Path(compiled_path or f"{path}.gaz")
+        self.check_interval = check_interval
+        self._entries = None
+        self._source_mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # Held by lookups, so the entries are not closed under them
+        self._entries_lock = threading.Lock()
+
+    def _compile(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            entries = [line.strip() for line in f]
+        self.compiled_path.parent.mkdir(parents=True, exist_ok=True)
+        compile_gazetteer(entries, self.compiled_path)
+        logging.info(f"Compiled gazetteer {self.path}: {len(set(entries))} entries")
+
+    def _load(self, source_mtime):
+        if (
+            not self.compiled_path.exists()
+            or self.compiled_path.stat().st_mtime < source_mtime
+        ):
+            self._compile()
+        entries = _MappedEntries(self.compiled_path)
+        with self._entries_lock:
+            old_entries, self._entries = self._entries, entries
+            if old_entries is not None:
+                old_entries.close()
+        self._source_mtime = source_mtime
+
+    def reload(self, force=False):
+        """Reload the gazetteer if the source file has changed."""
+        with self._lock:
+            source_mtime = self.path.stat().st_mtime
+            if force or self._entries is None or source_mtime != self._source_mtime:
+                self._load(source_mtime)
+            self._checked_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if (
+            self._entries is None
+            or time.monotonic() - self._checked_at > self.check_interval
+        ):
+            self.reload()
+
+    def __len__(self):
+        self._ensure_loaded()
+        with self._entries_lock:
+            return len(self._entries)
+
+    def __contains__(self, name: str):
+        self._ensure_loaded()
+        with self._entries_lock:
+            return name.encode("utf-8") in self._entries
+
+
+class Gazetteers:
+    """Gazetteers of NER classes.
+
+    Parameters
+    ----------
+    dictionaries : Optional[Mapping[str, PathLike]]
+        Source files of the classes. If a name is in several
+        gazetteers, the first class wins. By default, ProgLanguage
+        from data/programming_languages.txt in the repository
+    compiled_dir : Optional[PathLike]
+        Directory for the compiled files, next to the sources by default
+    """
+
+    def __init__(
+        self,
+        dictionaries: Optional[Mapping[str, PathLike]] = None,
+        compiled_dir: Optional[PathLike] = None,
+    ):
+        if dictionaries is None:
+            dictionaries = DEFAULT_GAZETTEERS
+        self.gazetteers: Dict[str, Gazetteer] = {
+            class_: Gazetteer(
+                path,
+                compiled_path=(
+                    Path(compiled_dir) / f"{class_}.gaz"
+                    if compiled_dir is not None
+                    else None
+                ),
+            )
+            for class_, path in dictionaries.items()
+        }
+
+    def classify(self, name: str) -> Optional[str]:
+        """Get the class of the name, None if it is in no gazetteer."""
+        for class_, gazetteer in self.gazetteers.items():
+            if name in gazetteer:
+                return class_
+        return None
+
+    def reload(self, force=False):
+        for gazetteer in self.gazetteers.values():
+            gazetteer.reload(force)
+
+
+_gazetteers = None
+_gazetteers_lock = threading.Lock()
+
+
+def get_gazetteers() -> Gazetteers:
+    """Get the process-wide gazetteers.
+
+    The source files are settings.ner.gazetteers, DEFAULT_GAZETTEERS if
+    it isn't set. They are compiled into settings.ner.state_dir.
+
+    Returns
+    -------
+    Gazetteers
+    """
+    global _gazetteers
+    from dt_nav.api import settings
+
+    with _gazetteers_lock:
+        if _gazetteers is None:
+            _gazetteers = Gazetteers(
+                getattr(settings.ner, "gazetteers", None),
+                compiled_dir=os.path.join(settings.ner.state_dir, "gazetteers"),
+            )
+        return _gazetteers
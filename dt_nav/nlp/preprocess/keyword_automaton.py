@@ -0,0 +1,202 @@
+from collections import deque
+from typing import Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+__all__ = ["KeywordAutomaton"]
+
+T = TypeVar("T")
+
+
+def _fold_char(c: str) -> str:
+    # Some characters change length when lowercased (e.g. "İ"), which
+    # would break the offsets, so they are kept as is
+    lower = c.lower()
+    return lower if len(lower) == 1 else c
+
+
+def _fold(text: str) -> str:
+    lower = text.lower()
+    if len(lower) == len(text):
+        return lower
+    return "".join([_fold_char(c) for c in text])
+
+
+def _is_word_char(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+class KeywordAutomaton(Generic[T]):
+    """Aho-Corasick automaton for case-insensitive keyword search.
+
+    Keywords can be added at any time. The failure links are rebuilt
+    lazily on the next search after that, so adding keywords while
+    another thread searches is not safe. Add them to a copy instead,
+    build it and then replace the searched automaton with the copy.
+
+    A keyword starting or ending with a word character only matches at
+    a word boundary on that side, so "go" is not found in "google".
+
+    Examples
+    --------
+    automaton = KeywordAutomaton()
+    automaton.add("python", "ProgLanguage")
+    automaton.add("sql", "Tool")
+    automaton.find("Python, SQL")
+    # [(0, 6, "ProgLanguage"), (8, 11, "Tool")]
+    """
+
+    def __init__(self, keywords: Optional[Iterable[Tuple[str, T]]] = None):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Node of the longest keyword ending at the node, if any
+        self._match: List[int] = [-1]
+        self._values: List[Optional[Tuple[int, T]]] = [None]
+        self._count = 0
+        self._dirty = False
+        if keywords is not None:
+            self.add_many(keywords)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, keyword: str):
+        node = self._node(_fold(keyword))
+        return node is not None and self._values[node] is not None
+
+    def _node(self, folded: str) -> Optional[int]:
+        node = 0
+        for c in folded:
+            node = self._goto[node].get(c)
+            if node is None:
+                return None
+        return node
+
+    def add(self, keyword: str, value: T):
+        """Add a keyword or replace the value of an existing one.
+
+        Parameters
+        ----------
+        keyword : str
+        value : T
+            Returned with every match of the keyword
+        """
+        if len(keyword) == 0:
+            return
+        node = 0
+        for c in _fold(keyword):
+            next_node = self._goto[node].get(c)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._match.append(-1)
+                self._values.append(None)
+                self._goto[node][c] = next_node
+                self._dirty = True
+            node = next_node
+        if self._values[node] is None:
+            self._count += 1
+            self._dirty = True
+        self._values[node] = (len(keyword), value)
+
+    def add_many(self, keywords: Iterable[Tuple[str, T]]):
+        for keyword, value in keywords:
+            self.add(keyword, value)
+
+    def copy(self) -> "KeywordAutomaton[T]":
+        """Get a copy which can be changed without affecting this one."""
+        other = KeywordAutomaton()
+        other._goto = [dict(d) for d in self._goto]
+        other._fail = list(self._fail)
+        other._match = list(self._match)
+        other._values = list(self._values)
+        other._count = self._count
+        other._dirty = self._dirty
+        return other
+
+    def build(self):
+        """Build the failure links now instead of on the next search."""
+        if self._dirty:
+            self._build()
+
+    def _build(self):
+        queue = deque()
+        for node in self._goto[0].values():
+            self._fail[node] = 0
+            queue.append(node)
+        self._match[0] = -1
+        while len(queue) > 0:
+            node = queue.popleft()
+            fail = self._fail[node]
+            if self._values[node] is not None:
+                self._match[node] = node
+            else:
+                self._match[node] = self._match[fail]
+            for c, child in self._goto[node].items():
+                f = fail
+                while f != 0 and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(c, 0)
+                queue.append(child)
+        self._dirty = False
+
+    def _iter_matches(self, text: str) -> Iterator[Tuple[int, int, T]]:
+        self.build()
+        goto, fail, match, values = self._goto, self._fail, self._match, self._values
+        node = 0
+        for i, c in enumerate(_fold(text)):
+            while node != 0 and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            out = match[node]
+            while out != -1:
+                length, value = values[out]
+                yield i + 1 - length, i + 1, value
+                out = match[fail[out]]
+
+    def _at_boundaries(self, text: str, start: int, end: int) -> bool:
+        if _is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1]):
+            return False
+        if (
+            _is_word_char(text[end - 1])
+            and end < len(text)
+            and _is_word_char(text[end])
+        ):
+            return False
+        return True
+
+    def find_all(self, text: str) -> Iterator[Tuple[int, int, T]]:
+        """Find all matches of the keywords, including overlapping ones.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        Iterator[Tuple[int, int, T]]
+            Start, end and value of every match, ordered by the end
+        """
+        for start, end, value in self._iter_matches(text):
+            if self._at_boundaries(text, start, end):
+                yield start, end, value
+
+    def find(self, text: str) -> List[Tuple[int, int, T]]:
+        """Find the leftmost longest non-overlapping matches.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        List[Tuple[int, int, T]]
+            Start, end and value of every match, ordered by the start
+        """
+        matches = sorted(self.find_all(text), key=lambda m: (m[0], -m[1]))
+        res = []
+        prev_end = 0
+        for start, end, value in matches:
+            if start >= prev_end:
+                res.append((start, end, value))
+                prev_end = end
+        return res
@@ -1,6 +1,8 @@
 from pymystem3 import Mystem
 from sklearn.base import BaseEstimator, TransformerMixin
 
+from .morphology_cache import get_morphology_cache
+
 __all__ = ["TextLemmatizer"]
 
 
@@ -8,15 +10,24 @@ class TextLemmatizer(BaseEstimator, TransformerMixin):
     stemmer: Mystem
 
     def __init__(self):
-        if (
-            not hasattr(TextLemmatizer, "stemmer")
-            or getattr(TextLemmatizer, "stemmer") is None
-        ):
-            TextLemmatizer.stemmer = Mystem()
-        self.stemmer = TextLemmatizer.stemmer
+        self._morphology = get_morphology_cache()
+        self.stemmer = self._morphology.mystem
+
+    def __getstate__(self):
+        # The cache and mystem belong to the process, and the lock and
+        # the mystem subprocess can't be pickled anyway
+        state = dict(super().__getstate__())
+        state.pop("_morphology", None)
+        state.pop("stemmer", None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._morphology = get_morphology_cache()
+        self.stemmer = self._morphology.mystem
 
     def stem(self, string):
-        return "".join(self.stemmer.lemmatize(string))
+        return self._morphology.lemmatize(string)
 
     def fit(self, X, y=None):
         return self
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from pymystem3 import Mystem
+
+__all__ = ["MorphologyCache", "get_morphology_cache"]
+
+
+class MorphologyCache:
+    """LRU cache of mystem analysis and lemmas.
+
+    The same short strings are sent to mystem over and over again, so
+    both EntitiesProcessor and TextLemmatizer go through this cache.
+    Cached analysis is shared between callers and must not be modified.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of entries of each kind
+    path : Optional[str]
+        JSON file to load the cache from and save it to
+    """
+
+    def __init__(self, max_size=200000, path: Optional[str] = None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._mystem = None
+        self._analysis = OrderedDict()
+        self._lemmas = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @property
+    def mystem(self) -> Mystem:
+        if self._mystem is None:
+            self._mystem = Mystem()
+        return self._mystem
+
+    def _get(self, entries, key):
+        with self._lock:
+            try:
+                value = entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _put(self, entries, key, value):
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def get_analysis(self, token: str) -> Optional[list]:
+        return self._get(self._analysis, token)
+
+    def put_analysis(self, token: str, analysis: list):
+        self._put(self._analysis, token, analysis)
+
+    def lemmatize(self, string: str) -> str:
+        lemma = self._get(self._lemmas, string)
+        if lemma is None:
+            lemma = "".join(self.mystem.lemmatize(string))
+            self._put(self._lemmas, string, lemma)
+        return lemma
+
+    def load(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            self._analysis.update(data.get("analysis", {}))
+            self._lemmas.update(data.get("lemmas", {}))
+        logging.info(
+            f"Loaded morphology cache from {path}: {len(self._analysis)} analyses, "
+            f"{len(self._lemmas)} lemmas"
+        )
+
+    def save(self, path: Optional[str] = None):
+        """Save the cache to a JSON file.
+
+        Parameters
+        ----------
+        path : Optional[str]
+            Path to the file, self.path by default
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the morphology cache to")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock:
+            data = {"analysis": self._analysis, "lemmas": self._lemmas}
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "analyses": len(self._analysis),
+            "lemmas": len(self._lemmas),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+
+_morphology_cache = None
+_morphology_cache_lock = threading.Lock()
+
+
+def _default_path() -> Optional[str]:
+    from dt_nav.api import settings
+
+    return getattr(
+        settings.ner,
+        "morphology_cache_path",
+        os.path.join(settings.ner.state_dir, "morphology_cache.json"),
+    )
+
+
+def get_morphology_cache(path: Optional[str] = None) -> MorphologyCache:
+    """Get the process-wide morphology cache.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        JSON file to persist the cache to. Only used when the cache is
+        created, i.e. on the first call. By default,
+        settings.ner.morphology_cache_path, morphology_cache.json in
+        settings.ner.state_dir if it isn't set. Set it to None in the
+        settings to keep the cache in memory only
+
+    Returns
+    -------
+    MorphologyCache
+    """
+    global _morphology_cache
+    with _morphology_cache_lock:
+        if _morphology_cache is None:
+            _morphology_cache = MorphologyCache(path=path or _default_path())
+        return _morphology_cache
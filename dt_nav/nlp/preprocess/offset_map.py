@@ -0,0 +1,191 @@
+import bisect
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from dt_nav.utils import NEREntities
+
+__all__ = ["OffsetMap", "TextEditBuffer"]
+
+
+class OffsetMap:
+    """Mapping of positions in an old text to positions in a new text.
+
+    positions[i] is the new position of the i-th character of the old
+    text, used for entity starts. ends[i] is the new position for an
+    entity ending at i, which is the same unless some text was replaced
+    around i. Both arrays have one extra element for the end of the text.
+    """
+
+    def __init__(self, positions: np.ndarray, ends: Optional[np.ndarray] = None):
+        self.positions = positions
+        self.ends = positions if ends is None else ends
+
+    @classmethod
+    def identity(cls, length: int) -> "OffsetMap":
+        return cls(np.arange(length + 1, dtype=np.int64))
+
+    @classmethod
+    def from_insertions(
+        cls, length: int, insertions: Iterable[Tuple[int, int]]
+    ) -> "OffsetMap":
+        """Make a map for a text with some strings inserted into it.
+
+        Parameters
+        ----------
+        length : int
+            Length of the old text
+        insertions : Iterable[Tuple[int, int]]
+            Old positions and lengths of the inserted strings. A string
+            inserted at the position goes before the old character.
+
+        Returns
+        -------
+        OffsetMap
+        """
+        shifts = np.zeros(length + 1, dtype=np.int64)
+        for position, inserted_length in insertions:
+            shifts[position] += inserted_length
+        return cls(np.arange(length + 1, dtype=np.int64) + np.cumsum(shifts))
+
+    def __len__(self):
+        return len(self.positions) - 1
+
+    def __getitem__(self, position: int) -> int:
+        return int(self.positions[position])
+
+    def then(self, other: "OffsetMap") -> "OffsetMap":
+        """Compose with the map of the next edit of the new text."""
+        return OffsetMap(other.positions[self.positions], other.ends[self.ends])
+
+    def remap_spans(self, entities: NEREntities) -> NEREntities:
+        """Move all entities to the new text at once.
+
+        Parameters
+        ----------
+        entities : NEREntities
+
+        Returns
+        -------
+        NEREntities
+            Entities with remapped starts and ends
+        """
+        if len(entities) == 0:
+            return []
+        starts = np.array([e[0] for e in entities], dtype=np.int64)
+        ends = np.array([e[1] for e in entities], dtype=np.int64)
+        return [
+            (start, end, e[2])
+            for start, end, e in zip(
+                self.positions[starts].tolist(), self.ends[ends].tolist(), entities
+            )
+        ]
+
+
+def _spans_conflict(a, b):
+    (a_start, a_end), (b_start, b_end) = a, b
+    if a_start == a_end and b_start == b_end:
+        return a_start == b_start
+    if a_start == a_end:
+        return b_start < a_start < b_end
+    if b_start == b_end:
+        return a_start < b_start < a_end
+    return max(a_start, b_start) < min(a_end, b_end)
+
+
+class TextEditBuffer:
+    """Collect edits of a text and apply them in one pass.
+
+    Every edit replaces a span of the text with a string. Insertions and
+    deletions are replacements of an empty span and with an empty string.
+    An edit overlapping one added earlier is ignored.
+
+    Positions inside a replaced span are moved together with its start,
+    or with its end if the edit is anchored at the end, and are clamped
+    to the replacement.
+
+    Parameters
+    ----------
+    text : str
+        The text to edit
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self._keys = []
+        self._edits = []
+
+    def replace(self, start: int, end: int, replacement: str, anchor="start") -> bool:
+        """Replace text[start:end] with replacement.
+
+        Parameters
+        ----------
+        start : int
+        end : int
+        replacement : str
+        anchor : str
+            "start" or "end"
+
+        Returns
+        -------
+        bool
+            False if the edit overlaps an existing one and is ignored
+        """
+        key = (start, end)
+        i = bisect.bisect_right(self._keys, key)
+        for j in (i - 1, i):
+            if 0 <= j < len(self._keys) and _spans_conflict(self._keys[j], key):
+                return False
+        self._keys.insert(i, key)
+        self._edits.insert(i, (start, end, replacement, anchor))
+        return True
+
+    def insert(self, position: int, string: str) -> bool:
+        return self.replace(position, position, string)
+
+    def delete(self, start: int, end: int, anchor="start") -> bool:
+        return self.replace(start, end, "", anchor)
+
+    def apply(self) -> Tuple[str, OffsetMap]:
+        """Apply the edits.
+
+        Returns
+        -------
+        Tuple[str, OffsetMap]
+            The new text and the map from the old positions to the new
+            ones. Entity ends are mapped through the last character of
+            the entity.
+        """
+        text = self.text
+        positions = np.empty(len(text) + 1, dtype=np.int64)
+        pieces = []
+        replaced = []
+        old_pos, new_pos = 0, 0
+        for start, end, replacement, anchor in self._edits:
+            positions[old_pos:start] = np.arange(new_pos, new_pos + start - old_pos)
+            pieces.append(text[old_pos:start])
+            new_pos += start - old_pos
+
+            # Positions inside the span stay inside the replacement, even
+            # if it is shorter than the span
+            new_end = new_pos + len(replacement)
+            if anchor == "end":
+                positions[start:end] = np.maximum(
+                    np.arange(new_end - (end - start), new_end), new_pos
+                )
+            else:
+                positions[start:end] = np.minimum(
+                    np.arange(new_pos, new_pos + end - start), new_end
+                )
+            replaced.append((start, end, new_end))
+            pieces.append(replacement)
+            new_pos = new_end
+            old_pos = end
+        positions[old_pos:] = np.arange(new_pos, new_pos + len(text) + 1 - old_pos)
+        pieces.append(text[old_pos:])
+
+        ends = np.empty_like(positions)
+        ends[0] = positions[0]
+        ends[1:] = positions[:-1] + 1
+        for start, end, new_end in replaced:
+            ends[start + 1 : end + 1] = np.minimum(ends[start + 1 : end + 1], new_end)
+        return "".join(pieces), OffsetMap(positions, ends)
@@ -0,0 +1,152 @@
+import os
+import threading
+from typing import List, Sequence
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import train_test_split
+
+__all__ = ["PrefilterStats", "SentencePrefilter", "get_prefilter_stats"]
+
+
+def _sentence_features(tokens: List[str]) -> List[str]:
+    words = [t.lower() for t in tokens]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class PrefilterStats:
+    def __init__(self, sentences=0, skipped=0):
+        self.sentences = sentences
+        self.skipped = skipped
+
+    def since(self, other: "PrefilterStats") -> "PrefilterStats":
+        return PrefilterStats(
+            self.sentences - other.sentences, self.skipped - other.skipped
+        )
+
+    def __repr__(self):
+        rate = self.skipped / self.sentences if self.sentences > 0 else 0.0
+        return f"skipped {self.skipped}/{self.sentences} sentences ({rate:.1%})"
+
+
+_stats = PrefilterStats()
+_stats_lock = threading.Lock()
+
+
+def get_prefilter_stats() -> PrefilterStats:
+    """Get a copy of the process-wide prefilter stats.
+
+    Use PrefilterStats.since to get the stats of one run.
+
+    Returns
+    -------
+    PrefilterStats
+    """
+    with _stats_lock:
+        return PrefilterStats(_stats.sentences, _stats.skipped)
+
+
+class SentencePrefilter:
+    """Cheap classifier of sentences which might contain entities.
+
+    A linear model over hashed words and word bigrams of a tokenized
+    sentence. Sentences scored below the threshold for the required
+    recall are not worth running the NER model on.
+
+    The probabilities of the sentences held out in fit are kept, so the
+    threshold can be found for any recall without retraining.
+
+    Parameters
+    ----------
+    n_features : int
+        Number of hashed features
+    """
+
+    def __init__(self, n_features=2**20):
+        self.vectorizer = HashingVectorizer(
+            analyzer=_sentence_features, n_features=n_features, alternate_sign=False
+        )
+        self.classifier = SGDClassifier(
+            loss="log_loss", class_weight="balanced", random_state=0
+        )
+        self.positive_scores = np.zeros(0)
+        self.validation_scores = np.zeros(0)
+
+    def fit(
+        self,
+        sentences: List[List[str]],
+        has_entities: Sequence[bool],
+        validation_size=0.2,
+    ) -> "SentencePrefilter":
+        """Train on tokenized sentences.
+
+        Parameters
+        ----------
+        sentences : List[List[str]]
+        has_entities : Sequence[bool]
+            Whether every sentence has an entity
+        validation_size : float
+            Share of sentences held out to find the thresholds
+
+        Raises
+        ------
+        ValueError
+            If there are no sentences with or without entities
+
+        Returns
+        -------
+        SentencePrefilter
+        """
+        y = np.asarray(has_entities, dtype=bool)
+        if y.sum() < 2 or (~y).sum() < 2:
+            raise ValueError("Need sentences both with and without entities")
+        X = self.vectorizer.transform(sentences)
+        X_train, X_val, y_train, y_val = train_test_split(
+            X, y, test_size=validation_size, random_state=0, stratify=y
+        )
+        self.classifier.fit(X_train, y_train)
+        self.validation_scores = self.classifier.predict_proba(X_val)[:, 1]
+        self.positive_scores = np.sort(self.validation_scores[y_val])
+        return self
+
+    def threshold(self, recall: float) -> float:
+        """Get the lowest score to keep the share recall of sentences with entities."""
+        if len(self.positive_scores) == 0 or recall >= 1:
+            return 0.0
+        return float(np.quantile(self.positive_scores, 1 - recall, method="lower"))
+
+    def scores(self, sentences: List[List[str]]) -> np.ndarray:
+        """Get the probability of every sentence to have an entity."""
+        if len(sentences) == 0:
+            return np.zeros(0)
+        return self.classifier.predict_proba(self.vectorizer.transform(sentences))[:, 1]
+
+    def keep_mask(self, sentences: List[List[str]], recall: float) -> np.ndarray:
+        """Get the mask of sentences worth running the NER model on.
+
+        Parameters
+        ----------
+        sentences : List[List[str]]
+        recall : float
+            Required share of the sentences with entities to keep
+
+        Returns
+        -------
+        np.ndarray
+        """
+        keep = self.scores(sentences) >= self.threshold(recall)
+        with _stats_lock:
+            _stats.sentences += len(keep)
+            _stats.skipped += int((~keep).sum())
+        return keep
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        joblib.dump(self, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "SentencePrefilter":
+        return joblib.load(path)
@@ -0,0 +1,133 @@
+import re
+from typing import List, Optional, Tuple
+
+__all__ = ["SentenceSplitter"]
+
+# Sentence boundaries: a dot followed by a space or a newline, three or
+# more newlines in a row, or "!?"
+_BOUNDARY_RE = re.compile("\\.[ \\n]|\\n{3,}|\\!\\?")
+
+# A chunk is a sentence if it has something besides dots and whitespace
+_SENTENCE_CONTENT_RE = re.compile("[^\\s\\.]")
+
+_NON_SPACE_RE = re.compile("\\S")
+
+# "Требования:" and such, which start an enumeration
+_COLON_HEADER_RE = re.compile("[А-Я].*:\\s*$")
+
+
+class SentenceSplitter:
+    """Split a text into sentences and enumeration items.
+
+    The text is first split into chunks by sentence boundaries. Then
+    every chunk is split before lines looking like enumeration headers
+    ("Требования:"), and the resulting pieces are split into separate
+    lines if the lines are long on average.
+
+    Everything is done in one scan over the text with precompiled
+    patterns, no intermediate lists of substrings are built.
+    """
+
+    def __init__(self, line_threshold=55):
+        self.line_threshold = line_threshold
+
+    def _chunks(self, text):
+        chunks = []
+        pos = 0
+        for match in _BOUNDARY_RE.finditer(text):
+            start, end = match.span()
+            if _SENTENCE_CONTENT_RE.search(text, pos, start):
+                chunks.append((pos, start))
+            # "!?" is kept as a sentence of its own
+            if _SENTENCE_CONTENT_RE.search(text, start, end):
+                chunks.append((start, end))
+            pos = end
+        if _SENTENCE_CONTENT_RE.search(text, pos):
+            chunks.append((pos, len(text)))
+        return chunks
+
+    def _lines(self, text, start, end):
+        lines = []
+        line_start = start
+        while True:
+            line_end = text.find("\n", line_start, end)
+            if line_end == -1:
+                lines.append((line_start, end))
+                return lines
+            lines.append((line_start, line_end))
+            line_start = line_end + 1
+
+    def _is_blank(self, text, start, end):
+        return _NON_SPACE_RE.search(text, start, end) is None
+
+    def _split_by_headers(self, text, start, lines, last_entity_start):
+        # Trailing blank lines are dropped together with the newlines
+        while len(lines) > 0 and self._is_blank(text, *lines[-1]):
+            lines.pop()
+
+        # Pieces are (start, end, first line, last line + 1)
+        pieces = []
+        piece_start, piece_line = start, 0
+        for i, (line_start, line_end) in enumerate(lines):
+            is_split = _COLON_HEADER_RE.match(text, line_start, line_end) is not None
+            if not is_split and i == len(lines) - 1 and last_entity_start is not None:
+                # Mind that the entity offset is compared with the offset
+                # relative to the chunk start
+                is_split = last_entity_start > line_start - start
+            if is_split:
+                if not self._is_blank(text, piece_start, line_start):
+                    pieces.append((piece_start, line_start, piece_line, i))
+                piece_start, piece_line = line_start, i
+        if len(lines) > 0 and not self._is_blank(text, piece_start, lines[-1][1]):
+            pieces.append((piece_start, lines[-1][1], piece_line, len(lines)))
+        return pieces
+
+    def _split_by_line_length(self, text, start, end, lines, res):
+        total_length, count = 0, 0
+        for line_start, line_end in lines:
+            if not self._is_blank(text, line_start, line_end):
+                total_length += line_end - line_start
+                count += 1
+        if count > 0 and total_length > self.line_threshold * count:
+            for line_start, line_end in lines:
+                if not self._is_blank(text, line_start, line_end):
+                    res.append((line_start, text[line_start:line_end]))
+        else:
+            res.append((start, text[start:end]))
+
+    def split(self, text: str, entities=None) -> List[Tuple[int, str]]:
+        """Split the text into sentences.
+
+        Parameters
+        ----------
+        text : str
+            Text to split
+        entities : Optional[NEREntities]
+            Entities of the text. If the last entity starts after the
+            last line of the last sentence, that line is split into a
+            separate sentence.
+
+        Returns
+        -------
+        List[Tuple[int, str]]
+            Offsets and texts of the sentences
+        """
+        chunks = self._chunks(text)
+        last_entity_start: Optional[int] = None
+        if entities is not None and len(entities) > 0:
+            last_entity_start = entities[-1][0]
+
+        res = []
+        for i, (start, end) in enumerate(chunks):
+            lines = self._lines(text, start, end)
+            pieces = self._split_by_headers(
+                text,
+                start,
+                lines,
+                last_entity_start if i == len(chunks) - 1 else None,
+            )
+            for piece_start, piece_end, first_line, last_line in pieces:
+                self._split_by_line_length(
+                    text, piece_start, piece_end, lines[first_line:last_line], res
+                )
+        return res
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from dt_nav.utils import NEREntities
+
+__all__ = ["TokenizationStore"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokenized (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    data TEXT NOT NULL,
+    used_at REAL NOT NULL
+)
+"""
+
+_INDEX = "CREATE INDEX IF NOT EXISTS tokenized_used_at ON tokenized (used_at)"
+
+_GET_MANY_CHUNK = 500
+
+
+class TokenizationStore:
+    """SQLite store of tokenized documents.
+
+    Documents are keyed by a hash of the text, the entities and the
+    tokenizer version, so the store is invalidated whenever the splitter
+    or the spaCy model changes.
+
+    Every read or write of a row updates its time of use. prune removes
+    the least recently used rows above max_rows and the rows of other
+    tokenizer versions unused for stale_after seconds. Processes with
+    another tokenizer version may still be running during a deploy, so
+    their rows are not removed right away. put_many prunes after every
+    max_rows // 100 new rows.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database
+    version : str
+        Tokenizer version, see CunningTokenizer.version
+    max_rows : Optional[int]
+        Maximum number of rows to keep, unbounded if None
+    stale_after : float
+        Seconds after which unused rows of other versions are removed
+    """
+
+    def __init__(
+        self,
+        path: str,
+        version: str,
+        max_rows: Optional[int] = None,
+        stale_after=24 * 60 * 60.0,
+    ):
+        self.path = path
+        self.version = version
+        self.max_rows = max_rows
+        self.stale_after = stale_after
+        self._puts_since_prune = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_SCHEMA)
+            self._conn.execute(_INDEX)
+
+    def _key(self, text: str, entities: Optional[NEREntities], with_bio: bool) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.version.encode("utf-8"))
+        h.update(b"\0bio" if with_bio else b"\0")
+        h.update(json.dumps(entities or [], ensure_ascii=False).encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def get_many(
+        self,
+        texts: Sequence[str],
+        entities: Optional[Sequence[NEREntities]] = None,
+        with_bio=False,
+    ) -> List[Optional[list]]:
+        """Get tokenized documents.
+
+        Parameters
+        ----------
+        texts : Sequence[str]
+        entities : Optional[Sequence[NEREntities]]
+            Entities of each text, if tokenized with entities
+        with_bio : bool
+            If the tags are in the BIO notation
+
+        Returns
+        -------
+        List[Optional[list]]
+            Tokenized sentences of each document, None if the document
+            is not in the store
+        """
+        if entities is None:
+            entities = [None] * len(texts)
+        keys = [self._key(t, e, with_bio) for t, e in zip(texts, entities)]
+        found = {}
+        now = time.time()
+        with self._lock, self._conn:
+            for i in range(0, len(keys), _GET_MANY_CHUNK):
+                chunk = keys[i : i + _GET_MANY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, data FROM tokenized WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+                if len(rows) > 0:
+                    self._conn.execute(
+                        "UPDATE tokenized SET used_at = ? "
+                        f"WHERE key IN ({placeholders})",
+                        [now, *chunk],
+                    )
+        return [json.loads(found[k]) if k in found else None for k in keys]
+
+    def put_many(
+        self,
+        texts: Sequence[str],
+        tokenized: Sequence[list],
+        entities: Optional[Sequence[NEREntities]] = None,
+        with_bio=False,
+    ):
+        """Save tokenized documents.
+
+        Parameters
+        ----------
+        texts : Sequence[str]
+        tokenized : Sequence[list]
+            Tokenized sentences of each document
+        entities : Optional[Sequence[NEREntities]]
+            Entities of each text, if tokenized with entities
+        with_bio : bool
+            If the tags are in the BIO notation
+        """
+        if entities is None:
+            entities = [None] * len(texts)
+        now = time.time()
+        rows = [
+            (
+                self._key(t, e, with_bio),
+                self.version,
+                json.dumps(d, ensure_ascii=False),
+                now,
+            )
+            for t, e, d in zip(texts, entities, tokenized)
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tokenized (key, version, data, used_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._puts_since_prune += len(rows)
+            prune = self._puts_since_prune >= max(1, (self.max_rows or 0) // 100)
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Remove stale rows of other versions and rows above max_rows."""
+        with self._lock, self._conn:
+            self._puts_since_prune = 0
+            self._conn.execute(
+                "DELETE FROM tokenized WHERE version != ? AND used_at < ?",
+                (self.version, time.time() - self.stale_after),
+            )
+            if self.max_rows is not None:
+                self._conn.execute(
+                    "DELETE FROM tokenized WHERE key IN (SELECT key FROM tokenized "
+                    "ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
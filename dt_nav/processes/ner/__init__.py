@@ -1,6 +1,14 @@
 from .extract import *
 from .jsonl_common import *
+from .keyword_extract import *
 from .model_common import *
+from .model_registry import *
+from .model_server import *
 from .namespace import *
+from .onnx_export import *
+from .pipeline import *
+from .prefilter import *
 from .process_documents import *
+from .sentence_cache import *
+from .sharded_model import *
 from .train import *
@@ -1,16 +1,278 @@
+import atexit
 import concurrent.futures
-from typing import List
+import logging
+import multiprocessing
+import threading
+from typing import List, Optional, Tuple
 
+import numpy as np
 from dt_nav.api import settings
 from dt_nav.models.document_keyword import DocumentKeywordStatus
-from dt_nav.nlp.preprocess import CunningTokenizer
+from dt_nav.nlp.preprocess import SentenceSplitter, get_cunning_tokenizer
 from dt_nav.processes.ner.jsonl_common import JsonlDatumStatus
-from dt_nav.utils import st_preds_to_jsonl_datum
+from dt_nav.utils import bio_ids_to_entities
 from tqdm import tqdm
 
-from .model_common import get_trained_ner
+from .model_common import (
+    _model_cache_key,
+    get_labels_list,
+    get_tokenization_store,
+    get_trained_ner,
+)
+from .prefilter import get_prefilter
+from .sentence_cache import SentenceCache
+from .sharded_model import ShardedNERModel
 
-__all__ = ["extract_entities", "extract_entities_many"]
+__all__ = [
+    "DocumentsBatch",
+    "extract_entities",
+    "extract_entities_many",
+    "get_sentence_cache",
+    "get_tokenizer_pool",
+    "shutdown_tokenizer_pool",
+]
+
+_splitter = SentenceSplitter()
+
+_sentence_cache = None
+_sentence_cache_lock = threading.Lock()
+
+
+def get_sentence_cache() -> SentenceCache:
+    """Get the process-wide cache of tokenized and predicted sentences.
+
+    The size is set by settings.ner.sentence_cache_size. The cache is
+    cleared when another model version, backend or prefilter setting is
+    in use.
+
+    Returns
+    -------
+    SentenceCache
+    """
+    global _sentence_cache
+    with _sentence_cache_lock:
+        if _sentence_cache is None:
+            _sentence_cache = SentenceCache(
+                getattr(settings.ner, "sentence_cache_size", 100000)
+            )
+    model_key = _model_cache_key()
+    if _sentence_cache.set_model_key(model_key):
+        logging.info(f"Sentence cache is cleared for NER model {model_key}")
+    return _sentence_cache
+
+
+def _tokenize_sentences(sent_data):
+    return get_cunning_tokenizer().tokenize_many(sent_data)
+
+
+def _init_pool():
+    get_cunning_tokenizer()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_tokenizer_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Get the process pool for tokenization, starting it if necessary.
+
+    The pool lives until shutdown_tokenizer_pool, so the workers load
+    spaCy once and not on every call of extract_entities_many. If
+    settings.ner.tokenizer_pool_max_tasks is set, every worker is
+    replaced by a new one after that many tasks to bound memory growth.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_tasks = getattr(settings.ner, "tokenizer_pool_max_tasks", None)
+            kwargs = {}
+            if max_tasks is not None:
+                # Workers can only be replaced in spawned processes
+                kwargs["mp_context"] = multiprocessing.get_context("spawn")
+                kwargs["max_tasks_per_child"] = max_tasks
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                initializer=_init_pool,
+                max_workers=settings.device.max_workers,
+                **kwargs,
+            )
+        return _pool
+
+
+def shutdown_tokenizer_pool():
+    """Stop the workers of the tokenization pool, if it is started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            logging.info("Shutting down the tokenizer pool")
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+atexit.register(shutdown_tokenizer_pool)
+
+
+def _lookup_sentences(sent_data, cache):
+    """Split sentences into cached and missing ones.
+
+    Returns the list of cache entries (None for the missing sentences)
+    and the list of missing sentences.
+    """
+    entries = [cache.get(sentence) for _, sentence in sent_data]
+    missing = [s for s, entry in zip(sent_data, entries) if entry is None]
+    return entries, missing
+
+
+def _outputs_to_label_ids(model_outputs) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Get label ids and their probabilities from NERModel.predict outputs.
+
+    model_outputs has the logits of every subtoken of every word. The
+    label of a word is predicted by its first subtoken, the same way as
+    the labels returned by NERModel.predict.
+
+    Returns
+    -------
+    List[Tuple[np.ndarray, np.ndarray]]
+        Label ids and probabilities of the words of every sentence
+    """
+    lengths = [len(sentence) for sentence in model_outputs]
+    logits = np.array(
+        [
+            next(iter(word.values()))[0]
+            for sentence in model_outputs
+            for word in sentence
+        ],
+        dtype=np.float32,
+    )
+    if len(logits) == 0:
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        return [empty] * len(lengths)
+    label_ids = logits.argmax(axis=1)
+    # Softmax of the largest logit
+    scores = 1 / np.exp(logits - logits.max(axis=1, keepdims=True)).sum(axis=1)
+    split = np.cumsum(lengths)[:-1]
+    return list(zip(np.split(label_ids, split), np.split(scores, split)))
+
+
+def _predict_sentences(model, sentences: List[List[str]]) -> list:
+    """Predict tokenized sentences in batches.
+
+    Identical sentences are predicted once, in batches of
+    settings.ner.predict_batch_size. The model pads every sentence to
+    max_seq_length, so the order of the sentences doesn't matter.
+    If there is a prefilter (see get_prefilter), the sentences it skips
+    get "O" for every token and None instead of the probabilities.
+
+    Returns
+    -------
+    list
+        Label ids and their probabilities (see _outputs_to_label_ids)
+        in the order of sentences
+    """
+    unique_indices, unique_sentences, sentence_indices = {}, [], []
+    for tokens in sentences:
+        key = tuple(tokens)
+        try:
+            sentence_indices.append(unique_indices[key])
+        except KeyError:
+            unique_indices[key] = len(unique_sentences)
+            sentence_indices.append(len(unique_sentences))
+            unique_sentences.append(tokens)
+
+    preds = [None] * len(unique_sentences)
+    to_predict = list(range(len(unique_sentences)))
+    prefilter = get_prefilter()
+    if prefilter is not None:
+        keep = prefilter.keep_mask(
+            unique_sentences, getattr(settings.ner, "prefilter_recall", 0.99)
+        )
+        outside_id = get_labels_list(with_bio=True).index("O")
+        for i in np.flatnonzero(~keep):
+            length = len(unique_sentences[i])
+            preds[i] = (np.full(length, outside_id, dtype=np.int64), None)
+        to_predict = np.flatnonzero(keep).tolist()
+
+    batch_size = getattr(settings.ner, "predict_batch_size", 64)
+    batches = [
+        to_predict[i : i + batch_size] for i in range(0, len(to_predict), batch_size)
+    ]
+    sentence_batches = [[unique_sentences[i] for i in batch] for batch in batches]
+    if isinstance(model, ShardedNERModel):
+        # The batches are predicted by all the processes at once
+        batch_preds = model.predict_label_ids(sentence_batches)
+    else:
+        batch_preds = (
+            _outputs_to_label_ids(model.predict(s, split_on_space=False)[1])
+            for s in sentence_batches
+        )
+    for batch, pred_batch in zip(batches, batch_preds):
+        for i, pred in zip(batch, pred_batch):
+            preds[i] = pred
+    return [preds[i] for i in sentence_indices]
+
+
+def _make_datum(text, sent_data, entries, tokenized_missing, preds_missing, cache):
+    """Make JsonlDatumStatus for a document.
+
+    Sentences found in the cache are reused with shifted offsets,
+    the predicted ones are put into the cache. Labels of all sentences
+    are decoded at once by bio_ids_to_entities, and the datum also gets
+    "confidence" of every entity. Also returns the tokenized sentences
+    of the whole document.
+    """
+    tokenized_sent_data = []
+    label_ids, scores, token_starts, token_ends = [], [], [], []
+    sentence_starts, n_tokens = [], 0
+    missing_i = 0
+    for (offset, sentence), entry in zip(sent_data, entries):
+        if entry is None:
+            tokens, tags, offsets = tokenized_missing[missing_i]
+            sentence_label_ids, sentence_scores = preds_missing[missing_i]
+            missing_i += 1
+            if sentence_scores is None:
+                # Skipped by the prefilter, not predicted by the model
+                sentence_scores = np.ones(len(sentence_label_ids), dtype=np.float32)
+            else:
+                cache.put(
+                    sentence,
+                    tokens,
+                    [o - offset for o in offsets],
+                    sentence_label_ids,
+                    sentence_scores,
+                )
+        else:
+            tokens, tags = entry.tokens, ["O"] * len(entry.tokens)
+            offsets = [offset + o for o in entry.offsets]
+            sentence_label_ids, sentence_scores = entry.label_ids, entry.scores
+        tokenized_sent_data.append((tokens, tags, offsets))
+
+        # The model skips the tokens after its max_seq_length
+        n = min(len(tokens), len(sentence_label_ids))
+        if n == 0:
+            continue
+        sentence_starts.append(n_tokens)
+        n_tokens += n
+        label_ids.append(sentence_label_ids[:n])
+        scores.append(sentence_scores[:n])
+        token_starts.extend(offsets[:n])
+        token_ends.extend([o + len(t) for o, t in zip(offsets[:n], tokens[:n])])
+
+    entities, confidence = bio_ids_to_entities(
+        np.concatenate([np.zeros(0, dtype=np.int64), *label_ids]),
+        np.array(token_starts, dtype=np.int64),
+        np.array(token_ends, dtype=np.int64),
+        np.array(sentence_starts, dtype=np.int64),
+        get_labels_list(with_bio=True),
+        np.concatenate([np.zeros(0, dtype=np.float32), *scores]),
+    )
+    datum = {"text": text, "entities": entities, "confidence": confidence}
+    datum["status"] = {}
+    for e in datum["entities"]:
+        datum["status"][text[e[0] : e[1]]] = DocumentKeywordStatus.EXTRACTED
+    return datum, tokenized_sent_data
 
 
 def extract_entities(text: str) -> JsonlDatumStatus:
@@ -25,64 +287,143 @@ def extract_entities(text: str) -> JsonlDatumStatus:
     -------
     JsonlDatum
     """
-    tokenizer = CunningTokenizer()
-    sent_data = tokenizer.extract_sentences(text)
-    tokenized_sent_data = [tokenizer.tokenize(s) for s in sent_data]
-    tokenized_sentences = [t[0] for t in tokenized_sent_data]
+    cache = get_sentence_cache()
+    sent_data = _splitter.split(text)
+    entries, missing = _lookup_sentences(sent_data, cache)
+    tokenized_missing = _tokenize_sentences(missing)
 
     with get_trained_ner() as model:
-        preds, _ = model.predict(tokenized_sentences, split_on_space=False)
-
-    datum = st_preds_to_jsonl_datum(text, tokenized_sent_data, preds)
-    datum["status"] = {}
-    for e in datum["entities"]:
-        datum["status"][text[e[0] : e[1]]] = DocumentKeywordStatus.EXTRACTED
+        preds_missing = _predict_sentences(model, [t[0] for t in tokenized_missing])
+    datum, _ = _make_datum(
+        text, sent_data, entries, tokenized_missing, preds_missing, cache
+    )
     return datum
 
 
-_tokenizer = None
+class DocumentsBatch:
+    """Documents on their way through extract_entities_many.
 
+    Filled in by _prepare_batch, _predict_batch and _finish_batch one
+    after another.
 
-def _init_pool():
-    global _tokenizer
-    _tokenizer = CunningTokenizer()
+    Parameters
+    ----------
+    texts : List[str]
+    ids : Optional[List[int]]
+        Ids of the documents, if any
+    """
 
+    def __init__(self, texts: List[str], ids: Optional[List[int]] = None):
+        self.texts = texts
+        self.ids = ids
+        self.sent_data = None
+        self.entries = None
+        self.stored = None
+        self.tokenized_missing = None
+        self.preds_missing = None
+        self.datums: Optional[List[JsonlDatumStatus]] = None
 
-def _tokenize_text(text):
-    global _tokenizer
-    sent_data = _tokenizer.extract_sentences(text)
-    tokenized_sent_data = [_tokenizer.tokenize(s) for s in sent_data]
-    return tokenized_sent_data
+    def __len__(self):
+        return len(self.texts)
 
 
-def extract_entities_many(texts: List[str]):
-    tokenized_sentences_all = []
-    with concurrent.futures.ProcessPoolExecutor(
-        initializer=_init_pool, max_workers=settings.device.max_workers
-    ) as executor:
-        with tqdm(total=len(texts), desc="Tokenizing") as bar:
-            tokenized_sentences_all = []
-            for s in executor.map(_tokenize_text, texts):
-                tokenized_sentences_all.append(s)
-                bar.update(1)
+def _prepare_batch(batch: DocumentsBatch):
+    """Split the texts into sentences and tokenize the ones not in the cache."""
+    cache = get_sentence_cache()
+    store = get_tokenization_store()
+    batch.sent_data, batch.entries = [], []
+    missing_all = []
+    for text in batch.texts:
+        sent_data = _splitter.split(text)
+        entries, missing = _lookup_sentences(sent_data, cache)
+        batch.sent_data.append(sent_data)
+        batch.entries.append(entries)
+        missing_all.append(missing)
 
-    res = []
-    with get_trained_ner() as model:
-        for text, tokenized_sent_data in tqdm(
-            zip(texts, tokenized_sentences_all),
-            total=len(texts),
-            desc="Extracting entities",
-           ):
-            if len(tokenized_sent_data) == 0:
-                res.append({"text": text, "entities": [], "status": {}})
-                continue
-            preds, _ = model.predict(
-                [t[0] for t in tokenized_sent_data], split_on_space=False
+    batch.stored = [None] * len(batch)
+    if store is not None:
+        batch.stored = store.get_many(batch.texts)
+    to_tokenize = [
+        i
+        for i, (stored, missing) in enumerate(zip(batch.stored, missing_all))
+        if stored is None and len(missing) > 0
+    ]
+    logging.info(
+        f"Tokenizing {len(to_tokenize)}/{len(batch)} documents "
+        f"({len(batch) - batch.stored.count(None)} in the tokenization store)"
+    )
+
+    batch.tokenized_missing = [[] for _ in batch.texts]
+    for i, stored in enumerate(batch.stored):
+        if stored is not None:
+            batch.tokenized_missing[i] = [
+                tuple(t) for t, entry in zip(stored, batch.entries[i]) if entry is None
+            ]
+    chunksize = getattr(settings.ner, "tokenizer_pool_chunksize", None)
+    if chunksize is None:
+        chunksize = max(1, len(to_tokenize) // (4 * (settings.device.max_workers or 1)))
+    try:
+        with tqdm(total=len(to_tokenize), desc="Tokenizing") as bar:
+            tokenized = get_tokenizer_pool().map(
+                _tokenize_sentences,
+                [missing_all[i] for i in to_tokenize],
+                chunksize=chunksize,
             )
-            datum = st_preds_to_jsonl_datum(text, tokenized_sent_data, preds)
-            datum["status"] = {}
-            for e in datum["entities"]:
-                datum["status"][text[e[0] : e[1]]] = DocumentKeywordStatus.EXTRACTED
+            for i, s in zip(to_tokenize, tokenized):
+                batch.tokenized_missing[i] = s
+                bar.update(1)
+    except concurrent.futures.BrokenExecutor:
+        # The next call starts a new pool
+        shutdown_tokenizer_pool()
+        raise
+
+
+def _predict_batch(batch: DocumentsBatch, model):
+    """Predict the missing sentences of all documents of the batch together."""
+    sentences = [t[0] for tokenized in batch.tokenized_missing for t in tokenized]
+    logging.info(f"Predicting {len(sentences)} sentences")
+    preds = _predict_sentences(model, sentences)
+    batch.preds_missing, pos = [], 0
+    for tokenized_missing in batch.tokenized_missing:
+        batch.preds_missing.append(preds[pos : pos + len(tokenized_missing)])
+        pos += len(tokenized_missing)
+
 
-            res.append(datum)
-    return res
+def _finish_batch(batch: DocumentsBatch):
+    """Make datums of the documents and save new ones to the tokenization store."""
+    cache = get_sentence_cache()
+    store = get_tokenization_store()
+    batch.datums = []
+    new_texts, new_tokenized = [], []
+    for text, sent_data, entries, tokenized_missing, preds_missing, stored in zip(
+        batch.texts,
+        batch.sent_data,
+        batch.entries,
+        batch.tokenized_missing,
+        batch.preds_missing,
+        batch.stored,
+    ):
+        if len(sent_data) == 0:
+            batch.datums.append({"text": text, "entities": [], "status": {}})
+            continue
+        datum, tokenized_sent_data = _make_datum(
+            text, sent_data, entries, tokenized_missing, preds_missing, cache
+        )
+        batch.datums.append(datum)
+        if stored is None:
+            new_texts.append(text)
+            new_tokenized.append(tokenized_sent_data)
+    if store is not None and len(new_texts) > 0:
+        store.put_many(new_texts, new_tokenized)
+
+
+def extract_entities_many(texts: List[str]):
+    batch = DocumentsBatch(texts)
+    _prepare_batch(batch)
+    # Sentences of all documents are predicted together and then
+    # scattered back to the documents
+    with get_trained_ner() as model:
+        _predict_batch(batch, model)
+    _finish_batch(batch)
+    logging.info(f"Sentence cache: {get_sentence_cache().stats()}")
+    return batch.datums
@@ -1,8 +1,11 @@
-import json
-from typing import Dict, TypedDict
+import bisect
+import difflib
+import re
+from typing import Dict, List, NotRequired, Tuple, TypedDict
 
 from dt_nav.models.document_keyword import DocumentKeywordStatus
-from dt_nav.utils import IdentitySet, NEREntities, find_good_substring_indices
+from dt_nav.nlp.preprocess import KeywordAutomaton
+from dt_nav.utils import IdentitySet, NEREntities
 from dt_nav.utils.screw import group_list_by
 
 __all__ = [
@@ -32,6 +35,95 @@ class JsonlDatumStatus(TypedDict):
     text: str
     entities: NEREntities
     status: Dict[str, DocumentKeywordStatus]
+    # Confidence of every entity extracted by the model
+    confidence: NotRequired[List[float]]
+
+
+_DIFF_TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]")
+
+# Lines with their newlines, the last one may have none
+_DIFF_LINE_RE = re.compile(r"[^\n]*\n|[^\n]+")
+
+
+def _diff_tokens(text: str, token_re=_DIFF_TOKEN_RE) -> Tuple[List[str], List[int]]:
+    """Split the text into words, spaces and punctuation marks for the diff.
+
+    Returns the tokens and their offsets, with len(text) at the end.
+    """
+    tokens, offsets = [], []
+    for m in token_re.finditer(text):
+        tokens.append(m.group())
+        offsets.append(m.start())
+    offsets.append(len(text))
+    return tokens, offsets
+
+
+def _equal_token_blocks(
+    source_text: str, target_text: str, source_start: int, target_start: int
+) -> List[Tuple[int, int, int]]:
+    source_tokens, source_offsets = _diff_tokens(source_text)
+    target_tokens, target_offsets = _diff_tokens(target_text)
+    # Whitespace can't start a match, so runs of spaces don't align
+    # unrelated parts of the text
+    matcher = difflib.SequenceMatcher(str.isspace, source_tokens, target_tokens)
+    return [
+        (
+            source_start + source_offsets[i1],
+            source_start + source_offsets[i2],
+            target_start + target_offsets[j1],
+        )
+        for tag, i1, i2, j1, _ in matcher.get_opcodes()
+        if tag == "equal"
+    ]
+
+
+def _equal_blocks(source_text: str, target_text: str) -> List[Tuple[int, int, int]]:
+    """Find the unchanged parts of the text.
+
+    The texts are diffed by lines first, and only the changed lines are
+    diffed by tokens, since a token diff of the whole text is close to
+    quadratic.
+
+    Returns
+    -------
+    List[Tuple[int, int, int]]
+        Start and end in source_text and start in target_text of every
+        unchanged block, ordered by the start
+    """
+    source_lines, source_offsets = _diff_tokens(source_text, _DIFF_LINE_RE)
+    target_lines, target_offsets = _diff_tokens(target_text, _DIFF_LINE_RE)
+    matcher = difflib.SequenceMatcher(
+        str.isspace, source_lines, target_lines, autojunk=False
+    )
+    blocks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        source_start, source_end = source_offsets[i1], source_offsets[i2]
+        target_start, target_end = target_offsets[j1], target_offsets[j2]
+        if tag == "equal":
+            blocks.append((source_start, source_end, target_start))
+        elif tag == "replace":
+            blocks.extend(
+                _equal_token_blocks(
+                    source_text[source_start:source_end],
+                    target_text[target_start:target_end],
+                    source_start,
+                    target_start,
+                )
+            )
+
+    # Blocks of the line and the token diffs may continue each other
+    merged = []
+    for start, end, target_start in blocks:
+        if len(merged) > 0:
+            prev_start, prev_end, prev_target_start = merged[-1]
+            if (
+                prev_end == start
+                and prev_target_start + prev_end - prev_start == target_start
+            ):
+                merged[-1] = (prev_start, end, prev_target_start)
+                continue
+        merged.append((start, end, target_start))
+    return merged
 
 
 def _update_jsonl_by_text(
@@ -43,8 +135,10 @@ def _update_jsonl_by_text(
     the text. As such, if the text is changed, entities have to be
     updated.
 
-    This function does that just by looking for each word in the new
-    text again. So, it is a potentially destructive operation.
+    The old and the new text are aligned with a diff. Entities in the
+    unchanged parts of the text are just shifted. In the changed parts,
+    all keywords of source_datum are looked for again with one pass of
+    KeywordAutomaton, so entities there may be lost or added.
 
     Parameters
     ----------
@@ -59,27 +153,45 @@ def _update_jsonl_by_text(
         Updated datum
 
     """
-    entities_classes_count: Dict[str, Dict[str, int]] = {}
+    source_text = source_datum["text"]
+    entities_classes: Dict[str, str] = {}
     entities_status: Dict[str, DocumentKeywordStatus] = {}
-    entities: NEREntities = []
 
     for start, end, class_ in source_datum["entities"]:
-        value = fix_kw(source_datum["text"][start:end])
-        classes = entities_classes_count.get(value, {})
-        classes[class_] = classes.get(class_, 1)
-        entities_classes_count[value] = classes
-
-    for value, classes in entities_classes_count.items():
-        class_ = max(classes, key=classes.get)
-        starts = find_good_substring_indices(target_text.lower(), value)
-        ends = [s + len(value) for s in starts]
-        entities.extend([(start, end, class_) for start, end in zip(starts, ends)])
-
-        entities_status[value] = source_datum["status"].get(
-            value, DocumentKeywordStatus.EXTRACTED
-        )
-    entities = sorted(entities, key=lambda e: e[0])
-    return {"text": target_text, "entities": entities, "status": entities_status}
+        value = fix_kw(source_text[start:end])
+        if value not in entities_classes:
+            entities_classes[value] = class_
+            entities_status[value] = source_datum["status"].get(
+                value, DocumentKeywordStatus.EXTRACTED
+            )
+
+    blocks = _equal_blocks(source_text, target_text)
+    block_starts = [b[0] for b in blocks]
+    entities = set()
+    for start, end, _ in source_datum["entities"]:
+        i = bisect.bisect_right(block_starts, start) - 1
+        if i < 0:
+            continue
+        block_start, block_end, target_start = blocks[i]
+        if end <= block_end:
+            value = fix_kw(source_text[start:end])
+            shift = target_start - block_start
+            entities.add((start + shift, end + shift, entities_classes[value]))
+
+    target_blocks = [(t, t + end - start) for start, end, t in blocks]
+    target_block_starts = [b[0] for b in target_blocks]
+    automaton = KeywordAutomaton(entities_classes.items())
+    for start, end, class_ in automaton.find_all(target_text):
+        i = bisect.bisect_right(target_block_starts, start) - 1
+        if i >= 0 and end <= target_blocks[i][1]:
+            continue
+        entities.add((start, end, class_))
+
+    return {
+        "text": target_text,
+        "entities": sorted(entities),
+        "status": entities_status,
+    }
 
 
 _STATUS_PRIORITIES = {
@@ -121,17 +233,17 @@ def _merge_jsonl_entities(
         Updated datum
     """
     assert target_datum["text"] == source["text"]
+    text = target_datum["text"]
     entities: NEREntities = [*target_datum["entities"]]
     status = {**target_datum["status"]}
-    target_entities_by_ents = {json.dumps(e): e for e in target_datum["entities"]}
+    target_entities_keys = set([tuple(e) for e in target_datum["entities"]])
 
     for e in source["entities"]:
         value = fix_kw(source["text"][e[0] : e[1]])
         source_status = source["status"].get(value, DocumentKeywordStatus.EXTRACTED)
         if source_status == DocumentKeywordStatus.EXTRACTED:
             continue
-        key = json.dumps(e)
-        if key in target_entities_by_ents:
+        if tuple(e) in target_entities_keys:
             if source_status in (
                 DocumentKeywordStatus.CONFIRMED,
                 DocumentKeywordStatus.ADDED,
@@ -142,34 +254,46 @@ def _merge_jsonl_entities(
             continue
         entities.append(e)
 
-    entities_by_index: Dict[int, NEREntities] = {}
-
-    for e in entities:
-        start, end, _ = e
-        for i in range(start, end):
-            try:
-                entities_by_index[i].append(e)
-            except KeyError:
-                entities_by_index[i] = [e]
-    indices = sorted(list(set([*entities_by_index.keys()])))
-
+    priorities: Dict[int, int] = {}
+
+    def get_priority(i):
+        try:
+            return priorities[i]
+        except KeyError:
+            e = entities[i]
+            priority = _STATUS_PRIORITIES.get(status[fix_kw(text[e[0] : e[1]])], 0)
+            priorities[i] = priority
+            return priority
+
+    # The entity covering a character is only chosen at the start of
+    # some entity: after that, all the others covering it are rejected
+    starts = sorted(
+        [i for i, e in enumerate(entities) if e[0] < e[1]],
+        key=lambda i: entities[i][0],
+    )
     result, rejected = IdentitySet(), IdentitySet()
-    for i in indices:
-        entities_here = entities_by_index[i]
-        entities_here = [e for e in entities_here if e not in rejected]
+    active: Dict[int, int] = {}
+    next_i = 0
+    while next_i < len(starts):
+        start = entities[starts[next_i]][0]
+        while next_i < len(starts) and entities[starts[next_i]][0] == start:
+            active[starts[next_i]] = entities[starts[next_i]][1]
+            next_i += 1
+        active = {
+            i: end
+            for i, end in active.items()
+            if end > start and entities[i] not in rejected
+        }
+        if len(active) == 0:
+            continue
+        entities_here = sorted(active)
         if len(entities_here) > 1:
-            entities_here = sorted(
-                entities_here,
-                key=lambda e: _STATUS_PRIORITIES.get(
-                    status[fix_kw(target_datum["text"][e[0] : e[1]])], 0
-                ),
-                reverse=True,
-            )
-        result.add(entities_here[0])
-        for e in entities_here[1:]:
-            rejected.add(e)
+            entities_here = sorted(entities_here, key=get_priority, reverse=True)
+        result.add(entities[entities_here[0]])
+        for i in entities_here[1:]:
+            rejected.add(entities[i])
     return {
-        "text": target_datum["text"],
+        "text": text,
         "entities": sorted(list(result), key=lambda e: e[0]),
         "status": status,
     }
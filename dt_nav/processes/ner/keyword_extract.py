@@ -0,0 +1,151 @@
+import logging
+import threading
+from typing import List, Optional, Sequence
+
+import sqlalchemy as sa
+from dt_nav.api.db import DBConn
+from dt_nav.models import Keyword
+from dt_nav.models.document_keyword import DocumentKeywordStatus
+from dt_nav.nlp.preprocess import KeywordAutomaton
+from sqlalchemy.orm import Session
+
+from .jsonl_common import JsonlDatumStatus
+
+__all__ = [
+    "get_keyword_automaton",
+    "update_keyword_automaton",
+    "extract_entities_by_keywords",
+    "extract_entities_by_keywords_many",
+]
+
+_automaton: Optional[KeywordAutomaton[str]] = None
+_automaton_values = set()
+_loaded_until = None
+_automaton_lock = threading.Lock()
+
+
+def _publish_automaton(automaton: KeywordAutomaton[str]):
+    # Searches hold a reference to the automaton they started with, so
+    # a published automaton is never changed, only replaced
+    global _automaton
+    automaton.build()
+    _automaton = automaton
+
+
+def get_keyword_automaton(
+    db: Optional[Session] = None, refresh=True
+) -> KeywordAutomaton[str]:
+    """Get the process-wide automaton over the values of Keyword.
+
+    All keywords are loaded on the first call. After that, only the
+    keywords updated since the previous load are added to a copy of
+    the automaton, which then replaces it. If the number of keywords in
+    the database doesn't match the automaton, some were deleted or
+    renamed, and the automaton is rebuilt from scratch.
+
+    The returned automaton is never changed, so it can be searched
+    from several threads.
+
+    Parameters
+    ----------
+    db : Optional[Session]
+
+    refresh : bool
+        If False, don't look for updated keywords if the automaton is
+        already loaded
+
+    Returns
+    -------
+    KeywordAutomaton[str]
+        Automaton with keyword types as values
+    """
+    global _automaton_values, _loaded_until
+    with _automaton_lock:
+        if _automaton is not None and not refresh:
+            return _automaton
+        query = sa.select(Keyword.value, Keyword.type, Keyword.updated_at)
+        with DBConn.ensure_session(db) as db:
+            rebuild = _automaton is None
+            if not rebuild:
+                count = db.scalar(sa.select(sa.func.count()).select_from(Keyword))
+                rebuild = count != len(_automaton_values)
+            if not rebuild and _loaded_until is not None:
+                query = query.where(Keyword.updated_at >= _loaded_until)
+            rows = db.execute(query).all()
+
+        if rebuild:
+            automaton, _automaton_values, _loaded_until = (
+                KeywordAutomaton(),
+                set(),
+                None,
+            )
+        elif len(rows) > 0:
+            automaton = _automaton.copy()
+        else:
+            return _automaton
+        for value, type_, updated_at in rows:
+            automaton.add(value, type_)
+            _automaton_values.add(value)
+            if updated_at is not None and (
+                _loaded_until is None or updated_at > _loaded_until
+            ):
+                _loaded_until = updated_at
+        _publish_automaton(automaton)
+        logging.info(
+            f"Keyword automaton: {len(rows)} keywords "
+            f"{'loaded' if rebuild else 'updated'}"
+        )
+        return _automaton
+
+
+def update_keyword_automaton(keywords: Sequence[Keyword]):
+    """Add upserted keywords to the automaton, if it is loaded.
+
+    Parameters
+    ----------
+    keywords : Sequence[Keyword]
+    """
+    with _automaton_lock:
+        if _automaton is None or len(keywords) == 0:
+            return
+        automaton = _automaton.copy()
+        for keyword in keywords:
+            automaton.add(keyword.value, keyword.type)
+            _automaton_values.add(keyword.value)
+        _publish_automaton(automaton)
+
+
+def extract_entities_by_keywords(
+    text: str, automaton: Optional[KeywordAutomaton[str]] = None
+) -> JsonlDatumStatus:
+    """Extract known keywords from the text.
+
+    A cheap alternative to extract_entities, which only finds keywords
+    already in the database.
+
+    Parameters
+    ----------
+    text : str
+        A text to extract entities from
+    automaton : Optional[KeywordAutomaton[str]]
+        The process-wide automaton by default
+
+    Returns
+    -------
+    JsonlDatumStatus
+    """
+    if automaton is None:
+        automaton = get_keyword_automaton(refresh=False)
+    entities = [[start, end, type_] for start, end, type_ in automaton.find(text)]
+    status = {}
+    for e in entities:
+        status[text[e[0] : e[1]]] = DocumentKeywordStatus.EXTRACTED
+    return {"text": text, "entities": entities, "status": status}
+
+
+def extract_entities_by_keywords_many(
+    texts: Sequence[str], automaton: Optional[KeywordAutomaton[str]] = None
+) -> List[JsonlDatumStatus]:
+    if automaton is None:
+        automaton = get_keyword_automaton(refresh=False)
+    return [extract_entities_by_keywords(text, automaton) for text in texts]
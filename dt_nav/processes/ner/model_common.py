@@ -1,11 +1,30 @@
 import logging
+import os
+import shutil
+import tempfile
+import threading
 from contextlib import contextmanager
-from typing import ContextManager, List
+from typing import ContextManager, List, Optional
 
 from dt_nav.api import settings
+from dt_nav.nlp.preprocess import TokenizationStore, get_cunning_tokenizer
 from simpletransformers.ner import NERArgs, NERModel
 
-__all__ = ["get_labels_list", "get_model_args", "get_trained_ner"]
+from .model_registry import NERModelRegistry
+from .model_server import RemoteNERModel, _get_authkey
+from .sharded_model import ShardedNERModel, _set_torch_threads, get_inference_config
+
+__all__ = [
+    "get_labels_list",
+    "get_model_args",
+    "get_model_registry",
+    "get_onnx_dir",
+    "get_trained_ner",
+    "get_tokenization_store",
+    "is_model_saved",
+    "preload_ner_model",
+    "save_safetensors",
+]
 
 
 def get_labels_list(with_bio=True) -> List[str]:
@@ -39,19 +58,214 @@ def get_model_args():
     args.learning_rate = 1e-5
     args.overwrite_output_dir = True
     args.use_multiprocessing = False
+    # extract_entities_many makes batches of this size itself, so each
+    # of them goes through the model at once
+    args.eval_batch_size = getattr(settings.ner, "predict_batch_size", 64)
     args.silent = True
     return args
 
 
-_model = None
+_CONFIG_FILE = "config.json"
+_ONNX_MODEL_FILE = "onnx_model.onnx"
+_SAFETENSORS_FILE = "model.safetensors"
+_PICKLE_FILE = "pytorch_model.bin"
+
+
+def get_onnx_dir(model_dir: Optional[str] = None) -> str:
+    """Get the directory of the exported ONNX model.
+
+    Every version has its own, onnx in model_dir.
+
+    Parameters
+    ----------
+    model_dir : Optional[str]
+        Directory of the PyTorch model, the active version by default
+
+    Returns
+    -------
+    str
+    """
+    if model_dir is None:
+        model_dir = get_model_registry().active_dir()
+    return os.path.join(model_dir, "onnx")
+
+
+def is_model_saved(model_dir: str) -> bool:
+    """Check if model_dir has a config and weights, without loading them.
+
+    Parameters
+    ----------
+    model_dir : str
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.exists(os.path.join(model_dir, _CONFIG_FILE)):
+        return False
+    return any(
+        os.path.exists(os.path.join(model_dir, name))
+        for name in (_SAFETENSORS_FILE, _PICKLE_FILE)
+    )
+
+
+def _load_ner_model(model_dir: Optional[str] = None) -> NERModel:
+    if model_dir is None:
+        model_dir = get_model_registry().active_dir()
+    backend = getattr(settings.ner, "backend", "torch")
+    args = get_model_args()
+    if backend == "onnx":
+        onnx_dir = get_onnx_dir(model_dir)
+        if os.path.exists(os.path.join(onnx_dir, _ONNX_MODEL_FILE)):
+            args.onnx = True
+            return NERModel("bert", onnx_dir, args=args, use_cuda=False)
+        logging.warning(f"No ONNX model in {onnx_dir}, loading the PyTorch one")
+    elif backend != "torch":
+        raise ValueError(f"Unknown NER backend: {backend}")
+    if os.path.exists(os.path.join(model_dir, _SAFETENSORS_FILE)):
+        # from_pretrained reads these without unpickling
+        logging.info(f"Loading NER model weights from {_SAFETENSORS_FILE}")
+    else:
+        logging.warning(
+            f"No {_SAFETENSORS_FILE} in {model_dir}, loading {_PICKLE_FILE}. "
+            "Retrain the model or run save_safetensors to load it without unpickling"
+        )
+    return NERModel("bert", model_dir, args=args, use_cuda=settings.ner.use_cuda)
+
+
+def save_safetensors(model: NERModel, model_dir: str) -> bool:
+    """Save the weights of the model as safetensors.
+
+    from_pretrained prefers model.safetensors, which is read without
+    unpickling. The weights are still copied into the model, so it
+    takes about as long and as much memory as pytorch_model.bin, see
+    tests/test_model_formats.py.
+
+    The weights are saved to a temporary directory and loaded back
+    from it first. Only if they are the same as those of the model,
+    model.safetensors is moved into model_dir and pytorch_model.bin is
+    removed. Otherwise model_dir is left as it was.
+
+    Parameters
+    ----------
+    model : NERModel
+    model_dir : str
+
+    Returns
+    -------
+    bool
+        True if model.safetensors is saved
+    """
+    import torch
+
+    model_to_save = getattr(model.model, "module", model.model)
+    tmp_dir = tempfile.mkdtemp(prefix=".safetensors-", dir=model_dir)
+    try:
+        model_to_save.save_pretrained(tmp_dir, safe_serialization=True)
+        loaded = type(model_to_save).from_pretrained(tmp_dir)
+        expected = model_to_save.state_dict()
+        actual = loaded.state_dict()
+        if expected.keys() != actual.keys() or not all(
+            torch.equal(expected[k].cpu(), actual[k]) for k in expected
+        ):
+            logging.error(
+                f"Weights loaded from {_SAFETENSORS_FILE} differ from the model, "
+                f"keeping {_PICKLE_FILE} in {model_dir}"
+            )
+            return False
+        os.replace(
+            os.path.join(tmp_dir, _SAFETENSORS_FILE),
+            os.path.join(model_dir, _SAFETENSORS_FILE),
+        )
+        pickle_path = os.path.join(model_dir, _PICKLE_FILE)
+        if os.path.exists(pickle_path):
+            os.remove(pickle_path)
+        return True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_remote_model = None
+_sharded_model = None
+_sharded_model_lock = threading.Lock()
+_torch_threads_set = False
+
+
+def get_model_registry() -> NERModelRegistry:
+    """Get the registry of NER model versions in settings.ner.state_dir.
+
+    Returns
+    -------
+    NERModelRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = NERModelRegistry(
+                settings.ner.state_dir,
+                _load_ner_model,
+                check_interval=getattr(settings.ner, "registry_check_interval", 10.0),
+                keep_versions=getattr(settings.ner, "registry_keep_versions", 2),
+            )
+        return _registry
+
+
+def preload_ner_model():
+    """Start loading the active NER model in the background.
+
+    Call this at the startup of a process which is going to extract
+    entities, so the first request doesn't wait for the model. Does
+    nothing if settings.ner.model_server_address is set.
+    """
+    if getattr(settings.ner, "model_server_address", None) is not None:
+        return
+    processes, threads = get_inference_config()
+    if processes > 1:
+        threading.Thread(
+            target=_get_sharded_model,
+            args=(processes, threads),
+            name="ner-model-preload",
+            daemon=True,
+        ).start()
+    else:
+        get_model_registry().preload()
+
+
+def _get_sharded_model(processes: int, threads: Optional[int]) -> ShardedNERModel:
+    """Get the process-wide ShardedNERModel of the active version.
+
+    When another version gets active, new processes are started for it
+    and the old ones exit after their batches.
+    """
+    global _sharded_model
+    model_dir = get_model_registry().active_dir()
+    with _sharded_model_lock:
+        if _sharded_model is None or _sharded_model.model_dir != model_dir:
+            model = ShardedNERModel(model_dir, processes, threads)
+            if _sharded_model is not None:
+                _sharded_model.shutdown(wait=False)
+            _sharded_model = model
+        return _sharded_model
 
 
 @contextmanager
 def get_trained_ner() -> ContextManager[NERModel]:
-    """Load model into memory.
+    """Get the active NER model.
+
+    The model is loaded once per process by NERModelRegistry. When
+    train_ner activates a new version, it is loaded in the background
+    and replaces the old one without restarting the process.
+
+    settings.ner.backend is either "torch" (default) or "onnx" for the
+    model exported by export_onnx_model.
 
-    I suspect loading NERModel might have some overhead, so this
-    attemtps to load it just once.
+    If get_inference_config gives more than one process, the model is
+    a ShardedNERModel instead.
+
+    If settings.ner.model_server_address is set, the model is not loaded
+    at all. RemoteNERModel sends sentences to the NERModelServer there.
 
     Returns
     -------
@@ -64,16 +278,81 @@ def get_trained_ner() -> ContextManager[NERModel]:
         ner.predict(["Hello world"])
 
     """
-    global _model
-    if _model is None:
-        logging.info("Loading NER model")
-        args = get_model_args()
-        _model = NERModel(
-            "bert", settings.ner.state_dir, args=args, use_cuda=settings.ner.use_cuda
-        )
-        try:
-            yield _model
-        finally:
-            logging.info("Unloading NER model")
+    global _remote_model, _torch_threads_set
+    address = getattr(settings.ner, "model_server_address", None)
+    processes, threads = get_inference_config()
+    if address is not None:
+        if _remote_model is None:
+            _remote_model = RemoteNERModel(address, authkey=_get_authkey())
+        yield _remote_model
+    elif processes > 1:
+        yield _get_sharded_model(processes, threads)
     else:
-        yield _model
+        if not _torch_threads_set:
+            _set_torch_threads(threads)
+            _torch_threads_set = True
+        yield get_model_registry().get_model()
+
+
+# The registry generation and other state the key was computed for,
+# and the key
+_cache_key = (None, None)
+
+
+def _model_cache_key() -> tuple:
+    """Get the key of the model get_trained_ner would give now.
+
+    Predictions cached for one key are not valid for another.
+
+    The key of the local model is only computed again when the
+    registry loads another model, so the ACTIVE file isn't read on
+    every call. With a model server, it is read at most every
+    check_interval of the registry.
+    """
+    global _cache_key
+    backend = getattr(settings.ner, "backend", "torch")
+    prefilter = getattr(settings.ner, "prefilter", False)
+    registry = get_model_registry()
+    if getattr(settings.ner, "model_server_address", None) is not None:
+        return ("remote", prefilter, registry.cached_active_dir())
+    if _sharded_model is not None and get_inference_config()[0] > 1:
+        return (backend, prefilter, _sharded_model.model_dir)
+    state = (backend, prefilter, registry.generation)
+    cached_state, key = _cache_key
+    if state != cached_state:
+        key = (backend, prefilter, registry.loaded_dir())
+        _cache_key = (state, key)
+    return key
+
+
+_tokenization_store = None
+_tokenization_store_lock = threading.Lock()
+
+
+def get_tokenization_store() -> Optional[TokenizationStore]:
+    """Get the on-disk store of tokenized documents.
+
+    The store is kept in settings.ner.tokenization_store_dir and is
+    shared by extraction and training. It keeps at most
+    settings.ner.tokenization_store_max_rows documents.
+
+    Returns
+    -------
+    Optional[TokenizationStore]
+        None if the directory is not set
+    """
+    global _tokenization_store
+    store_dir = getattr(settings.ner, "tokenization_store_dir", None)
+    if store_dir is None:
+        return None
+    with _tokenization_store_lock:
+        if _tokenization_store is None:
+            _tokenization_store = TokenizationStore(
+                os.path.join(store_dir, "tokenized.sqlite3"),
+                get_cunning_tokenizer().version,
+                max_rows=getattr(settings.ner, "tokenization_store_max_rows", 1000000),
+                stale_after=getattr(
+                    settings.ner, "tokenization_store_stale_after", 24 * 60 * 60.0
+                ),
+            )
+        return _tokenization_store
@@ -0,0 +1,285 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+__all__ = ["NERModelRegistry"]
+
+_ACTIVE_FILE = "ACTIVE"
+_LOCK_FILE = "ACTIVE.lock"
+_VERSIONS_DIR = "versions"
+
+
+class NERModelRegistry:
+    """Versioned NER models in one directory.
+
+    Every trained model gets its own directory in root/versions. The
+    ACTIVE file in root holds the name of the active version and of the
+    previous one, and is replaced atomically by activate, so processes
+    reading it never see a half-written pointer.
+
+    If there is no ACTIVE file, the model is expected right in root, as
+    train_ner saved it before the registry.
+
+    get_model is thread-safe. The first call loads the active version,
+    concurrent calls wait for it. After that, the ACTIVE file is checked
+    at most every check_interval seconds. When another version gets
+    active, it is loaded in a background thread while the old model
+    keeps serving, and then swapped in.
+
+    Parameters
+    ----------
+    root : str
+    loader : Callable[[str], object]
+        Loads a model from a version directory
+    check_interval : float
+        Seconds between checks of the ACTIVE file
+    keep_versions : int
+        How many latest versions activate keeps, including the active
+        and the previous one
+    """
+
+    def __init__(
+        self,
+        root: str,
+        loader: Callable[[str], object],
+        check_interval=10.0,
+        keep_versions=2,
+    ):
+        self.root = root
+        self.loader = loader
+        self.check_interval = check_interval
+        self.keep_versions = max(keep_versions, 2)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._model = None
+        self._model_version = None
+        self._checked_at = 0.0
+        self._swapping = False
+        # Incremented whenever another model is loaded, so callers can
+        # tell the model has changed without reading the ACTIVE file
+        self.generation = 0
+        self._active_dir = None
+        self._active_dir_read_at = 0.0
+
+    @property
+    def _active_path(self) -> str:
+        return os.path.join(self.root, _ACTIVE_FILE)
+
+    def _read_active(self) -> dict:
+        try:
+            with open(self._active_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": None, "previous": None}
+
+    def _write_active(self, active: dict):
+        tmp_path = f"{self._active_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(active, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._active_path)
+
+    def version_dir(self, version: Optional[str]) -> str:
+        """Get the directory of the version, root for None."""
+        if version is None:
+            return self.root
+        return os.path.join(self.root, _VERSIONS_DIR, version)
+
+    def versions(self) -> List[str]:
+        """Get all versions, from the oldest to the latest."""
+        try:
+            return sorted(os.listdir(os.path.join(self.root, _VERSIONS_DIR)))
+        except FileNotFoundError:
+            return []
+
+    def active_version(self) -> Optional[str]:
+        return self._read_active()["version"]
+
+    def active_dir(self) -> str:
+        return self.version_dir(self.active_version())
+
+    def cached_active_dir(self) -> str:
+        """Get active_dir, reading the ACTIVE file at most every check_interval."""
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self._active_dir is None
+                or now - self._active_dir_read_at >= self.check_interval
+            ):
+                self._active_dir = self.active_dir()
+                self._active_dir_read_at = now
+            return self._active_dir
+
+    def loaded_dir(self) -> str:
+        """Get the directory of the model get_model returns now.
+
+        This is the active version if the model isn't loaded yet.
+        """
+        with self._lock:
+            if self._model is not None:
+                return self.version_dir(self._model_version)
+        return self.active_dir()
+
+    def new_version(self) -> Tuple[str, str]:
+        """Create a directory for a new version.
+
+        The version is not active until activate is called.
+
+        Returns
+        -------
+        Tuple[str, str]
+            Version name and its directory
+        """
+        # Versions are ordered by name, so a new one has to be the last
+        # even if the latest one was created in the same second or its
+        # name is from the future
+        versions = self.versions()
+        last = versions[-1] if len(versions) > 0 else ""
+        base = max(time.strftime("%Y%m%d-%H%M%S"), last)
+        for i in range(1000):
+            version = base if i == 0 else f"{base}-{i:03d}"
+            if version <= last:
+                continue
+            path = self.version_dir(version)
+            try:
+                os.makedirs(path)
+                return version, path
+            except FileExistsError:
+                continue
+        raise RuntimeError(f"Can't name a new NER model version after {last}")
+
+    @contextmanager
+    def _locked(self):
+        """Lock the ACTIVE file against other processes and threads."""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, _LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def discard(self, version: str):
+        """Remove a version that is not active."""
+        with self._locked():
+            active = self._read_active()
+            if version in (active["version"], active["previous"]):
+                raise ValueError(f"Version {version} is in use")
+            shutil.rmtree(self.version_dir(version), ignore_errors=True)
+
+    def _activate(self, version: Optional[str]):
+        if not os.path.isdir(self.version_dir(version)):
+            raise ValueError(f"No NER model version {version}")
+        active = self._read_active()
+        if active["version"] == version:
+            return
+        self._write_active({"version": version, "previous": active["version"]})
+        logging.info(f"NER model version {version} is active")
+        self._prune(keep={version, active["version"]})
+
+    def activate(self, version: Optional[str]):
+        """Make the version active, keeping the current one for rollback.
+
+        Versions older than the latest keep_versions are removed, except
+        the active and the previous one.
+        """
+        with self._locked():
+            self._activate(version)
+
+    def rollback(self):
+        """Make the previous version active again."""
+        with self._locked():
+            active = self._read_active()
+            if active["previous"] is None:
+                raise ValueError("No previous NER model version")
+            self._activate(active["previous"])
+
+    def _prune(self, keep: set):
+        for version in self.versions()[: -self.keep_versions]:
+            if version not in keep:
+                logging.info(f"Removing NER model version {version}")
+                shutil.rmtree(self.version_dir(version), ignore_errors=True)
+
+    def _load(self, version: Optional[str]):
+        path = self.version_dir(version)
+        logging.info(f"Loading NER model version {version} from {path}")
+        start = time.perf_counter()
+        model = self.loader(path)
+        logging.info(
+            f"Loaded NER model version {version} in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        return model
+
+    def _swap(self, version: Optional[str]):
+        try:
+            with self._load_lock:
+                model = self._load(version)
+            with self._lock:
+                self._model, self._model_version = model, version
+                self.generation += 1
+        except Exception:
+            logging.exception(f"Failed to load NER model version {version}")
+        finally:
+            with self._lock:
+                self._swapping = False
+
+    def _check_active(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._swapping or now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            version = self.active_version()
+            if version == self._model_version:
+                return
+            self._swapping = True
+        threading.Thread(
+            target=self._swap, args=(version,), name="ner-model-swap", daemon=True
+        ).start()
+
+    def get_model(self):
+        """Get the model of the active version, loading it if necessary."""
+        model = self._model
+        if model is not None:
+            self._check_active()
+            return model
+        with self._load_lock:
+            if self._model is None:
+                version = self.active_version()
+                model = self._load(version)
+                with self._lock:
+                    self._model, self._model_version = model, version
+                    self._checked_at = time.monotonic()
+                    self.generation += 1
+        return self._model
+
+    def preload(self, background=True):
+        """Load the active version ahead of the first get_model.
+
+        Parameters
+        ----------
+        background : bool
+            If True, load in a daemon thread and return immediately
+        """
+        if not os.path.isdir(self.active_dir()):
+            logging.warning(f"No NER model in {self.active_dir()} to preload")
+            return
+
+        def load():
+            try:
+                self.get_model()
+            except Exception:
+                logging.exception("Failed to preload NER model")
+
+        if background:
+            threading.Thread(target=load, name="ner-model-preload", daemon=True).start()
+        else:
+            self.get_model()
@@ -0,0 +1,275 @@
+import logging
+import os
+import queue
+import secrets
+import stat
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import List
+
+from dt_nav.api import settings
+
+__all__ = ["NERModelServer", "RemoteNERModel", "serve_ner_model"]
+
+
+def _authkey_path() -> str:
+    return getattr(
+        settings.ner,
+        "model_server_authkey_file",
+        os.path.join(settings.ner.state_dir, "model_server.key"),
+    )
+
+
+def _get_authkey(create=False) -> bytes:
+    """Get the key clients and the server authenticate each other with.
+
+    This is settings.ner.model_server_authkey if set. Otherwise the key
+    is read from settings.ner.model_server_authkey_file, which only the
+    owner can read. With create=True, the file is created with a random
+    key if there is none.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no key and create is False
+    """
+    authkey = getattr(settings.ner, "model_server_authkey", None)
+    if authkey is not None:
+        return authkey.encode("utf-8")
+    path = _authkey_path()
+    if create and not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        # Another server might have created it meanwhile, keep that one
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, "r") as f:
+        return f.read().strip().encode("utf-8")
+
+
+class _Request:
+    def __init__(self, sentences: List[List[str]]):
+        self.sentences = sentences
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class NERModelServer:
+    """Serve one NER model to many processes over a Unix socket.
+
+    Requests from all connections are coalesced into micro-batches.
+    A batch stops taking requests when it has max_batch_size sentences
+    or max_wait seconds after the first request.
+
+    Connections exchange pickles, so only the owner may use the socket
+    and every client has to know authkey.
+
+    Parameters
+    ----------
+    model
+        Anything with NERModel.predict
+    address : str
+        Path to the Unix socket
+    authkey : bytes
+    max_batch_size : int
+    max_wait : float
+
+    Raises
+    ------
+    ValueError
+        If authkey is empty
+    """
+
+    def __init__(
+        self,
+        model,
+        address: str,
+        authkey: bytes,
+        max_batch_size=64,
+        max_wait=0.01,
+    ):
+        if not authkey:
+            raise ValueError("NER model server needs an authkey")
+        self.model = model
+        self.address = address
+        self.authkey = authkey
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                request = _Request(conn.recv())
+                self._requests.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    conn.send(("error", repr(request.error)))
+                else:
+                    conn.send(("ok", request.result))
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def _collect_batch(self) -> List[_Request]:
+        batch = [self._requests.get()]
+        size = len(batch[0].sentences)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.sentences)
+        return batch
+
+    def _run_batch(self, batch: List[_Request]):
+        sentences = [s for request in batch for s in request.sentences]
+        try:
+            preds, raw_outputs = [], []
+            if len(sentences) > 0:
+                preds, raw_outputs = self.model.predict(sentences, split_on_space=False)
+            pos = 0
+            for request in batch:
+                end = pos + len(request.sentences)
+                request.result = (preds[pos:end], raw_outputs[pos:end])
+                pos = end
+        except Exception as e:
+            logging.exception("Failed to predict a batch")
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def _batch_loop(self):
+        while True:
+            batch = self._collect_batch()
+            self._run_batch(batch)
+
+    def _remove_stale_socket(self):
+        try:
+            mode = os.lstat(self.address).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"{self.address} exists and is not a socket")
+        os.remove(self.address)
+
+    def serve_forever(self):
+        self._remove_stale_socket()
+        threading.Thread(
+            target=self._batch_loop, name="ner-server-batches", daemon=True
+        ).start()
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            os.chmod(self.address, 0o600)
+            logging.info(f"Serving NER model on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    logging.exception("Failed to accept a connection")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class RemoteNERModel:
+    """Client of NERModelServer with the predict method of NERModel.
+
+    Every thread has its own connection to the server.
+
+    Parameters
+    ----------
+    address : str
+        Path to the Unix socket
+    authkey : bytes
+
+    Raises
+    ------
+    ValueError
+        If authkey is empty
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        if not authkey:
+            raise ValueError("NER model server needs an authkey")
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def predict(self, to_predict: List[List[str]], split_on_space=False):
+        if split_on_space:
+            raise ValueError("RemoteNERModel only predicts tokenized sentences")
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.send(list(to_predict))
+                status, res = conn.recv()
+                break
+            except (EOFError, OSError):
+                # The server might have been restarted
+                self._local.conn = None
+                conn.close()
+                if attempt > 0:
+                    raise
+        if status == "error":
+            raise RuntimeError(f"NER model server failed: {res}")
+        return res
+
+
+class _ActiveNERModel:
+    """Predict with the active model of NERModelRegistry."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def predict(self, to_predict, split_on_space=False):
+        return self.registry.get_model().predict(
+            to_predict, split_on_space=split_on_space
+        )
+
+
+def serve_ner_model():
+    """Load the model and serve it on settings.ner.model_server_address.
+
+    The server follows the active version of the model registry. If
+    settings.ner.model_server_authkey isn't set, a random key is shared
+    with the clients in a file, see _get_authkey.
+    """
+    from .model_common import get_model_registry
+
+    registry = get_model_registry()
+    registry.preload(background=False)
+    server = NERModelServer(
+        _ActiveNERModel(registry),
+        settings.ner.model_server_address,
+        authkey=_get_authkey(create=True),
+        max_batch_size=getattr(settings.ner, "model_server_batch_size", 64),
+        max_wait=getattr(settings.ner, "model_server_max_wait", 0.01),
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve_ner_model()
@@ -0,0 +1,121 @@
+import logging
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+from dt_nav.api import settings
+from simpletransformers.ner import NERModel
+
+from .model_common import _ONNX_MODEL_FILE, get_model_args, get_onnx_dir
+
+__all__ = ["check_onnx_parity", "export_onnx_model"]
+
+
+def check_onnx_parity(
+    model: NERModel, onnx_model: NERModel, sentences: List[List[str]]
+) -> float:
+    """Compare predictions of the PyTorch and the ONNX model.
+
+    Parameters
+    ----------
+    model : NERModel
+        PyTorch model
+    onnx_model : NERModel
+        The same model exported to ONNX
+    sentences : List[List[str]]
+        Tokenized sentences
+
+    Returns
+    -------
+    float
+        Share of tokens with the same predicted label
+    """
+    preds, _ = model.predict(sentences, split_on_space=False)
+    onnx_preds, _ = onnx_model.predict(sentences, split_on_space=False)
+    total, same = 0, 0
+    for pred, onnx_pred in zip(preds, onnx_preds):
+        total += max(len(pred), len(onnx_pred))
+        same += sum(
+            [
+                list(p.values())[0] == list(o.values())[0]
+                for p, o in zip(pred, onnx_pred)
+            ]
+        )
+    return same / total if total > 0 else 1.0
+
+
+def _quantize(model_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = f"{model_path}.quantized"
+    quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    os.replace(quantized_path, model_path)
+
+
+def export_onnx_model(
+    model: NERModel,
+    sentences: Optional[List[List[str]]] = None,
+    model_dir: Optional[str] = None,
+) -> bool:
+    """Export the model to ONNX for settings.ner.backend = "onnx".
+
+    The weights are quantized to int8 unless settings.ner.onnx_quantize
+    is False. If sentences are passed, the exported model is kept only
+    if it predicts at least settings.ner.onnx_min_parity (0.99 by
+    default) of their tokens the same as the PyTorch model.
+
+    Export into a version before it is activated. An existing export is
+    never replaced, since workers might be loading it.
+
+    Parameters
+    ----------
+    model : NERModel
+        Trained PyTorch model
+    sentences : Optional[List[List[str]]]
+        Tokenized sentences for the parity check
+    model_dir : Optional[str]
+        Version directory of the model, the active version by default
+
+    Returns
+    -------
+    bool
+        True if the model was exported
+
+    Raises
+    ------
+    FileExistsError
+        If the version already has an ONNX model
+    """
+    onnx_dir = get_onnx_dir(model_dir)
+    if os.path.exists(onnx_dir):
+        raise FileExistsError(f"ONNX model is already exported to {onnx_dir}")
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".onnx-", dir=os.path.dirname(os.path.abspath(onnx_dir))
+    )
+
+    try:
+        logging.info(f"Exporting NER model to {onnx_dir}")
+        model.convert_to_onnx(tmp_dir, set_onnx_arg=False)
+        if getattr(settings.ner, "onnx_quantize", True):
+            _quantize(os.path.join(tmp_dir, _ONNX_MODEL_FILE))
+
+        if sentences is not None and len(sentences) > 0:
+            args = get_model_args()
+            args.onnx = True
+            onnx_model = NERModel("bert", tmp_dir, args=args, use_cuda=False)
+            parity = check_onnx_parity(model, onnx_model, sentences)
+            min_parity = getattr(settings.ner, "onnx_min_parity", 0.99)
+            logging.info(f"ONNX model parity on {len(sentences)} sentences: {parity}")
+            if parity < min_parity:
+                logging.error(
+                    f"ONNX model parity {parity} is below {min_parity}, "
+                    "not exporting"
+                )
+                return False
+
+        # Fails if another export got there first
+        os.rename(tmp_dir, onnx_dir)
+        return True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
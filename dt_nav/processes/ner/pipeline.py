@@ -0,0 +1,183 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple
+
+from dt_nav.api.db import DBConn
+
+__all__ = ["PipelineStage", "StageStats", "run_pipeline"]
+
+_DONE = object()
+
+
+class PipelineStage(NamedTuple):
+    """A stage of run_pipeline.
+
+    func is called with every item and returns the item for the next
+    stage. If with_session is True, the stage gets its own database
+    session as the second argument, which is committed after every
+    item.
+    """
+
+    name: str
+    func: Callable
+    with_session: bool = False
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.documents = 0
+        self.busy = 0.0
+
+    def add(self, documents: int, busy: float):
+        self.items += 1
+        self.documents += documents
+        self.busy += busy
+
+    def __repr__(self):
+        rate = self.documents / self.busy if self.busy > 0 else 0.0
+        return (
+            f"{self.name}: {self.items} items, {self.documents} documents, "
+            f"{self.busy:.1f}s busy, {rate:.1f} documents/s"
+        )
+
+
+def _put(q: queue.Queue, item, failed: threading.Event):
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _run_source(source, out_q, stats, failed, errors):
+    try:
+        it = iter(source)
+        while not failed.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            stats.add(len(item), time.perf_counter() - start)
+            _put(out_q, item, failed)
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        out_q.put(_DONE)
+
+
+def _run_stage(stage, in_q, out_q, stats, failed, errors):
+    done = False
+
+    def process(db=None):
+        nonlocal done
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                done = True
+                break
+            if failed.is_set():
+                continue
+            start = time.perf_counter()
+            try:
+                if db is None:
+                    res = stage.func(item)
+                else:
+                    res = stage.func(item, db)
+                    db.commit()
+            except BaseException as e:
+                errors.append(e)
+                failed.set()
+                if db is not None:
+                    db.rollback()
+                continue
+            stats.add(len(item), time.perf_counter() - start)
+            if out_q is not None:
+                _put(out_q, res, failed)
+
+    try:
+        if stage.with_session:
+            with DBConn.ensure_session(commit_if_created=True) as db:
+                process(db)
+        else:
+            process()
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+        # Let the upstream stages finish
+        while not done and in_q.get() is not _DONE:
+            pass
+    finally:
+        if out_q is not None:
+            out_q.put(_DONE)
+
+
+def run_pipeline(
+    source: Iterable, stages: List[PipelineStage], max_queue_size=2
+) -> Dict[str, StageStats]:
+    """Run stages over items from source, each stage in its own thread.
+
+    The stages are connected by queues of at most max_queue_size items,
+    so a slow stage makes the previous ones wait instead of piling up
+    items in memory. Items have to support len(), which is used as the
+    number of documents in the stats.
+
+    If a stage fails, the others stop and the first exception is raised.
+
+    Parameters
+    ----------
+    source : Iterable
+        Items for the first stage, iterated in its own thread
+    stages : List[PipelineStage]
+    max_queue_size : int
+
+    Returns
+    -------
+    Dict[str, StageStats]
+        Stats of the source ("fetch") and the stages
+    """
+    failed = threading.Event()
+    errors = []
+    stats = {"fetch": StageStats("fetch")}
+    queues = [queue.Queue(max_queue_size) for _ in stages]
+    threads = [
+        threading.Thread(
+            target=_run_source,
+            args=(source, queues[0], stats["fetch"], failed, errors),
+            name="pipeline-fetch",
+        )
+    ]
+    for i, stage in enumerate(stages):
+        stats[stage.name] = StageStats(stage.name)
+        out_q = queues[i + 1] if i + 1 < len(stages) else None
+        threads.append(
+            threading.Thread(
+                target=_run_stage,
+                args=(stage, queues[i], out_q, stats[stage.name], failed, errors),
+                name=f"pipeline-{stage.name}",
+            )
+        )
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for stage_stats in stats.values():
+        logging.info(f"Pipeline stage {stage_stats}")
+    documents = stats[stages[-1].name].documents
+    logging.info(
+        f"Pipeline: {documents} documents in {elapsed:.1f}s "
+        f"({documents / elapsed if elapsed > 0 else 0.0:.1f} documents/s)"
+    )
+    if len(errors) > 0:
+        raise errors[0]
+    return stats
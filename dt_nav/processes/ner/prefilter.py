@@ -0,0 +1,81 @@
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from dt_nav.api import settings
+from dt_nav.nlp.preprocess import SentencePrefilter
+
+# Prefilters saved before SentencePrefilter moved refer to its analyzer here
+from dt_nav.nlp.preprocess.sentence_prefilter import _sentence_features  # noqa: F401
+
+from .model_common import get_model_registry
+
+__all__ = ["get_prefilter", "train_prefilter"]
+
+_PREFILTER_FILE = "prefilter.joblib"
+
+
+def train_prefilter(
+    sentences: List[List[str]], tags: List[List[str]], model_dir: str
+) -> SentencePrefilter:
+    """Train SentencePrefilter on the NER training data and save it.
+
+    Parameters
+    ----------
+    sentences : List[List[str]]
+        Tokenized sentences, both with and without entities
+    tags : List[List[str]]
+        BIO tags of the tokens
+    model_dir : str
+        Version directory of the NER model
+
+    Returns
+    -------
+    SentencePrefilter
+    """
+    has_entities = [any(t != "O" for t in sentence_tags) for sentence_tags in tags]
+    prefilter = SentencePrefilter().fit(sentences, has_entities)
+    recall = getattr(settings.ner, "prefilter_recall", 0.99)
+    skipped = prefilter.validation_scores < prefilter.threshold(recall)
+    logging.info(
+        f"Prefilter with recall {recall} skips {skipped.mean():.1%} "
+        "of the held-out sentences"
+    )
+    prefilter.save(os.path.join(model_dir, _PREFILTER_FILE))
+    return prefilter
+
+
+_prefilter = None
+_prefilter_path = None
+_prefilter_lock = threading.Lock()
+
+
+def get_prefilter() -> Optional[SentencePrefilter]:
+    """Get the prefilter of the active NER model version.
+
+    None unless settings.ner.prefilter is True and train_ner has saved
+    a prefilter for the version.
+
+    Returns
+    -------
+    Optional[SentencePrefilter]
+    """
+    global _prefilter, _prefilter_path
+    if not getattr(settings.ner, "prefilter", False):
+        return None
+    path = os.path.join(get_model_registry().active_dir(), _PREFILTER_FILE)
+    with _prefilter_lock:
+        if path != _prefilter_path:
+            _prefilter_path = path
+            # The prefilter of the previous version must not stay
+            _prefilter = None
+            try:
+                _prefilter = SentencePrefilter.load(path)
+            except FileNotFoundError:
+                logging.warning(f"No prefilter in {path}, predicting all sentences")
+            except Exception:
+                logging.exception(
+                    f"Failed to load prefilter from {path}, predicting all sentences"
+                )
+        return _prefilter
@@ -1,18 +1,30 @@
+import enum
 import logging
-from typing import Optional, Sequence
+from typing import Iterator, List, Optional, Sequence
 
 import dramatiq
 import sqlalchemy as sa
+from dt_nav.api import settings
 from dt_nav.api.db import DBConn
 from dt_nav.models import Document, DocumentKeyword, DocumentKeywordStatus, Keyword
+from dt_nav.nlp.preprocess import KeywordAutomaton, get_prefilter_stats
 from dt_nav.processes.documents.common import DocumentNeedle, get_document_by_needle
 from dt_nav.tasks import broker
 from dt_nav.utils import JsonlDatum, unique_values
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
-from tqdm import tqdm
 
-from .extract import extract_entities, extract_entities_many
+from .extract import (
+    DocumentsBatch,
+    _finish_batch,
+    _predict_batch,
+    _prepare_batch,
+    _splitter,
+    _tokenize_sentences,
+    extract_entities,
+    get_sentence_cache,
+    shutdown_tokenizer_pool,
+)
 from .jsonl_common import (
     JsonlDatumStatus,
     add_rejected_entities_from_source,
@@ -20,14 +32,68 @@ from .jsonl_common import (
     fix_kw,
     merge_jsonl_with_status,
 )
+from .keyword_extract import (
+    extract_entities_by_keywords_many,
+    get_keyword_automaton,
+    update_keyword_automaton,
+)
+from .model_common import (
+    get_model_registry,
+    get_trained_ner,
+    is_model_saved,
+    preload_ner_model,
+)
+from .pipeline import PipelineStage, run_pipeline
+from .sharded_model import autotune_inference
 
 __all__ = [
+    "ExtractionMode",
+    "NERModelPreloadMiddleware",
+    "TokenizerPoolMiddleware",
+    "autotune_ner_inference",
     "get_saved_jsonl",
     "extract_entities_for_document",
     "extract_entities_for_document_type",
 ]
 
 
+class TokenizerPoolMiddleware(dramatiq.Middleware):
+    """Stop the tokenizer pool together with the dramatiq worker."""
+
+    def before_worker_shutdown(self, broker, worker):
+        shutdown_tokenizer_pool()
+
+
+broker.add_middleware(TokenizerPoolMiddleware())
+
+
+class NERModelPreloadMiddleware(dramatiq.Middleware):
+    """Load the NER model when the dramatiq worker boots.
+
+    Disabled by settings.ner.preload_model = False.
+    """
+
+    def after_worker_boot(self, broker, worker):
+        if getattr(settings.ner, "preload_model", True):
+            preload_ner_model()
+
+
+broker.add_middleware(NERModelPreloadMiddleware())
+
+
+class ExtractionMode(str, enum.Enum):
+    """How to extract entities for many documents.
+
+    MODEL runs the NER model. KEYWORDS only looks for the keywords
+    already in the database. KEYWORDS_FIRST saves the keywords found in
+    every batch first and then runs the model on it.
+    """
+
+    MODEL = "model"
+    KEYWORDS = "keywords"
+    KEYWORDS_FIRST = "keywords_first"
+
+
 def get_saved_jsonl(
     needle: DocumentNeedle, db: Optional[Session] = None, filter_rejected=False
 ) -> JsonlDatumStatus:
@@ -122,6 +188,7 @@ def _update_keywords(
         )
     ).returning(Keyword)
     res = db.execute(upsert_stmt).scalars().all()
+    update_keyword_automaton(res)
     return res
 
 
@@ -269,30 +336,10 @@ def extract_entities_for_document(
         save_jsonl_for_document(document, datum, is_user=False, db=db)
 
 
-def _extract_entities_batch(documents: Document, db: Session):
-    target_datums = extract_entities_many([d.text for d in documents])
-    for document, target_datum in tqdm(
-        zip(documents, target_datums), total=len(documents), desc="Saving"
-    ):
-        source_datum = get_saved_jsonl(document, db)
-
-        datum = merge_jsonl_with_status(target_datum, source_datum)
-        save_jsonl_for_document(document, datum, is_user=False, db=db)
-
-
-@dramatiq.actor(max_retries=0, broker=broker, time_limit=3600000)
-def extract_entities_for_document_type(type_: str, update=1):
-    """Extract or update entities for all documents of a given type
-
-    Parameters
-    ----------
-    type_ : str
-        Document type
-    update : int
-        If 0, extract only for the first time. If 1, also extract if
-        the document has been updated. If 2, extract unconditionally
-    """
-    with DBConn.ensure_session(commit_if_created=True) as db:
+def _iter_documents_to_update(
+    type_: str, update: int, chunk_size: int
+) -> Iterator[DocumentsBatch]:
+    with DBConn.ensure_session() as db:
         document_ids = (
             db.execute(
                 sa.select(Document.id).where(
@@ -307,31 +354,147 @@ def extract_entities_for_document_type(type_: str, update=1):
             .scalars()
             .all()
         )
-        documents = db.execute(sa.select(Document).where(Document.id.in_(document_ids)))
+        documents = db.execute(
+            sa.select(Document)
+            .where(Document.id.in_(document_ids))
+            .execution_options(yield_per=chunk_size)
+        ).scalars()
 
-        batch = []
-        batch_i, i = 0, 0
         total = len(document_ids)
-        while True:
-            i += 1
-
-            document = None
-            result = documents.fetchone()
-            if result is not None:
-                document = result[0]
-
-            if document is not None:
-                if not _check_document_update(document, update, verbose=False):
-                    continue
-                batch.append(document)
-
-            if len(batch) > 1000 or document is None:
-                logging.info(
-                    f"Starting batch {batch_i} (size={len(batch)}, i={i}, total={total})"
-                )
-                _extract_entities_batch(batch, db)
-                batch = []
-                db.commit()
+        ids, texts = [], []
+        for i, document in enumerate(documents):
+            if _check_document_update(document, update, verbose=False):
+                ids.append(document.id)
+                texts.append(document.text)
+            db.expunge(document)
+            if len(ids) >= chunk_size:
+                logging.info(f"Fetched {i + 1}/{total} documents")
+                yield DocumentsBatch(texts, ids)
+                ids, texts = [], []
+        if len(ids) > 0:
+            yield DocumentsBatch(texts, ids)
+
+
+def _extraction_stages(
+    mode: ExtractionMode, automaton: Optional[KeywordAutomaton[str]] = None
+) -> List[PipelineStage]:
+    def keywords(batch: DocumentsBatch):
+        batch.datums = extract_entities_by_keywords_many(batch.texts, automaton)
+        return batch
+
+    def save_keywords(batch: DocumentsBatch, db: Session):
+        save(merge(keywords(batch), db), db)
+        batch.datums = None
+        return batch
+
+    def tokenize(batch: DocumentsBatch):
+        _prepare_batch(batch)
+        return batch
+
+    def infer(batch: DocumentsBatch):
+        with get_trained_ner() as model:
+            _predict_batch(batch, model)
+        return batch
+
+    def merge(batch: DocumentsBatch, db: Session):
+        if batch.datums is None:
+            _finish_batch(batch)
+        batch.datums = [
+            merge_jsonl_with_status(datum, get_saved_jsonl(id_, db))
+            for id_, datum in zip(batch.ids, batch.datums)
+        ]
+        return batch
+
+    def save(batch: DocumentsBatch, db: Session):
+        for id_, datum in zip(batch.ids, batch.datums):
+            save_jsonl_for_document(id_, datum, is_user=False, db=db)
+        return batch
+
+    if mode == ExtractionMode.KEYWORDS:
+        stages = [PipelineStage("keywords", keywords)]
+    else:
+        stages = [
+            PipelineStage("tokenize", tokenize),
+            PipelineStage("infer", infer),
+        ]
+        if mode == ExtractionMode.KEYWORDS_FIRST:
+            stages.insert(0, PipelineStage("keywords", save_keywords, True))
+    stages.append(PipelineStage("merge", merge, with_session=True))
+    stages.append(PipelineStage("save", save, with_session=True))
+    return stages
+
+
+def _is_model_available() -> bool:
+    """Check for a saved model without loading it."""
+    if getattr(settings.ner, "model_server_address", None) is not None:
+        return True
+    model_dir = get_model_registry().active_dir()
+    if not is_model_saved(model_dir):
+        logging.warning(f"NER model is not available in {model_dir}")
+        return False
+    return True
+
 
-            if document is None:
-                break
+@dramatiq.actor(max_retries=0, broker=broker, time_limit=3600000)
+def extract_entities_for_document_type(
+    type_: str, update=1, mode=ExtractionMode.MODEL, fallback=True
+):
+    """Extract or update entities for all documents of a given type
+
+    Parameters
+    ----------
+    type_ : str
+        Document type
+    update : int
+        If 0, extract only for the first time. If 1, also extract if
+        the document has been updated. If 2, extract unconditionally
+    mode : ExtractionMode
+        See ExtractionMode
+    fallback : bool
+        If True, extract only keywords if the NER model can't be loaded
+
+    Documents go through a pipeline of fetching, tokenization,
+    inference, merging with the saved entities and saving in chunks
+    of settings.ner.pipeline_chunk_size, see run_pipeline.
+    """
+    mode = ExtractionMode(mode)
+    if mode != ExtractionMode.KEYWORDS and fallback and not _is_model_available():
+        logging.warning("Falling back to keyword extraction")
+        mode = ExtractionMode.KEYWORDS
+    # The automaton is refreshed once per run, not for every batch
+    automaton = None
+    if mode != ExtractionMode.MODEL:
+        automaton = get_keyword_automaton()
+    chunk_size = getattr(settings.ner, "pipeline_chunk_size", 100)
+    prefilter_stats = get_prefilter_stats()
+    run_pipeline(
+        _iter_documents_to_update(type_, update, chunk_size),
+        _extraction_stages(mode, automaton),
+        max_queue_size=getattr(settings.ner, "pipeline_queue_size", 2),
+    )
+    logging.info(f"Sentence cache: {get_sentence_cache().stats()}")
+    logging.info(f"Prefilter: {get_prefilter_stats().since(prefilter_stats)}")
+
+
+@dramatiq.actor(max_retries=0, broker=broker, time_limit=60 * 60 * 1000)
+def autotune_ner_inference(n_documents=100):
+    """Run autotune_inference on sentences of random documents.
+
+    Parameters
+    ----------
+    n_documents : int
+    """
+    with DBConn.ensure_session() as db:
+        texts = db.scalars(
+            sa.select(Document.text)
+            .where(Document.text.is_not(None))
+            .order_by(sa.func.random())
+            .limit(n_documents)
+        ).all()
+    sentences = [
+        tokens
+        for text in texts
+        for tokens, _, _ in _tokenize_sentences(_splitter.split(text))
+    ]
+    logging.info(f"Autotuning NER inference on {len(sentences)} sentences")
+    autotune_inference(sentences)
@@ -0,0 +1,124 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+__all__ = ["SentenceCacheEntry", "SentenceCache"]
+
+
+class SentenceCacheEntry(NamedTuple):
+    """Tokenized sentence with predictions.
+
+    Offsets are relative to the start of the sentence, so the entry can
+    be reused for the same sentence anywhere in any document.
+    """
+
+    tokens: List[str]
+    offsets: List[int]
+    label_ids: np.ndarray
+    scores: np.ndarray
+
+
+class SentenceCache:
+    """LRU cache of tokenized and predicted sentences.
+
+    Sentences are keyed by a hash of their text. Vacancy texts repeat
+    a lot of boilerplate sentences, so a lot of work is saved this way.
+
+    Predictions are only valid for the model which made them, so the
+    cache is cleared when set_model_key gets another key.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of sentences to keep
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.model_key = None
+        self._entries: "OrderedDict[bytes, SentenceCacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(sentence: str) -> bytes:
+        return hashlib.blake2b(sentence.encode("utf-8"), digest_size=16).digest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sentence: str) -> Optional[SentenceCacheEntry]:
+        key = self._key(sentence)
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self,
+        sentence: str,
+        tokens: List[str],
+        offsets: List[int],
+        label_ids: np.ndarray,
+        scores: np.ndarray,
+    ):
+        """Put a tokenized sentence into the cache.
+
+        Parameters
+        ----------
+        sentence : str
+            Text of the sentence
+        tokens : List[str]
+        offsets : List[int]
+            Token offsets relative to the start of the sentence
+        label_ids : np.ndarray
+            Labels predicted by the model for the tokens
+        scores : np.ndarray
+            Probabilities of the predicted labels
+        """
+        key = self._key(sentence)
+        with self._lock:
+            self._entries[key] = SentenceCacheEntry(tokens, offsets, label_ids, scores)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_model_key(self, model_key) -> bool:
+        """Set the key of the model the predictions come from.
+
+        Returns
+        -------
+        bool
+            True if the key has changed and the cache was cleared
+        """
+        with self._lock:
+            if model_key == self.model_key:
+                return False
+            self.model_key = model_key
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
@@ -0,0 +1,275 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from dt_nav.api import settings
+
+__all__ = [
+    "ShardedNERModel",
+    "autotune_inference",
+    "get_inference_config",
+]
+
+_worker_model = None
+_worker_error = None
+
+
+def _set_torch_threads(threads: Optional[int]):
+    if threads is not None:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+def _init_worker(model_dir: str, threads: Optional[int], ready):
+    global _worker_model, _worker_error
+    from .model_common import _load_ner_model
+
+    try:
+        _set_torch_threads(threads)
+        _worker_model = _load_ner_model(model_dir)
+        ready.put(None)
+    except Exception as e:
+        # Raising here would break the whole pool without telling why
+        _worker_error = e
+        ready.put(repr(e))
+
+
+def _ping():
+    pass
+
+
+def _worker():
+    if _worker_error is not None:
+        raise _worker_error
+    return _worker_model
+
+
+def _predict(sentences: List[List[str]]):
+    return _worker().predict(sentences, split_on_space=False)
+
+
+def _predict_label_ids(sentences: List[List[str]]):
+    from .extract import _outputs_to_label_ids
+
+    _, outputs = _worker().predict(sentences, split_on_space=False)
+    return _outputs_to_label_ids(outputs)
+
+
+class ShardedNERModel:
+    """NERModel.predict spread over several processes.
+
+    Every process loads its own copy of the model and runs torch with
+    the given number of threads, so processes * threads should not
+    exceed the number of cores. The constructor waits until all the
+    processes have loaded the model.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory of the model, see NERModelRegistry
+    processes : int
+    threads : Optional[int]
+        torch threads per process, the torch default if None
+
+    Raises
+    ------
+    OSError
+        If the model can't be loaded
+    """
+
+    def __init__(self, model_dir: str, processes: int, threads: Optional[int] = None):
+        self.model_dir = model_dir
+        self.processes = processes
+        self.threads = threads
+        # torch doesn't like to be forked
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_dir, threads, ready),
+        )
+        logging.info(
+            f"Starting {processes} NER model processes with {threads} threads each"
+        )
+        # Every submit starts a new process until there are enough
+        pings = [self._pool.submit(_ping) for _ in range(processes)]
+        errors, loaded = [], 0
+        while loaded < processes:
+            try:
+                error = ready.get(timeout=1)
+            except queue.Empty:
+                # A process died before it could tell anything
+                broken = [p for p in pings if p.done() and p.exception() is not None]
+                if len(broken) > 0:
+                    errors.append(repr(broken[0].exception()))
+                    break
+                continue
+            loaded += 1
+            if error is not None:
+                errors.append(error)
+        if len(errors) > 0:
+            self.shutdown()
+            raise OSError(f"Can't load NER model in {model_dir}: {errors[0]}")
+
+    def _shards(self, sentences: List[List[str]]) -> List[List[List[str]]]:
+        size = -(-len(sentences) // self.processes)
+        return [sentences[i : i + size] for i in range(0, len(sentences), size)]
+
+    def predict(self, to_predict: List[List[str]], split_on_space=False):
+        """Predict like NERModel.predict, splitting sentences between processes."""
+        if split_on_space:
+            raise ValueError("ShardedNERModel only predicts tokenized sentences")
+        preds, outputs = [], []
+        if len(to_predict) == 0:
+            return preds, outputs
+        for shard_preds, shard_outputs in self._pool.map(
+            _predict, self._shards(list(to_predict))
+        ):
+            preds.extend(shard_preds)
+            outputs.extend(shard_outputs)
+        return preds, outputs
+
+    def predict_label_ids(
+        self, batches: List[List[List[str]]]
+    ) -> Iterator[List[Tuple[np.ndarray, np.ndarray]]]:
+        """Predict batches of sentences, each batch in one of the processes.
+
+        The results are yielded in the order of batches.
+
+        Returns
+        -------
+        Iterator[List[Tuple[np.ndarray, np.ndarray]]]
+            Label ids and probabilities for every batch, see
+            _outputs_to_label_ids
+        """
+        return self._pool.map(_predict_label_ids, batches)
+
+    def shutdown(self, wait=True):
+        """Stop the processes.
+
+        With wait=False, the batches already submitted are still
+        predicted.
+        """
+        self._pool.shutdown(wait=wait)
+
+
+def _autotune_path() -> str:
+    # Every host has its own best split
+    return os.path.join(
+        settings.ner.state_dir, f"inference_autotune.{socket.gethostname()}.json"
+    )
+
+
+_inference_config = None
+
+
+def get_inference_config() -> Tuple[int, Optional[int]]:
+    """Get the number of model processes and torch threads per process.
+
+    These are settings.ner.inference_processes and
+    settings.ner.inference_threads. If the former isn't set, the best
+    split found by autotune_inference on this host is used, and one
+    process with the default threads if there is none.
+
+    Returns
+    -------
+    Tuple[int, Optional[int]]
+    """
+    global _inference_config
+    processes = getattr(settings.ner, "inference_processes", None)
+    threads = getattr(settings.ner, "inference_threads", None)
+    if processes is not None:
+        return processes, threads
+    if _inference_config is None:
+        try:
+            with open(_autotune_path(), "r") as f:
+                tuned = json.load(f)
+            _inference_config = (tuned["processes"], tuned["threads"])
+        except FileNotFoundError:
+            _inference_config = (1, None)
+    processes, tuned_threads = _inference_config
+    return processes, threads if threads is not None else tuned_threads
+
+
+def autotune_inference(
+    sentences: List[List[str]],
+    configs: Optional[List[Tuple[int, int]]] = None,
+    save=True,
+) -> Tuple[int, int]:
+    """Find the split into processes and threads with the most sentences/s.
+
+    Every config is timed on the same sentences with the active model,
+    after all of its processes have loaded it.
+
+    Parameters
+    ----------
+    sentences : List[List[str]]
+        Tokenized sentences
+    configs : Optional[List[Tuple[int, int]]]
+        Pairs of processes and threads per process. By default, powers
+        of two of processes with all cores split between them
+    save : bool
+        If True, save the best config for get_inference_config
+
+    Returns
+    -------
+    Tuple[int, int]
+        The best processes and threads
+    """
+    global _inference_config
+    from .model_common import get_model_registry
+
+    if configs is None:
+        cpus = os.cpu_count() or 1
+        configs, processes = [], 1
+        while processes <= cpus:
+            configs.append((processes, cpus // processes))
+            processes *= 2
+
+    model_dir = get_model_registry().active_dir()
+    batch_size = getattr(settings.ner, "predict_batch_size", 64)
+    batches = [
+        sentences[i : i + batch_size] for i in range(0, len(sentences), batch_size)
+    ]
+
+    results = []
+    for processes, threads in configs:
+        model = ShardedNERModel(model_dir, processes, threads)
+        try:
+            start = time.perf_counter()
+            for _ in model.predict_label_ids(batches):
+                pass
+            elapsed = time.perf_counter() - start
+        finally:
+            model.shutdown()
+        rate = len(sentences) / elapsed if elapsed > 0 else 0.0
+        logging.info(
+            f"NER inference with {processes} processes x {threads} threads: "
+            f"{rate:.1f} sentences/s"
+        )
+        results.append((rate, processes, threads))
+
+    _, processes, threads = max(results)
+    logging.info(f"Best NER inference split: {processes} x {threads}")
+    if save:
+        with open(_autotune_path(), "w") as f:
+            json.dump(
+                {
+                    "processes": processes,
+                    "threads": threads,
+                    "sentences_per_second": max(results)[0],
+                },
+                f,
+            )
+        _inference_config = (processes, threads)
+    return processes, threads
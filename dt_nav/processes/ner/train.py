@@ -1,15 +1,23 @@
 import logging
+import shutil
 
 import dramatiq
 import pandas as pd
 from dt_nav.api import settings
-from dt_nav.nlp.preprocess import CunningTokenizer
+from dt_nav.nlp.preprocess import get_cunning_tokenizer
 from dt_nav.tasks import broker
 from dt_nav.utils import read_jsonl
 from simpletransformers.ner import NERModel
 from tqdm import tqdm
 
-from .model_common import get_model_args
+from .model_common import (
+    get_model_args,
+    get_model_registry,
+    get_tokenization_store,
+    save_safetensors,
+)
+from .onnx_export import export_onnx_model
+from .prefilter import train_prefilter
 
 __all__ = ["train_ner"]
 
@@ -45,23 +53,75 @@ def _collect_jsonls_for_training():
 
 
 def _jsonl_to_sentences_df(data):
-    tokenizer = CunningTokenizer()
-    res = []
+    tokenizer = get_cunning_tokenizer()
+    store = get_tokenization_store()
+    texts = [datum["text"] for datum in data]
+    entities = [datum["entities"] for datum in data]
+    stored_all = [None] * len(data)
+    if store is not None:
+        stored_all = store.get_many(texts, entities, with_bio=True)
+        logging.info(
+            f"{len(data) - stored_all.count(None)}/{len(data)} documents "
+            "are in the tokenization store"
+        )
 
-    for datum in tqdm(data):
+    res, new_indices, new_tokenized = [], [], []
+    for i, (datum, stored) in enumerate(tqdm(zip(data, stored_all), total=len(data))):
         doc_meta = {"id": datum["id"], "kind": datum["kind"]}
 
-        sentences = tokenizer.extract_sentences(datum["text"], datum["entities"])
-        sentences_with_entities = tokenizer.add_entities_to_sentences(
-            sentences, datum["entities"]
-        )
-        for s in sentences_with_entities:
-            tokens, tags, _ = tokenizer.tokenize(s, with_bio=True)
+        tokenized_sentences = stored
+        if tokenized_sentences is None:
+            sentences = tokenizer.extract_sentences(datum["text"], datum["entities"])
+            sentences_with_entities = tokenizer.add_entities_to_sentences(
+                sentences, datum["entities"]
+            )
+            tokenized_sentences = tokenizer.tokenize_many(
+                sentences_with_entities, with_bio=True
+            )
+            new_indices.append(i)
+            new_tokenized.append(tokenized_sentences)
+        for tokens, tags, _ in tokenized_sentences:
             res.append({**doc_meta, "tokens": tokens, "tags": tags})
+
+    if store is not None and len(new_indices) > 0:
+        store.put_many(
+            [texts[i] for i in new_indices],
+            new_tokenized,
+            [entities[i] for i in new_indices],
+            with_bio=True,
+        )
     df = pd.DataFrame(res)
     return df
 
 
+def _jsonl_to_prefilter_sentences(data, df_sent):
+    """Get sentences with and without entities to train the prefilter.
+
+    df_sent only has sentences with entities, so the sentences without
+    them are tokenized here.
+
+    Returns
+    -------
+    Tuple[List[List[str]], List[List[str]]]
+        Tokens and BIO tags of the sentences
+    """
+    tokenizer = get_cunning_tokenizer()
+    empty_sentences = []
+    for datum in data:
+        sentences = tokenizer.extract_sentences(datum["text"], datum["entities"])
+        empty_sentences.extend(
+            s
+            for s in tokenizer.add_entities_to_sentences(
+                sentences, datum["entities"], add_empty=True
+            )
+            if len(s[2]) == 0
+        )
+    tokenized = tokenizer.tokenize_many(empty_sentences, with_bio=True)
+    sentences = df_sent.tokens.tolist() + [tokens for tokens, _, _ in tokenized]
+    tags = df_sent.tags.tolist() + [tags for _, tags, _ in tokenized]
+    return sentences, tags
+
+
 def _sentences_df_to_tokens_df(df_sent):
     res = []
     for i, td in enumerate(df_sent.itertuples()):
@@ -85,16 +145,58 @@ def train_ner():
 
     train_df = _sentences_df_to_tokens_df(df_sent)
 
-    args = get_model_args()
-    args.output_dir = settings.ner.state_dir
-
-    model = NERModel(
-        "bert",
-        "DeepPavlov/rubert-base-cased",
-        args=args,
-        use_cuda=settings.ner.use_cuda,
-    )
-    logging.info(f"Starting training NER model")
-    model.train_model(train_df)
-
-    _eval_ner(model, train_df)
+    registry = get_model_registry()
+    version, model_dir = registry.new_version()
+    try:
+        args = get_model_args()
+        args.output_dir = model_dir
+        args.best_model_dir = f"{model_dir}/best_model"
+
+        model = NERModel(
+            "bert",
+            "DeepPavlov/rubert-base-cased",
+            args=args,
+            use_cuda=settings.ner.use_cuda,
+        )
+        logging.info(f"Starting training NER model version {version}")
+        model.train_model(train_df)
+    except BaseException:
+        shutil.rmtree(model_dir, ignore_errors=True)
+        raise
+
+    # The model is saved by now, so the optional steps below must not
+    # lose it. They write into the version directory before it is
+    # active, so nothing is replaced under the workers.
+    try:
+        save_safetensors(model, model_dir)
+    except Exception:
+        logging.exception(f"Failed to save NER model version {version} as safetensors")
+
+    try:
+        _eval_ner(model, train_df)
+    except Exception:
+        logging.exception(f"Failed to evaluate NER model version {version}")
+
+    try:
+        parity_sentences = df_sent.sample(
+            n=min(len(df_sent), getattr(settings.ner, "onnx_parity_sentences", 500)),
+            random_state=0,
+        ).tokens.tolist()
+        export_onnx_model(model, parity_sentences, model_dir=model_dir)
+    except ImportError as e:
+        logging.warning(f"Can't export NER model to ONNX: {e}")
+    except Exception:
+        logging.exception(f"Failed to export NER model version {version} to ONNX")
+
+    try:
+        train_prefilter(
+            *_jsonl_to_prefilter_sentences(data, df_sent), model_dir=model_dir
+        )
+    except ValueError as e:
+        logging.warning(f"Can't train the sentence prefilter: {e}")
+    except Exception:
+        logging.exception(f"Failed to train the sentence prefilter for {version}")
+
+    # Workers load the new version in the background on their next
+    # prediction, the previous one stays for registry.rollback()
+    registry.activate(version)
@@ -15,6 +15,7 @@ from dt_nav.processes.integration.vacancies import (
     parse_rvr,
 )
 from dt_nav.processes.ner.process_documents import (
+    ExtractionMode,
     extract_entities_for_document,
     extract_entities_for_document_type,
 )
@@ -47,7 +48,15 @@ with ner_tab:
             index=1,
             key=next(BUTTON_KEY),
         )
+        mode = st.selectbox(
+            "Mode",
+            options=[m.value for m in ExtractionMode],
+            index=0,
+            key=next(BUTTON_KEY),
+        )
         if st.button("Send", key=next(BUTTON_KEY)):
-            extract_entities_for_document_type.send(type_=object_type, update=update)
+            extract_entities_for_document_type.send(
+                type_=object_type, update=update, mode=mode
+            )
 
 #...
\ No newline at end of file
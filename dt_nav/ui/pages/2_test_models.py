@@ -3,7 +3,7 @@ from gensim.models import Word2Vec
 import streamlit as st
 from annotated_text import annotated_text
 from dt_nav.api import settings
-from dt_nav.nlp.preprocess import CunningTokenizer
+from dt_nav.nlp.preprocess import get_cunning_tokenizer
 from dt_nav.nlp.w2v import embed_keyword
 from dt_nav.processes.ner import extract_entities
 from dt_nav.utils import jsonl_datum_to_annotated_text
@@ -14,7 +14,7 @@ with tab_ner:
     text = st.text_area("Enter text")
 
     if st.button("Extract"):
-        tokenizer = CunningTokenizer()
+        tokenizer = get_cunning_tokenizer()
 
         fixed_text = text
         # fixed_text = tokenizer.fix_punctuation(text)
@@ -1,5 +1,7 @@
 import json
-from typing import List, Tuple, TypedDict
+from typing import List, Optional, Sequence, Tuple, TypedDict
+
+import numpy as np
 
 __all__ = [
     "JsonlDatum",
@@ -7,6 +9,7 @@ __all__ = [
     "read_jsonl",
     "write_jsonl",
     "st_preds_to_jsonl_datum",
+    "bio_ids_to_entities",
     "jsonl_datum_to_annotated_text",
 ]
 
@@ -80,6 +83,98 @@ def st_preds_to_jsonl_datum(
     return {"text": text, "entities": entities}
 
 
+def _bio_label_table(labels_list: Sequence[str]):
+    """Get entity classes, the class id and whether it is B- for every label.
+
+    The class id of "O" is -1. Labels without a B-/I- prefix start a
+    new entity on every token.
+    """
+    classes, class_ids = [], {}
+    label_classes = np.full(len(labels_list), -1, dtype=np.int64)
+    label_begins = np.zeros(len(labels_list), dtype=bool)
+    for i, label in enumerate(labels_list):
+        if label == "O":
+            continue
+        pos, _, class_ = label.partition("-")
+        if pos not in ("B", "I") or class_ == "":
+            pos, class_ = "B", label
+        if class_ not in class_ids:
+            class_ids[class_] = len(classes)
+            classes.append(class_)
+        label_classes[i] = class_ids[class_]
+        label_begins[i] = pos == "B"
+    return classes, label_classes, label_begins
+
+
+def bio_ids_to_entities(
+    label_ids: np.ndarray,
+    token_starts: np.ndarray,
+    token_ends: np.ndarray,
+    sentence_starts: np.ndarray,
+    labels_list: Sequence[str],
+    scores: Optional[np.ndarray] = None,
+) -> Tuple[NEREntities, Optional[List[float]]]:
+    """Decode BIO labels of all tokens of a text into entities at once.
+
+    Gives the same entities as st_preds_to_jsonl_datum. An entity starts
+    at a B- token, or at an I- token not continuing an entity of the
+    same class in the same sentence, and ends before the first token
+    not continuing it.
+
+    Parameters
+    ----------
+    label_ids : np.ndarray
+        Indices in labels_list for the tokens of all sentences
+    token_starts : np.ndarray
+        Start offset of every token
+    token_ends : np.ndarray
+        End offset of every token
+    sentence_starts : np.ndarray
+        Indices of the first tokens of the sentences
+    labels_list : Sequence[str]
+        Labels of the model, e.g. get_labels_list()
+    scores : Optional[np.ndarray]
+        Probability of the predicted label of every token
+
+    Returns
+    -------
+    Tuple[NEREntities, Optional[List[float]]]
+        Entities and, if scores are passed, the confidence of every
+        entity: the lowest score among its tokens
+    """
+    classes, label_classes, label_begins = _bio_label_table(labels_list)
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    token_classes = label_classes[label_ids]
+    inside = token_classes >= 0
+
+    prev_classes = np.empty_like(token_classes)
+    prev_classes[:1] = -1
+    prev_classes[1:] = token_classes[:-1]
+    prev_classes[np.asarray(sentence_starts, dtype=np.int64)] = -1
+    continues = inside & ~label_begins[label_ids] & (prev_classes == token_classes)
+    begins = inside & ~continues
+    ends = inside.copy()
+    ends[:-1] &= ~continues[1:]
+
+    begin_indices = np.flatnonzero(begins)
+    entities = [
+        [start, end, classes[class_]]
+        for start, end, class_ in zip(
+            np.asarray(token_starts)[begin_indices].tolist(),
+            np.asarray(token_ends)[ends].tolist(),
+            token_classes[begin_indices].tolist(),
+        )
+    ]
+
+    confidence = None
+    if scores is not None:
+        entity_ids = np.cumsum(begins) - 1
+        entity_scores = np.ones(len(entities), dtype=np.float64)
+        np.minimum.at(entity_scores, entity_ids[inside], np.asarray(scores)[inside])
+        confidence = entity_scores.tolist()
+    return entities, confidence
+
+
 def jsonl_datum_to_annotated_text(datum: JsonlDatum):
     text = datum["text"]
 
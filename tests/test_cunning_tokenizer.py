@@ -0,0 +1,170 @@
+import random
+
+import pytest
+
+from dt_nav.nlp.preprocess import get_cunning_tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return get_cunning_tokenizer()
+
+
+def _previous_punctuation_mapping(words):
+    """The per-character dict preprocess_punctuation used to build."""
+    mapping = {}
+    old_pos, new_pos = 0, 0
+    for word, is_added in words:
+        for _ in range(len(word)):
+            if not is_added:
+                mapping[old_pos] = new_pos
+            new_pos += 1
+            if not is_added:
+                old_pos += 1
+    return mapping
+
+
+# Text, entities, and the text and entities after fixing punctuation as
+# the per-character mapping gave them. An end next to an added space
+# goes after it, as it did.
+PUNCTUATION_CASES = [
+    (
+        "Знание Python,Java,C++ и SQL;опыт работы\nDocker/Kubernetes!",
+        [(7, 13, "S"), (14, 18, "S"), (19, 22, "S"), (25, 28, "S"), (41, 47, "S")],
+        "Знание Python, Java, C++ и SQL; опыт работы\nDocker / Kubernetes!",
+        [(7, 13, "S"), (15, 19, "S"), (21, 24, "S"), (27, 30, "S"), (44, 51, "S")],
+    ),
+    (
+        "Требования: Go/Rust, Linux;Git",
+        [(12, 14, "S"), (15, 19, "S"), (21, 26, "S")],
+        "Требования: Go / Rust, Linux; Git",
+        [(12, 15, "S"), (17, 21, "S"), (23, 28, "S")],
+    ),
+    ("", [], "", []),
+]
+
+
+@pytest.mark.parametrize(
+    "text, entities, expected_text, expected_entities", PUNCTUATION_CASES
+)
+def test_fix_punctuation_matches_golden_output(
+    tokenizer, text, entities, expected_text, expected_entities
+):
+    new_text, offset_map = tokenizer.fix_punctuation_with_offsets(text)
+    assert new_text == expected_text
+    assert offset_map.remap_spans(entities) == expected_entities
+
+
+def test_entity_at_end_of_text_is_mapped(tokenizer):
+    # The per-character mapping had no entry for the end and raised KeyError
+    text = "Требования: Go/Rust, Linux;Git"
+    new_text, offset_map = tokenizer.fix_punctuation_with_offsets(text)
+    assert offset_map.remap_spans([(27, 30, "S")]) == [(30, 33, "S")]
+    assert new_text[30:33] == "Git"
+
+
+def test_offset_map_matches_previous_mapping(tokenizer):
+    rng = random.Random(0)
+    pieces = ["python", "C++", "Java", "знание", " ", ",", ", ", "/", ";", "\n"]
+    for _ in range(500):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 20)))
+        words = tokenizer.fix_punctuation_with_data(text)
+        mapping = _previous_punctuation_mapping(words)
+        new_text, offset_map = tokenizer.fix_punctuation_with_offsets(text)
+
+        assert new_text == "".join(word for word, _ in words)
+        assert [offset_map[i] for i in range(len(text))] == [
+            mapping[i] for i in range(len(text))
+        ]
+        assert offset_map[len(text)] == len(new_text)
+
+
+def _previous_add_entities_to_sentences(sentences, entities, add_empty=False):
+    """The walk over sorted entities add_entities_to_sentences used to do."""
+    if len(sentences) == 0 or len(entities) == 0:
+        return [(o, s, []) for o, s in sentences] if add_empty else []
+    res, current_entities = [], []
+    sent_i = -1
+    current_sent, current_offset = None, None
+    current_sent_end = -1
+    for start, end, class_ in entities:
+        while start >= current_sent_end:
+            if len(current_entities) > 0 or add_empty and current_sent is not None:
+                res.append((current_offset, current_sent, current_entities))
+                current_entities = []
+            sent_i += 1
+            current_offset, current_sent = sentences[sent_i]
+            current_sent_end = current_offset + len(current_sent)
+        current_entities.append((start, end, class_))
+    while len(current_entities) > 0 or add_empty and sent_i <= len(sentences):
+        res.append((current_offset, current_sent, current_entities))
+        current_entities = []
+        sent_i += 1
+        if sent_i < len(sentences):
+            current_offset, current_sent = sentences[sent_i]
+        else:
+            break
+    return res
+
+
+SENTENCES = [(0, "Ищем аналитика"), (16, "Знание SQL и Excel"), (36, "ДМС.")]
+
+
+@pytest.mark.parametrize(
+    "entities, add_empty, expected",
+    [
+        (
+            [(23, 26, "S"), (29, 34, "S")],
+            False,
+            [(16, "Знание SQL и Excel", [(23, 26, "S"), (29, 34, "S")])],
+        ),
+        (
+            [(5, 14, "P"), (23, 26, "S")],
+            True,
+            [
+                (0, "Ищем аналитика", [(5, 14, "P")]),
+                (16, "Знание SQL и Excel", [(23, 26, "S")]),
+                (36, "ДМС.", []),
+            ],
+        ),
+        # Between sentences, goes to the next one
+        ([(14, 15, "P")], False, [(16, "Знание SQL и Excel", [(14, 15, "P")])]),
+        ([], True, [(o, s, []) for o, s in SENTENCES]),
+    ],
+)
+def test_add_entities_to_sentences_matches_golden_output(
+    tokenizer, entities, add_empty, expected
+):
+    result = tokenizer.add_entities_to_sentences(SENTENCES, entities, add_empty)
+    assert result == expected
+    assert result == _previous_add_entities_to_sentences(SENTENCES, entities, add_empty)
+
+
+@pytest.mark.parametrize("add_empty", [False, True])
+def test_entities_after_last_sentence_are_dropped(tokenizer, add_empty):
+    entities = [(23, 26, "S"), (40, 43, "S")]
+    with pytest.raises(IndexError):
+        _previous_add_entities_to_sentences(SENTENCES, entities, add_empty)
+    result = tokenizer.add_entities_to_sentences(SENTENCES, entities, add_empty)
+    assert [e for _, _, sent_entities in result for e in sent_entities] == [
+        (23, 26, "S")
+    ]
+    assert len(result) == (3 if add_empty else 1)
+
+
+def test_add_entities_to_sentences_matches_previous_walk(tokenizer):
+    rng = random.Random(0)
+    for _ in range(1000):
+        sentences, offset = [], 0
+        for _ in range(rng.randint(0, 5)):
+            offset += rng.randint(0, 3)
+            sentence = "x" * rng.randint(1, 10)
+            sentences.append((offset, sentence))
+            offset += len(sentence)
+        starts = sorted(rng.randint(0, max(offset - 1, 0)) for _ in range(4))
+        entities = [(s, s + rng.randint(0, 3), "S") for s in starts]
+        entities = entities[: rng.randint(0, len(entities))]
+        for add_empty in (False, True):
+            assert tokenizer.add_entities_to_sentences(
+                sentences, entities, add_empty
+            ) == _previous_add_entities_to_sentences(sentences, entities, add_empty)
@@ -0,0 +1,53 @@
+import os
+import threading
+
+from dt_nav.nlp.preprocess.gazetteer import DEFAULT_GAZETTEERS, Gazetteer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_default_gazetteers_do_not_depend_on_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for path in DEFAULT_GAZETTEERS.values():
+        assert os.path.isabs(path)
+        assert os.path.dirname(path) == os.path.join(REPO_DIR, "data")
+
+
+def test_reload_closes_replaced_entries(tmp_path):
+    source = tmp_path / "names.txt"
+    source.write_text("Python\nGo\n", encoding="utf-8")
+    gazetteer = Gazetteer(source, compiled_path=tmp_path / "names.gaz")
+    assert "Python" in gazetteer and "Rust" not in gazetteer
+    old_entries = gazetteer._entries
+
+    source.write_text("Python\nRust\n", encoding="utf-8")
+    os.utime(source, (0, os.stat(source).st_mtime + 10))
+    gazetteer.reload()
+    assert old_entries._mm.closed
+    assert "Rust" in gazetteer and "Go" not in gazetteer
+    assert len(gazetteer) == 2
+
+
+def test_lookups_during_reloads(tmp_path):
+    source = tmp_path / "names.txt"
+    source.write_text("Python\n", encoding="utf-8")
+    gazetteer = Gazetteer(source, compiled_path=tmp_path / "names.gaz")
+    errors = []
+    done = threading.Event()
+
+    def lookup():
+        try:
+            while not done.is_set():
+                assert "Python" in gazetteer
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(50):
+        gazetteer.reload(force=True)
+    done.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,96 @@
+import random
+
+import numpy as np
+import pytest
+
+from dt_nav.utils.jsonl import bio_ids_to_entities, st_preds_to_jsonl_datum
+
+LABELS = ["O", "B-PL", "I-PL", "B-Tool", "I-Tool"]
+
+
+def _decode(sentences, label_ids, scores=None):
+    """bio_ids_to_entities over sentences of (tokens, tags, offsets)."""
+    token_starts, token_ends, sentence_starts = [], [], []
+    for (tokens, _, offsets), sentence_ids in zip(sentences, label_ids):
+        sentence_starts.append(len(token_starts))
+        for token, offset, _ in zip(tokens, offsets, sentence_ids):
+            token_starts.append(offset)
+            token_ends.append(offset + len(token))
+    return bio_ids_to_entities(
+        np.concatenate([np.asarray(ids, dtype=np.int64) for ids in label_ids]),
+        np.asarray(token_starts, dtype=np.int64),
+        np.asarray(token_ends, dtype=np.int64),
+        np.asarray(sentence_starts, dtype=np.int64),
+        LABELS,
+        scores,
+    )
+
+
+def _previous_entities(text, sentences, label_ids):
+    preds = [
+        [{token: LABELS[i]} for token, i in zip(tokens, sentence_ids)]
+        for (tokens, _, _), sentence_ids in zip(sentences, label_ids)
+    ]
+    return st_preds_to_jsonl_datum(text, sentences, preds)["entities"]
+
+
+TEXT = "Знание Python Django и SQL Server. Docker"
+SENTENCES = [
+    (
+        ["Знание", "Python", "Django", "и", "SQL", "Server", "."],
+        None,
+        [0, 7, 14, 21, 23, 27, 33],
+    ),
+    (["Docker"], None, [35]),
+]
+
+
+@pytest.mark.parametrize(
+    "label_ids, expected",
+    [
+        (
+            [[0, 1, 1, 0, 3, 4, 0], [3]],
+            [[7, 13, "PL"], [14, 20, "PL"], [23, 33, "Tool"], [35, 41, "Tool"]],
+        ),
+        # I- without B-, and I- of another class start an entity
+        (
+            [[0, 2, 2, 0, 4, 2, 0], [4]],
+            [[7, 20, "PL"], [23, 26, "Tool"], [27, 33, "PL"], [35, 41, "Tool"]],
+        ),
+        # An entity doesn't go on into the next sentence
+        ([[0, 0, 0, 0, 0, 3, 4], [4]], [[27, 34, "Tool"], [35, 41, "Tool"]]),
+        ([[0] * 7, [0]], []),
+    ],
+)
+def test_bio_ids_to_entities_matches_golden_output(label_ids, expected):
+    entities, confidence = _decode(SENTENCES, label_ids)
+    assert entities == expected
+    assert confidence is None
+    assert _previous_entities(TEXT, SENTENCES, label_ids) == expected
+
+
+def test_confidence_is_the_lowest_token_score():
+    label_ids = [[0, 1, 2, 0, 3, 4, 0], [3]]
+    scores = np.array([0.9, 0.8, 0.6, 0.9, 0.7, 0.95, 0.9, 0.5])
+    entities, confidence = _decode(SENTENCES, label_ids, scores)
+    assert entities == [[7, 20, "PL"], [23, 33, "Tool"], [35, 41, "Tool"]]
+    assert confidence == pytest.approx([0.6, 0.7, 0.5])
+
+
+def test_bio_ids_to_entities_matches_previous_decoding():
+    rng = random.Random(0)
+    for _ in range(2000):
+        sentences, label_ids, text = [], [], ""
+        for _ in range(rng.randint(1, 4)):
+            tokens, offsets = [], []
+            for _ in range(rng.randint(1, 8)):
+                offsets.append(len(text))
+                tokens.append("x" * rng.randint(1, 3))
+                text += tokens[-1] + " "
+            sentences.append((tokens, None, offsets))
+            # Sentences longer than max_seq_length have labels for the
+            # first tokens only
+            n_labels = rng.randint(1, len(tokens))
+            label_ids.append([rng.randrange(len(LABELS)) for _ in range(n_labels)])
+        entities, _ = _decode(sentences, label_ids)
+        assert entities == _previous_entities(text, sentences, label_ids)
@@ -0,0 +1,269 @@
+import json
+import random
+
+import pytest
+from dt_nav.models.document_keyword import DocumentKeywordStatus
+from dt_nav.nlp.preprocess import KeywordAutomaton
+from dt_nav.processes.ner.jsonl_common import (
+    _STATUS_PRIORITIES,
+    _equal_blocks,
+    _equal_token_blocks,
+    _merge_jsonl_entities,
+    _update_jsonl_by_text,
+    fix_kw,
+)
+from dt_nav.utils import IdentitySet
+
+_KEYWORDS = {"python": "PL", "sql": "Tool", "go": "PL", "c++": "PL", "docker": "Tool"}
+_FILLER = ["опыт", "знание", "и", "от", "лет", "работы", "3", "5", "google"]
+_SEPARATORS = [" ", ", ", ". ", "\n", " / "]
+
+
+def _random_edit(rng):
+    """Texts of random words and separators, the second with some words edited."""
+    words = list(_KEYWORDS) + _FILLER
+    pieces = [
+        (rng.choice(words), rng.choice(_SEPARATORS)) for _ in range(rng.randint(1, 30))
+    ]
+    source_text = "".join(w + s for w, s in pieces)
+    for _ in range(rng.randint(1, 4)):
+        i = rng.randint(0, len(pieces) - 1) if len(pieces) > 0 else 0
+        op = rng.random()
+        if op < 0.4 or len(pieces) == 0:
+            pieces.insert(i, (rng.choice(words), rng.choice(_SEPARATORS)))
+        elif op < 0.7:
+            del pieces[i]
+        else:
+            pieces[i] = (rng.choice(words), pieces[i][1])
+    return source_text, "".join(w + s for w, s in pieces)
+
+
+def test_equal_blocks_are_unchanged_text():
+    rng = random.Random(0)
+    for _ in range(1000):
+        source_text, target_text = _random_edit(rng)
+        prev_end, prev_target_end = 0, 0
+        for start, end, target_start in _equal_blocks(source_text, target_text):
+            assert start < end
+            assert start >= prev_end and target_start >= prev_target_end
+            target_end = target_start + end - start
+            assert source_text[start:end] == target_text[target_start:target_end]
+            prev_end, prev_target_end = end, target_end
+
+
+def test_equal_blocks_of_one_line_are_the_token_diff():
+    # Texts without newlines are one line each, so the blocks are those
+    # of the token diff of the whole texts the remap used before
+    rng = random.Random(1)
+    for _ in range(1000):
+        source_text, target_text = _random_edit(rng)
+        source_text = source_text.replace("\n", " ")
+        target_text = target_text.replace("\n", " ")
+        if source_text == target_text:
+            continue
+        assert _equal_blocks(source_text, target_text) == _equal_token_blocks(
+            source_text, target_text, 0, 0
+        )
+
+
+def test_update_jsonl_by_text_matches_golden_output():
+    source_text = "Требования: Python, SQL.\nОпыт работы с Go от 3 лет.\nЗнание C++."
+    target_text = (
+        "Вакансия.\nТребования: Python, SQL, Docker.\n"
+        "Опыт работы с GO от 5 лет.\nЗнание C++ и python."
+    )
+    source_datum = {
+        "text": source_text,
+        "entities": [(12, 18, "PL"), (20, 23, "Tool"), (39, 41, "PL"), (59, 62, "PL")],
+        "status": {"sql": DocumentKeywordStatus.CONFIRMED},
+    }
+    datum = _update_jsonl_by_text(source_datum, target_text)
+    assert datum["text"] == target_text
+    assert datum["entities"] == [
+        (22, 28, "PL"),
+        (30, 33, "Tool"),
+        (57, 59, "PL"),
+        (77, 80, "PL"),
+        (83, 89, "PL"),
+    ]
+    assert [target_text[s:e] for s, e, _ in datum["entities"]] == [
+        "Python",
+        "SQL",
+        "GO",
+        "C++",
+        "python",
+    ]
+    assert datum["status"] == {
+        "python": DocumentKeywordStatus.EXTRACTED,
+        "sql": DocumentKeywordStatus.CONFIRMED,
+        "go": DocumentKeywordStatus.EXTRACTED,
+        "c++": DocumentKeywordStatus.EXTRACTED,
+    }
+
+
+def test_update_jsonl_by_text_matches_search_of_whole_text():
+    # The previous code searched the whole new text for every keyword
+    # of the datum. That gives the same entities as long as every
+    # occurrence of the keywords in the old text is an entity.
+    rng = random.Random(2)
+    automaton = KeywordAutomaton(_KEYWORDS.items())
+    for _ in range(1000):
+        source_text, target_text = _random_edit(rng)
+        if source_text == target_text:
+            continue
+        entities = list(automaton.find_all(source_text))
+        source_datum = {"text": source_text, "entities": entities, "status": {}}
+        datum = _update_jsonl_by_text(source_datum, target_text)
+
+        datum_keywords = {source_text[s:e].lower(): c for s, e, c in entities}
+        previous = KeywordAutomaton(datum_keywords.items()).find_all(target_text)
+        assert datum["entities"] == sorted(previous)
+
+
+def _previous_merge_jsonl_entities(target_datum, source):
+    """The per-character merge _merge_jsonl_entities used to do."""
+    entities = [*target_datum["entities"]]
+    status = {**target_datum["status"]}
+    target_entities_by_ents = {json.dumps(e): e for e in target_datum["entities"]}
+    for e in source["entities"]:
+        value = fix_kw(source["text"][e[0] : e[1]])
+        source_status = source["status"].get(value, DocumentKeywordStatus.EXTRACTED)
+        if source_status == DocumentKeywordStatus.EXTRACTED:
+            continue
+        if json.dumps(e) in target_entities_by_ents:
+            if source_status in (
+                DocumentKeywordStatus.CONFIRMED,
+                DocumentKeywordStatus.ADDED,
+            ):
+                status[value] = DocumentKeywordStatus.CONFIRMED
+            elif source_status == DocumentKeywordStatus.REJECTED:
+                status[value] = DocumentKeywordStatus.REJECTED
+            continue
+        entities.append(e)
+
+    entities_by_index = {}
+    for e in entities:
+        for i in range(e[0], e[1]):
+            entities_by_index.setdefault(i, []).append(e)
+    result, rejected = IdentitySet(), IdentitySet()
+    for i in sorted(entities_by_index):
+        entities_here = [e for e in entities_by_index[i] if e not in rejected]
+        if len(entities_here) > 1:
+            entities_here = sorted(
+                entities_here,
+                key=lambda e: _STATUS_PRIORITIES.get(
+                    status[fix_kw(target_datum["text"][e[0] : e[1]])], 0
+                ),
+                reverse=True,
+            )
+        result.add(entities_here[0])
+        for e in entities_here[1:]:
+            rejected.add(e)
+    return {
+        "text": target_datum["text"],
+        "entities": sorted(list(result), key=lambda e: e[0]),
+        "status": status,
+    }
+
+
+_TEXT = "Знание Python и SQL Server, Python"
+
+
+def test_merge_jsonl_entities_matches_golden_output():
+    target_datum = {
+        "text": _TEXT,
+        "entities": [(7, 13, "PL"), (16, 19, "Tool"), (28, 34, "PL")],
+        "status": {
+            "python": DocumentKeywordStatus.EXTRACTED,
+            "sql": DocumentKeywordStatus.EXTRACTED,
+        },
+    }
+    source_datum = {
+        "text": _TEXT,
+        "entities": [[7, 13, "PL"], [20, 26, "Tool"], [0, 6, "Skill"]],
+        "status": {
+            "python": DocumentKeywordStatus.ADDED,
+            "server": DocumentKeywordStatus.CONFIRMED,
+            "знание": DocumentKeywordStatus.REJECTED,
+        },
+    }
+    expected = {
+        "text": _TEXT,
+        "entities": [
+            [0, 6, "Skill"],
+            (7, 13, "PL"),
+            (16, 19, "Tool"),
+            [20, 26, "Tool"],
+            (28, 34, "PL"),
+        ],
+        "status": {
+            "python": DocumentKeywordStatus.CONFIRMED,
+            "sql": DocumentKeywordStatus.EXTRACTED,
+        },
+    }
+    assert _merge_jsonl_entities(target_datum, source_datum) == expected
+    assert _previous_merge_jsonl_entities(target_datum, source_datum) == expected
+
+    # A saved entity overlapping a new one needs its status in the new
+    # datum, as before
+    source_datum["entities"].append([16, 26, "Tool"])
+    source_datum["status"]["sql server"] = DocumentKeywordStatus.CONFIRMED
+    with pytest.raises(KeyError):
+        _previous_merge_jsonl_entities(target_datum, source_datum)
+    with pytest.raises(KeyError):
+        _merge_jsonl_entities(target_datum, source_datum)
+
+
+def test_rejected_entity_outliving_its_winner_is_skipped():
+    # "Знание" wins over "ние Pyt" at its start, and "ние Pyt" goes on
+    # after it, covered by rejected entities only
+    target_datum = {
+        "text": _TEXT,
+        "entities": [(0, 6, "Skill"), (3, 10, "PL")],
+        "status": {
+            "знание": DocumentKeywordStatus.CONFIRMED,
+            "ние pyt": DocumentKeywordStatus.EXTRACTED,
+        },
+    }
+    source_datum = {"text": _TEXT, "entities": [], "status": {}}
+    with pytest.raises(IndexError):
+        _previous_merge_jsonl_entities(target_datum, source_datum)
+    datum = _merge_jsonl_entities(target_datum, source_datum)
+    assert datum["entities"] == [(0, 6, "Skill")]
+
+
+def test_merge_jsonl_entities_matches_previous_merge():
+    rng = random.Random(3)
+    statuses = list(DocumentKeywordStatus)
+    for _ in range(3000):
+        text = "".join(rng.choice("ab ") for _ in range(rng.randint(1, 25)))
+
+        def random_entities(n):
+            res = []
+            for _ in range(n):
+                start = rng.randint(0, len(text))
+                end = rng.randint(start, min(len(text), start + 6))
+                entity = (start, end, rng.choice("XY"))
+                res.append(list(entity) if rng.random() < 0.5 else entity)
+            return res
+
+        target_entities = random_entities(rng.randint(0, 6))
+        source_entities = random_entities(rng.randint(0, 6))
+        if len(target_entities) > 0 and rng.random() < 0.3:
+            source_entities.append(list(rng.choice(target_entities)))
+        values = {fix_kw(text[s:e]) for s, e, _ in target_entities + source_entities}
+        target_datum = {
+            "text": text,
+            "entities": target_entities,
+            "status": {v: rng.choice(statuses) for v in values},
+        }
+        source_datum = {
+            "text": text,
+            "entities": source_entities,
+            "status": {v: rng.choice(statuses) for v in values if rng.random() < 0.8},
+        }
+        try:
+            expected = _previous_merge_jsonl_entities(target_datum, source_datum)
+        except IndexError:
+            continue
+        assert _merge_jsonl_entities(target_datum, source_datum) == expected
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from dt_nav.nlp.preprocess.keyword_automaton import KeywordAutomaton
+
+
+def _is_word_char(c):
+    return c.isalnum() or c == "_"
+
+
+def _naive_find_all(keywords, text):
+    """Every boundary-respecting occurrence, found by plain slicing."""
+    res = []
+    folded = text.lower()
+    # Keywords differing only in case are the same keyword, the last
+    # value wins
+    folded_keywords = {keyword.lower(): value for keyword, value in keywords}
+    for keyword, value in folded_keywords.items():
+        for start in range(len(text) - len(keyword) + 1):
+            end = start + len(keyword)
+            if folded[start:end] != keyword:
+                continue
+            if _is_word_char(text[start]) and start > 0:
+                if _is_word_char(text[start - 1]):
+                    continue
+            if _is_word_char(text[end - 1]) and end < len(text):
+                if _is_word_char(text[end]):
+                    continue
+            res.append((start, end, value))
+    return sorted(res, key=lambda m: (m[1], m[0]))
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Python, SQL", [(0, 6, "Lang"), (8, 11, "Tool")]),
+        # Word boundaries
+        ("google go golang", [(7, 9, "Lang")]),
+        ("C++/C#, c++17", [(0, 3, "Lang"), (4, 6, "Lang"), (8, 11, "Lang")]),
+        # Leftmost longest
+        ("machine learning", [(0, 16, "Skill")]),
+        ("Опыт с PostgreSQL и постгрес", [(7, 17, "Tool"), (20, 28, "Tool")]),
+        ("", []),
+    ],
+)
+def test_find_matches_golden_output(text, expected):
+    automaton = KeywordAutomaton(
+        [
+            ("python", "Lang"),
+            ("sql", "Tool"),
+            ("go", "Lang"),
+            ("c++", "Lang"),
+            ("C#", "Lang"),
+            ("machine learning", "Skill"),
+            ("learning", "Skill"),
+            ("PostgreSQL", "Tool"),
+            ("Постгрес", "Tool"),
+        ]
+    )
+    assert automaton.find(text) == expected
+
+
+def test_offsets_survive_characters_changing_length_when_lowercased():
+    automaton = KeywordAutomaton([("java", "Lang")])
+    text = "İstanbul Java"
+    assert automaton.find(text) == [(9, 13, "Lang")]
+    assert text[9:13] == "Java"
+
+
+def test_keywords_added_after_a_search_are_found():
+    automaton = KeywordAutomaton([("java", "Lang")])
+    assert automaton.find("java javascript") == [(0, 4, "Lang")]
+    automaton.add("javascript", "Lang")
+    automaton.add("java", "Island")
+    assert automaton.find("java javascript") == [(0, 4, "Island"), (5, 15, "Lang")]
+    assert len(automaton) == 2
+    assert "JavaScript" in automaton and "script" not in automaton
+
+
+def test_copy_is_independent():
+    automaton = KeywordAutomaton([("java", "Lang")])
+    other = automaton.copy()
+    other.add("kotlin", "Lang")
+    assert automaton.find("java kotlin") == [(0, 4, "Lang")]
+    assert other.find("java kotlin") == [(0, 4, "Lang"), (5, 11, "Lang")]
+
+
+def test_find_all_matches_naive_search():
+    rng = random.Random(0)
+    words = ["a", "ab", "b", "ba", "aba", "a b", "b+", "+", "_a", "A"]
+    for _ in range(500):
+        keywords = [(rng.choice(words), i) for i in range(rng.randint(0, 5))]
+        text = "".join(rng.choice("aAb +_") for _ in range(rng.randint(0, 15)))
+        automaton = KeywordAutomaton(keywords)
+        assert list(automaton.find_all(text)) == _naive_find_all(keywords, text)
@@ -0,0 +1,72 @@
+import json
+import subprocess
+import sys
+
+import torch
+from safetensors.torch import load_file
+from transformers import BertConfig, BertForTokenClassification
+
+# Loads a model from the directory in argv[1], from safetensors if
+# argv[2] is "1", and prints the load time, the peak RSS of the process
+# and a hash of the weights
+_LOAD_SCRIPT = """
+import hashlib, json, resource, sys, time
+
+from transformers import BertForTokenClassification
+
+start = time.perf_counter()
+model = BertForTokenClassification.from_pretrained(
+    sys.argv[1], use_safetensors=sys.argv[2] == "1"
+)
+seconds = time.perf_counter() - start
+weights = hashlib.sha256()
+for name, tensor in sorted(model.state_dict().items()):
+    weights.update(name.encode())
+    weights.update(tensor.numpy().tobytes())
+print(json.dumps({
+    "seconds": seconds,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "weights": weights.hexdigest(),
+}))
+"""
+
+
+def _load(model_dir, use_safetensors):
+    out = subprocess.run(
+        [sys.executable, "-c", _LOAD_SCRIPT, str(model_dir), str(int(use_safetensors))],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def test_safetensors_and_pickle_load_the_same_weights(tmp_path):
+    config = BertConfig(
+        vocab_size=30000,
+        hidden_size=256,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        intermediate_size=1024,
+        num_labels=9,
+    )
+    model = BertForTokenClassification(config)
+    safetensors_dir, pickle_dir = tmp_path / "safetensors", tmp_path / "pickle"
+    model.save_pretrained(safetensors_dir, safe_serialization=True)
+    config.save_pretrained(pickle_dir)
+    torch.save(
+        load_file(safetensors_dir / "model.safetensors"),
+        pickle_dir / "pytorch_model.bin",
+    )
+
+    # Each format is loaded in a fresh process, so the peak RSS is that
+    # of loading it alone. Both copy the weights into the model, so the
+    # peak RSS is about the same, see pytest -s for the numbers.
+    from_safetensors = _load(safetensors_dir, True)
+    from_pickle = _load(pickle_dir, False)
+    for name, result in (("safetensors", from_safetensors), ("pickle", from_pickle)):
+        print(
+            f"{name}: loaded in {result['seconds']:.3f} s, "
+            f"peak RSS {result['max_rss_kb'] / 1024:.0f} MB"
+        )
+    assert from_safetensors["weights"] == from_pickle["weights"]
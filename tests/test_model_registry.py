@@ -0,0 +1,42 @@
+import time
+
+from dt_nav.processes.ner.model_registry import NERModelRegistry
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_generation_changes_when_another_version_is_loaded(tmp_path):
+    registry = NERModelRegistry(str(tmp_path), lambda path: path, check_interval=0)
+    first, first_dir = registry.new_version()
+    registry.activate(first)
+    assert registry.generation == 0
+
+    assert registry.get_model() == first_dir
+    assert registry.generation == 1
+    registry.get_model()
+    assert registry.generation == 1
+
+    second, second_dir = registry.new_version()
+    registry.activate(second)
+    registry.get_model()
+    _wait_for(lambda: registry.generation == 2)
+    assert registry.get_model() == second_dir
+    assert registry.loaded_dir() == second_dir
+
+
+def test_cached_active_dir_reads_active_file_after_check_interval(tmp_path):
+    registry = NERModelRegistry(str(tmp_path), lambda path: path, check_interval=60)
+    first, first_dir = registry.new_version()
+    registry.activate(first)
+    assert registry.cached_active_dir() == first_dir
+
+    second, second_dir = registry.new_version()
+    registry.activate(second)
+    assert registry.cached_active_dir() == first_dir
+    registry.check_interval = 0
+    assert registry.cached_active_dir() == second_dir
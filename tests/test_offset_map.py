@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+import pytest
+
+from dt_nav.nlp.preprocess.offset_map import TextEditBuffer
+
+
+def _apply(text, edits):
+    buffer = TextEditBuffer(text)
+    for start, end, replacement, anchor in edits:
+        buffer.replace(start, end, replacement, anchor)
+    return buffer.apply()
+
+
+def test_shrinking_replacement_keeps_positions_inside():
+    new_text, offset_map = _apply("hello     world", [(5, 10, " ", "start")])
+    assert new_text == "hello world"
+    positions = [0, 1, 2, 3, 4, 5, 6, 6, 6, 6, 6, 7, 8, 9, 10, 11]
+    assert offset_map.positions.tolist() == positions
+    assert offset_map.remap_spans([(7, 15, "X")]) == [(6, 11, "X")]
+    assert offset_map.remap_spans([(0, 7, "X")]) == [(0, 6, "X")]
+
+
+def test_shrinking_end_anchored_replacement_keeps_positions_inside():
+    new_text, offset_map = _apply("hello     world", [(5, 10, " ", "end")])
+    assert new_text == "hello world"
+    assert offset_map.positions.tolist()[5:11] == [5, 5, 5, 5, 5, 6]
+    assert offset_map.remap_spans([(7, 15, "X")]) == [(5, 11, "X")]
+
+
+@pytest.mark.parametrize(
+    "entity, expected",
+    [
+        # Inside the deleted gap
+        ((6, 8, "X"), (5, 5, "X")),
+        # Ends right before the gap, starts right after it
+        ((0, 3, "X"), (0, 3, "X")),
+        ((9, 12, "X"), (5, 8, "X")),
+        # Crosses one of the boundaries
+        ((2, 6, "X"), (2, 5, "X")),
+        ((7, 11, "X"), (5, 7, "X")),
+    ],
+)
+def test_entities_around_replaced_gap(entity, expected):
+    # The gap after the first sentence is replaced with ". "
+    new_text, offset_map = _apply("abc  \n\n\n def", [(3, 9, ". ", "start")])
+    assert new_text == "abc. def"
+    assert offset_map.remap_spans([entity]) == [expected]
+
+
+def test_deleted_prefix_moves_with_its_end():
+    new_text, offset_map = _apply("\n\n abc", [(0, 3, "", "end")])
+    assert new_text == "abc"
+    assert offset_map.remap_spans([(1, 5, "X"), (0, 2, "X")]) == [
+        (0, 2, "X"),
+        (0, 0, "X"),
+    ]
+
+
+def test_random_edits_give_monotonic_maps():
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = "".join(rng.choice("ab ") for _ in range(rng.randint(0, 20)))
+        buffer = TextEditBuffer(text)
+        for _ in range(rng.randint(0, 4)):
+            start = rng.randint(0, len(text))
+            end = min(len(text), start + rng.randint(0, 6))
+            replacement = "x" * rng.randint(0, 4)
+            buffer.replace(start, end, replacement, rng.choice(["start", "end"]))
+        new_text, offset_map = buffer.apply()
+
+        assert np.all(np.diff(offset_map.positions) >= 0)
+        assert np.all(np.diff(offset_map.ends) >= 0)
+        assert offset_map.positions[-1] == len(new_text)
+        for start in range(len(text)):
+            for end in range(start + 1, len(text) + 1):
+                new_start, new_end = offset_map.positions[start], offset_map.ends[end]
+                assert 0 <= new_start <= new_end <= len(new_text)
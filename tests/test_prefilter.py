@@ -0,0 +1,73 @@
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dt_nav.nlp.preprocess.sentence_prefilter import (
+    SentencePrefilter,
+    get_prefilter_stats,
+)
+from dt_nav.nlp.preprocess.sentence_splitter import SentenceSplitter
+
+DATA_DIR = Path(__file__).parent / "data"
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+@pytest.fixture
+def sentences():
+    """Tokens of the sample sentences and whether they have entities."""
+    splitter = SentenceSplitter()
+    sentences, has_entities = [], []
+    with open(DATA_DIR / "ner_sample.jsonl", encoding="utf-8") as f:
+        for line in f:
+            datum = json.loads(line)
+            for offset, sentence in splitter.split(datum["text"], datum["entities"]):
+                end = offset + len(sentence)
+                sentences.append(_TOKEN_RE.findall(sentence))
+                has_entities.append(
+                    any(offset <= start < end for start, _, _ in datum["entities"])
+                )
+    return sentences, has_entities
+
+
+def test_sample_has_sentences_with_and_without_entities(sentences):
+    _, has_entities = sentences
+    assert 2 <= sum(has_entities) <= len(has_entities) - 2
+
+
+def test_full_recall_keeps_all_sentences(sentences):
+    tokens, has_entities = sentences
+    prefilter = SentencePrefilter(n_features=2**12).fit(tokens, has_entities)
+    assert len(prefilter.positive_scores) > 0
+
+    before = get_prefilter_stats()
+    keep = prefilter.keep_mask(tokens, recall=1.0)
+    assert keep.all()
+    stats = get_prefilter_stats().since(before)
+    assert (stats.sentences, stats.skipped) == (len(tokens), 0)
+
+
+def test_threshold_grows_as_recall_drops(sentences):
+    tokens, has_entities = sentences
+    prefilter = SentencePrefilter(n_features=2**12).fit(tokens, has_entities)
+    thresholds = [prefilter.threshold(r) for r in (1.0, 0.9, 0.5, 0.0)]
+    assert thresholds == sorted(thresholds)
+    assert prefilter.scores([]).shape == (0,)
+
+
+def test_needs_both_classes(sentences):
+    tokens, _ = sentences
+    with pytest.raises(ValueError):
+        SentencePrefilter().fit(tokens, [True] * len(tokens))
+
+
+def test_save_and_load(tmp_path, sentences):
+    tokens, has_entities = sentences
+    prefilter = SentencePrefilter(n_features=2**12).fit(tokens, has_entities)
+    path = str(tmp_path / "prefilter.joblib")
+    prefilter.save(path)
+    loaded = SentencePrefilter.load(path)
+    np.testing.assert_array_equal(loaded.scores(tokens), prefilter.scores(tokens))
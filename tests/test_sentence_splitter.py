@@ -0,0 +1,93 @@
+import pytest
+
+from dt_nav.nlp.preprocess.sentence_splitter import SentenceSplitter
+
+# Expected sentences are the output of CunningTokenizer.extract_sentences
+# before it was replaced by SentenceSplitter
+CASES = [
+    (
+        "Мы ищем разработчика. Опыт работы с Python от 3 лет. Знание SQL.",
+        None,
+        [
+            (0, "Мы ищем разработчика"),
+            (22, "Опыт работы с Python от 3 лет"),
+            (53, "Знание SQL."),
+        ],
+    ),
+    (
+        "Требования:\n- знание Python\n- опыт работы с Django и Flask\n"
+        "Условия:\n- удалённая работа\n- ДМС",
+        None,
+        [
+            (0, "Требования:\n- знание Python\n- опыт работы с Django и Flask\n"),
+            (59, "Условия:\n- удалённая работа\n- ДМС"),
+        ],
+    ),
+    (
+        "Компания разрабатывает высоконагруженные сервисы для крупных банков.\n"
+        "Мы используем микросервисную архитектуру на Kubernetes и Kafka.\n"
+        "Вы будете проектировать и поддерживать API на Go и PostgreSQL.",
+        None,
+        [
+            (0, "Компания разрабатывает высоконагруженные сервисы для крупных банков"),
+            (69, "Мы используем микросервисную архитектуру на Kubernetes и Kafka"),
+            (133, "Вы будете проектировать и поддерживать API на Go и PostgreSQL."),
+        ],
+    ),
+    (
+        "Привет!? Это тест.\n\n\n\nНовый абзац после пустых строк. ...",
+        None,
+        [
+            (0, "Привет"),
+            (6, "!?"),
+            (8, " Это тест"),
+            (22, "Новый абзац после пустых строк"),
+        ],
+    ),
+    (
+        "Обязанности:\nразработка backend на Java\nКонтакты: hr@example.com",
+        [[29, 33, "Skill"], [47, 58, "Skill"]],
+        [
+            (0, "Обязанности:\nразработка backend на Java\n"),
+            (40, "Контакты: hr@example.com"),
+        ],
+    ),
+    (
+        "Дисциплина изучает базы данных.\nКомпетенции:\nУК-1\nОПК-2",
+        [[20, 31, "Skill"]],
+        [
+            (0, "Дисциплина изучает базы данных"),
+            (32, "Компетенции:\nУК-1\n"),
+            (50, "ОПК-2"),
+        ],
+    ),
+    (
+        "   \n.  \n",
+        None,
+        [],
+    ),
+    (
+        "Стек: Python, FastAPI, Docker. Будет плюсом: опыт с ML.\n"
+        "Мы предлагаем:\n  \nгибкий график",
+        [[6, 12, "Skill"], [14, 21, "Skill"], [80, 93, "Skill"]],
+        [
+            (0, "Стек: Python, FastAPI, Docker"),
+            (31, "Будет плюсом: опыт с ML"),
+            (56, "Мы предлагаем:\n  \n"),
+            (74, "гибкий график"),
+        ],
+    ),
+]
+
+
+@pytest.mark.parametrize("text, entities, expected", CASES)
+def test_split_matches_golden_output(text, entities, expected):
+    splitter = SentenceSplitter()
+    assert splitter.split(text, entities) == expected
+
+
+@pytest.mark.parametrize("text, entities, expected", CASES)
+def test_sentences_are_slices_of_text(text, entities, expected):
+    splitter = SentenceSplitter()
+    for offset, sentence in splitter.split(text, entities):
+        assert text[offset : offset + len(sentence)] == sentence